@@ -0,0 +1,227 @@
+"""Benchmark end-to-end conversions on a synthetic EPUB corpus.
+
+Books from epub_corpus.py are served from a loopback HTTP server and run
+through EpubToPdfConverter.convert_epub_to_pdf with cold caches, exactly as a
+queued job would run. Each profile reports pages/s, books/min, per-stage
+latency (median over runs) and peak memory, and the results are written as
+JSON so two commits can be compared. Peak memory is the highest RSS sampled
+during any stage of a run, in the web or a render process. Run from the
+repository root:
+
+    python benchmarks/bench_conversion.py --profiles small images --runs 3
+    python benchmarks/bench_conversion.py --baseline benchmarks/results/abc1234.json
+    python benchmarks/bench_conversion.py --profiles large --segmented --render-processes 8
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from epub_corpus import build_epub, spec_id
+
+PROFILES = {
+    'small': {'chapters': 5, 'paragraphs': 20},
+    'large': {'chapters': 60, 'paragraphs': 80},
+    'nested': {'chapters': 10, 'paragraphs': 40, 'depth': 20},
+    'images': {'chapters': 10, 'paragraphs': 20, 'images': 12, 'image_size': [2400, 1600]},
+    'latin': {'chapters': 20, 'paragraphs': 40, 'cyrillic': 0.0},
+    'cyrillic': {'chapters': 20, 'paragraphs': 40, 'cyrillic': 1.0}
+}
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory):
+    """Serve directory on a free loopback port; returns (server, base URL)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def build_corpus(corpus_dir, names):
+    """Generate (or reuse) one EPUB per profile; returns {profile: (file name, spec)}"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = {}
+    for name in names:
+        file_name = f'{name}-{spec_id(PROFILES[name])}.epub'
+        path = os.path.join(corpus_dir, file_name)
+        if not os.path.exists(path):
+            build_epub(path + '.tmp', **PROFILES[name])
+            os.replace(path + '.tmp', path)
+        corpus[name] = (file_name, PROFILES[name])
+    return corpus
+
+
+def clear_caches(*caches):
+    """Empty the converter's on-disk caches so every run starts cold"""
+    for cache in caches:
+        shutil.rmtree(cache.root, ignore_errors=True)
+        os.makedirs(cache.root, exist_ok=True)
+
+
+def run_conversion(converter, store, params):
+    conversion_id = str(uuid.uuid4())
+    start = time.perf_counter()
+    converter.convert_epub_to_pdf(conversion_id, params)
+    wall = time.perf_counter() - start
+    record = store.get(conversion_id)
+    store.delete(conversion_id)
+    if record['status'] != 'completed':
+        raise RuntimeError(f"conversion failed: {record['message']}")
+    pdf_path = record['pdf_path']
+    pdf_bytes = os.path.getsize(pdf_path)
+    shutil.rmtree(os.path.dirname(pdf_path), ignore_errors=True)
+    return {
+        'wall': wall,
+        'pages': record['page_count'],
+        'pdf_bytes': pdf_bytes,
+        'peak_rss': max(stage['rss'] for stage in record['stages'].values()),
+        'stages': {name: stage['wall'] for name, stage in record['stages'].items()}
+    }
+
+
+def summarize(runs):
+    wall = statistics.median(run['wall'] for run in runs)
+    pages = runs[0]['pages']
+    stage_names = sorted({name for run in runs for name in run['stages']})
+    return {
+        'wall_median': round(wall, 4),
+        'wall_min': round(min(run['wall'] for run in runs), 4),
+        'pages': pages,
+        'pdf_bytes': runs[0]['pdf_bytes'],
+        'pages_per_second': round(pages / wall, 2),
+        'books_per_minute': round(60 / wall, 2),
+        'peak_rss': max(run['peak_rss'] for run in runs),
+        'stages': {name: round(statistics.median(run['stages'].get(name, 0) for run in runs), 4)
+                   for name in stage_names}
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """Print median wall time changes against a previous results file; returns the regressed profiles"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f"\nagainst {baseline_path} ({baseline.get('revision')}):")
+    for name, summary in results['profiles'].items():
+        previous = baseline['profiles'].get(name)
+        if previous is None:
+            continue
+        change = summary['wall_median'] / previous['wall_median'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:>10} {previous['wall_median']:>9.3f}s -> {summary['wall_median']:>9.3f}s {change:>+8.1%}{flag}")
+        for stage, wall in summary['stages'].items():
+            before = previous['stages'].get(stage)
+            if before:
+                print(f"{'':>10}   {stage:<13} {before:>8.3f}s -> {wall:>8.3f}s {wall / before - 1:>+8.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=sorted(PROFILES))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--render-processes', type=int, default=None,
+                        help='size of the render process pool (default: CONVERTER_RENDER_PROCESSES)')
+    parser.add_argument('--segmented', action='store_true',
+                        help='render in parallel segments (the "segmented" conversion parameter)')
+    parser.add_argument('--corpus-dir', default=os.path.join(ROOT, 'benchmarks', '.corpus'))
+    parser.add_argument('--output', default=None, help='results file (default: benchmarks/results/<revision>.json)')
+    parser.add_argument('--baseline', default=None, help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown of a profile reported as a regression')
+    args = parser.parse_args()
+
+    # The converter reads its configuration at import time
+    work_dir = tempfile.mkdtemp(prefix='epub-bench-')
+    os.environ['CONVERTER_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    if args.render_processes is not None:
+        os.environ['CONVERTER_RENDER_PROCESSES'] = str(args.render_processes)
+
+    from src.routes.converter import EpubToPdfConverter, result_cache, layout_cache, book_cache
+    from src.services.downloader import download_cache
+    from src.services.asset_cache import asset_cache
+    from src.services.job_queue import RENDER_PROCESSES
+    from src.services.job_store import MemoryJobStore, set_job_store
+
+    store = MemoryJobStore()
+    set_job_store(store)
+    converter = EpubToPdfConverter()
+    corpus = build_corpus(args.corpus_dir, args.profiles)
+    server, base_url = serve_directory(args.corpus_dir)
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'render_processes': RENDER_PROCESSES,
+        'segmented': args.segmented,
+        'runs': args.runs,
+        'profiles': {}
+    }
+    try:
+        # Start the render pool outside the measured runs
+        clear_caches(result_cache, layout_cache, book_cache, download_cache, asset_cache)
+        run_conversion(converter, store, {'epub_url': f'{base_url}/{corpus[args.profiles[0]][0]}',
+                                          'segmented': args.segmented})
+
+        print(f"{'profile':>10} {'pages':>6} {'median s':>9} {'pages/s':>8} {'books/min':>10} {'peak MB':>8}")
+        for name in args.profiles:
+            file_name, spec = corpus[name]
+            runs = []
+            for _ in range(args.runs):
+                clear_caches(result_cache, layout_cache, book_cache, download_cache, asset_cache)
+                runs.append(run_conversion(converter, store, {'epub_url': f'{base_url}/{file_name}',
+                                                              'segmented': args.segmented}))
+            summary = dict(summarize(runs), spec=spec)
+            results['profiles'][name] = summary
+            print(f"{name:>10} {summary['pages']:>6} {summary['wall_median']:>9.3f} "
+                  f"{summary['pages_per_second']:>8.1f} {summary['books_per_minute']:>10.1f} "
+                  f"{summary['peak_rss'] / 1024 ** 2:>8.0f}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{results['revision'] or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f'\nwrote {output}')
+
+    if args.baseline and compare(results, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark PDF size and build time by script, font family and glyph coding.
+
+Renders synthetic Latin and Cyrillic books (see epub_corpus.py) straight
+through EpubToPdfConverter.build_pdf, once with ReportLab's ASCII-readable
+glyph codes and once with the coding the converter picks for the book's
+script. Every embedded TrueType font is checked to be a per-document subset,
+and the embedded font bytes are reported next to the full font files. Run
+from the repository root:
+
+    python benchmarks/bench_fonts.py --chapters 20 --families sans serif --runs 3
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ebooklib import epub
+from PyPDF2 import PdfReader
+from epub_corpus import build_epub, spec_id
+import src.routes.converter as converter_module
+from src.routes.converter import EpubToPdfConverter
+from src.services.fonts import FONT_FAMILIES, resolve_font_family, find_font_file
+
+SCRIPTS = {'latin': 0.0, 'mixed': 0.5, 'cyrillic': 1.0}
+
+
+def embedded_fonts(pdf_path):
+    """(subset names, embedded font bytes, fonts that are not subsets) of a PDF"""
+    subsets, streams, whole = set(), {}, set()
+    for page in PdfReader(pdf_path).pages:
+        fonts = page['/Resources'].get_object().get('/Font')
+        for ref in (fonts.get_object().values() if fonts else ()):
+            font = ref.get_object()
+            if font.get('/Subtype') != '/TrueType':
+                continue
+            name = str(font['/BaseFont'])
+            # Subsets are named with a six-letter tag, e.g. /AAAAAB+DejaVuSans
+            if len(name) > 8 and name[7] == '+':
+                subsets.add(name)
+            else:
+                whole.add(name)
+            font_file = font['/FontDescriptor'].get_object().raw_get('/FontFile2')
+            streams[font_file.idnum] = len(font_file.get_object().get_data())
+    return subsets, sum(streams.values()), whole
+
+
+def build(converter, parsed_book, settings, pdf_path):
+    start = time.perf_counter()
+    converter.build_pdf(pdf_filename=pdf_path, cover_path=None, title_bg_path=None, blurred_cover_path=None,
+                        full_page_image_path=None, images={}, **parsed_book, **settings)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scripts', nargs='+', choices=sorted(SCRIPTS), default=['latin', 'cyrillic'])
+    parser.add_argument('--families', nargs='+', default=['sans', 'serif'])
+    parser.add_argument('--chapters', type=int, default=20)
+    parser.add_argument('--paragraphs', type=int, default=40)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--corpus-dir', default=os.path.join(ROOT, 'benchmarks', '.corpus'))
+    args = parser.parse_args()
+
+    converter = EpubToPdfConverter()
+    pick_coding = converter_module.ascii_readable
+    work_dir = tempfile.mkdtemp(prefix='epub-fonts-')
+    os.makedirs(args.corpus_dir, exist_ok=True)
+    failures = 0
+
+    print(f"{'script':>9} {'family':>13} {'coding':>9} {'pages':>6} {'PDF KB':>8} {'fonts KB':>9} "
+          f"{'TTF KB':>8} {'subsets':>8} {'build s':>8}")
+    for script in args.scripts:
+        spec = {'chapters': args.chapters, 'paragraphs': args.paragraphs, 'cyrillic': SCRIPTS[script]}
+        epub_path = os.path.join(args.corpus_dir, f'fonts-{script}-{spec_id(spec)}.epub')
+        if not os.path.exists(epub_path):
+            build_epub(epub_path + '.tmp', **spec)
+            os.replace(epub_path + '.tmp', epub_path)
+        parsed_book = converter.parse_book(epub.read_epub(epub_path))
+
+        for family_name in args.families:
+            family = resolve_font_family(family_name)
+            settings = converter.layout_settings({'font_family': family})
+            full_bytes = sum(os.path.getsize(path) for path in map(find_font_file, FONT_FAMILIES[family].values())
+                             if path)
+            for coding, choose in (('readable', lambda text: True), ('by-script', pick_coding)):
+                converter_module.ascii_readable = choose
+                pdf_path = os.path.join(work_dir, f'{script}-{family}-{coding}.pdf')
+                walls = [build(converter, parsed_book, settings, pdf_path) for _ in range(args.runs)]
+                subsets, font_bytes, whole = embedded_fonts(pdf_path)
+                pages = len(PdfReader(pdf_path).pages)
+                print(f"{script:>9} {family:>13} {coding:>9} {pages:>6} {os.path.getsize(pdf_path) / 1024:>8.1f} "
+                      f"{font_bytes / 1024:>9.1f} {full_bytes / 1024:>8.0f} {len(subsets):>8} "
+                      f"{statistics.median(walls):>8.3f}")
+                if whole:
+                    failures += 1
+                    print(f"{'':>9} not subset: {', '.join(sorted(whole))}")
+            converter_module.ascii_readable = pick_coding
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
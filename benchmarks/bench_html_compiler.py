@@ -0,0 +1,76 @@
+"""Benchmark the chapter HTML compiler on deeply nested markup.
+
+Compares HtmlBlockCompiler with the recursive find_all/str()/re-parse walk that
+process_html_content used before, on chapters whose paragraphs sit inside
+increasingly deep <div> nesting. Run from the repository root:
+
+    python benchmarks/bench_html_compiler.py --paragraphs 200 --depths 1 5 10 20 40
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+from src.services.html_flowables import HtmlBlockCompiler
+
+
+def nested_chapter(paragraphs, depth):
+    """A chapter where every paragraph is wrapped in `depth` nested divs"""
+    paragraph = '<p>Lorem <b>ipsum</b> dolor <i>sit</i> amet, consectetur adipiscing elit.</p>'
+    body = paragraph * paragraphs
+    for _ in range(depth):
+        body = f'<div class="wrap">{body}</div>'
+    return f'<html><body><h1>Chapter</h1>{body}</body></html>'
+
+
+def legacy_walk(html_content):
+    """The pre-compiler algorithm: every div is serialized and parsed again.
+
+    The original passed str(element), which re-parses to a tree containing the
+    same div and never terminates; the inner HTML is used here instead.
+    """
+    blocks = 0
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for element in soup.find_all(True):
+        if element.name == 'div':
+            blocks += legacy_walk(element.decode_contents())
+        elif element.get_text(strip=True):
+            blocks += 1
+    return blocks
+
+
+def best_of(runs, func, *args):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--paragraphs', type=int, default=200)
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 5, 10, 20, 40])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--legacy-max-depth', type=int, default=6,
+                        help='skip the legacy walk above this depth (its cost explodes with nesting)')
+    args = parser.parse_args()
+
+    compiler = HtmlBlockCompiler()
+    print(f"{'depth':>6} {'html bytes':>11} {'blocks':>7} {'compiler s':>11} {'legacy s':>10}")
+    for depth in args.depths:
+        chapter = nested_chapter(args.paragraphs, depth)
+        blocks = len(compiler.compile(chapter))
+        compiler_time = best_of(args.runs, compiler.compile, chapter)
+        legacy = '-'
+        if depth <= args.legacy_max_depth:
+            legacy = f'{best_of(args.runs, legacy_walk, chapter):.4f}'
+        print(f'{depth:>6} {len(chapter):>11} {blocks:>7} {compiler_time:>11.4f} {legacy:>10}')
+
+
+if __name__ == '__main__':
+    main()
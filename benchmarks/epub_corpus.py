@@ -0,0 +1,150 @@
+"""Generate synthetic EPUBs for benchmarking the converter.
+
+Books are built with ebooklib from a seeded random generator, so a given spec
+always produces the same text, markup and images. Run from the repository
+root to write a single book:
+
+    python benchmarks/epub_corpus.py /tmp/book.epub --chapters 20 --paragraphs 40 --images 5
+"""
+import io
+import os
+import json
+import random
+import hashlib
+import argparse
+from PIL import Image, ImageDraw
+from ebooklib import epub
+
+LATIN_WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et '
+    'dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea '
+    'commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur'
+).split()
+CYRILLIC_WORDS = (
+    'книга глава слово город время человек жизнь дело рука день голова дом сторона друг вопрос лицо '
+    'место работа страна мир ночь глаз земля вода отец мать сила война путь история утро вечер дорога'
+).split()
+
+DEFAULT_SPEC = {
+    'chapters': 10,
+    'paragraphs': 30,
+    'words': 60,
+    'depth': 1,
+    'images': 0,
+    'image_size': [1200, 800],
+    'cyrillic': 0.5,
+    'seed': 0
+}
+
+
+def spec_id(spec):
+    """Short stable identifier of a corpus spec, used for file names"""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def sentence(rng, words, cyrillic):
+    vocabulary = CYRILLIC_WORDS if rng.random() < cyrillic else LATIN_WORDS
+    chosen = [rng.choice(vocabulary) for _ in range(max(1, words))]
+    # Sprinkle inline markup the compiler has to carry across the paragraph
+    for _ in range(len(chosen) // 15):
+        index = rng.randrange(len(chosen))
+        tag = rng.choice(('b', 'i', 'em', 'strong'))
+        chosen[index] = f'<{tag}>{chosen[index]}</{tag}>'
+    text = ' '.join(chosen)
+    return text[0].upper() + text[1:] + '.'
+
+
+def synthetic_image(rng, size, index):
+    """A deterministic photo-like JPEG: gradients plus random shapes"""
+    width, height = size
+    image = Image.merge('RGB', [
+        Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size),
+        Image.radial_gradient('L').resize(size),
+        Image.linear_gradient('L').rotate(90 + index).resize(size)
+    ])
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(5, max(6, min(width, height) // 6))
+        fill = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=fill)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def chapter_html(rng, spec, number, image_names):
+    body = [f'<h1>Chapter {number}</h1>']
+    for index in range(spec['paragraphs']):
+        if index and index % 12 == 0:
+            body.append(f'<h2>Section {index // 12}</h2>')
+        if index and index % 17 == 0:
+            items = ''.join(f'<li>{sentence(rng, 8, spec["cyrillic"])}</li>' for _ in range(4))
+            body.append(f'<ul>{items}</ul>')
+        paragraph = f'<p>{sentence(rng, spec["words"], spec["cyrillic"])}</p>'
+        # Wrap in `depth` nested containers, as many converted books do
+        for _ in range(spec['depth'] - 1):
+            paragraph = f'<div class="wrap">{paragraph}</div>'
+        body.append(paragraph)
+    for name in image_names:
+        body.insert(rng.randrange(1, len(body) + 1), f'<p><img src="images/{name}" alt=""/></p>')
+    return ''.join(body)
+
+
+def build_epub(path, **overrides):
+    """Write a synthetic EPUB to path and return the full spec it was built from"""
+    spec = dict(DEFAULT_SPEC, **overrides)
+    rng = random.Random(spec['seed'])
+
+    book = epub.EpubBook()
+    book.set_identifier(f'synthetic-{spec_id(spec)}')
+    book.set_title(f'Synthetic book {spec_id(spec)}')
+    book.set_language('ru' if spec['cyrillic'] >= 0.5 else 'en')
+    book.add_author('Benchmark Corpus')
+    book.add_metadata('DC', 'description', f'Generated from {json.dumps(spec, sort_keys=True)}')
+
+    image_names = []
+    for index in range(spec['images']):
+        name = f'image_{index:03d}.jpg'
+        book.add_item(epub.EpubItem(uid=f'image_{index}', file_name=f'images/{name}',
+                                    media_type='image/jpeg',
+                                    content=synthetic_image(rng, tuple(spec['image_size']), index)))
+        image_names.append(name)
+
+    chapters = []
+    for number in range(1, spec['chapters'] + 1):
+        chapter_images = image_names[number - 1::spec['chapters']]
+        chapter = epub.EpubHtml(title=f'Chapter {number}', file_name=f'chapter_{number:03d}.xhtml', lang='ru')
+        chapter.content = chapter_html(rng, spec, number, chapter_images)
+        book.add_item(chapter)
+        chapters.append(chapter)
+
+    book.toc = chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    book.spine = ['nav'] + chapters
+    epub.write_epub(path, book)
+    return spec
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output')
+    parser.add_argument('--chapters', type=int, default=DEFAULT_SPEC['chapters'])
+    parser.add_argument('--paragraphs', type=int, default=DEFAULT_SPEC['paragraphs'], help='per chapter')
+    parser.add_argument('--words', type=int, default=DEFAULT_SPEC['words'], help='per paragraph')
+    parser.add_argument('--depth', type=int, default=DEFAULT_SPEC['depth'], help='<div> nesting around paragraphs')
+    parser.add_argument('--images', type=int, default=DEFAULT_SPEC['images'])
+    parser.add_argument('--image-size', type=int, nargs=2, default=DEFAULT_SPEC['image_size'], metavar=('W', 'H'))
+    parser.add_argument('--cyrillic', type=float, default=DEFAULT_SPEC['cyrillic'], help='share of Cyrillic sentences')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SPEC['seed'])
+    args = parser.parse_args()
+
+    spec = build_epub(args.output, chapters=args.chapters, paragraphs=args.paragraphs, words=args.words,
+                      depth=args.depth, images=args.images, image_size=list(args.image_size),
+                      cyrillic=args.cyrillic, seed=args.seed)
+    print(f'{args.output}: {os.path.getsize(args.output)} bytes, spec {json.dumps(spec, sort_keys=True)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""Gunicorn settings, picked up automatically when gunicorn is started from this directory.
+
+The app is imported once in the master, which then registers the font and
+renders a warm-up page before forking, so every worker starts with ReportLab,
+ebooklib, Pillow, lxml/bs4 and PyPDF2 imported and the font parsed. Each
+worker then starts its render processes right away; they warm themselves up
+in the background instead of during the first conversions.
+"""
+import os
+
+preload_app = True
+
+# Status long-polls and streamed downloads hold a thread each
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+
+def on_starting(server):
+    # Metrics count from this start; the files of an earlier run's workers would be added forever
+    from src.services.metrics import metrics
+    metrics.clear()
+
+
+def when_ready(server):
+    from src.routes.converter import warm_up
+    warm_up()
+
+
+def post_fork(server, worker):
+    from src.services.job_store import get_job_store
+    from src.services.job_queue import start_render_pool
+    from src.services.workspaces import workspace_reaper
+    get_job_store().after_fork()
+    workspace_reaper.after_fork()
+    workspace_reaper.start()
+    start_render_pool()
@@ -1,15 +1,35 @@
 import os
 import sys
+import logging
+import secrets
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from flask import Flask, send_from_directory
 from flask_cors import CORS
 from src.routes.converter import converter_bp
+from src.services.job_store import init_job_store
+from src.services.downloader import MAX_DOWNLOAD_BYTES
+from src.services.uploads import UploadRequest
+from src.services.workspaces import workspace_reaper
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
-app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
+# Spool uploaded files to named files so they can be handed to the converter without a copy
+app.request_class = UploadRequest
+# Signs the download links sent by email. Without SECRET_KEY a random key is made at startup,
+# shared by the workers gunicorn forks from this process, and links stop working on a restart.
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+if not app.config['SECRET_KEY']:
+    logging.warning("SECRET_KEY is not set; emailed download links will not survive a restart")
+    app.config['SECRET_KEY'] = secrets.token_hex(32)
+app.config['MAX_CONTENT_LENGTH'] = MAX_DOWNLOAD_BYTES  # 100MB max file size
+
+# Conversion status store shared by every gunicorn worker
+database_dir = os.path.join(os.path.dirname(__file__), 'database')
+os.makedirs(database_dir, exist_ok=True)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', f"sqlite:///{os.path.join(database_dir, 'app.db')}")
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+init_job_store(app)
 
 # Enable CORS for all routes
 CORS(app)
@@ -34,4 +54,6 @@ def serve(path):
 
 
 if __name__ == '__main__':
+    # Under gunicorn each worker starts its reaper after the fork (see gunicorn.conf.py)
+    workspace_reaper.start()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,60 @@
+import json
+import sqlite3
+from datetime import datetime
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+db = SQLAlchemy()
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL so status readers in other workers never block the writing job"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.close()
+
+
+class ConversionJob(db.Model):
+    # Fields every status record has; everything else lives in the JSON data column
+    CORE_FIELDS = ('status', 'progress', 'message', 'created_at')
+
+    id = db.Column(db.String(36), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, index=True)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    message = db.Column(db.Text, nullable=False, default='')
+    data = db.Column(db.Text, nullable=False, default='{}')
+    # Incremented on every write so status watchers can tell what they have already seen
+    version = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self):
+        return f'<ConversionJob {self.id} {self.status}>'
+
+    @classmethod
+    def columns(cls, record):
+        """Column values that replace a job's state with a status record; the version is left to the store"""
+        return {
+            'status': record['status'],
+            'progress': record.get('progress', 0),
+            'message': record.get('message', ''),
+            'created_at': record.get('created_at') or datetime.now(),
+            'data': json.dumps({key: value for key, value in record.items()
+                                if key not in cls.CORE_FIELDS and key != 'version'})
+        }
+
+    def to_dict(self):
+        record = json.loads(self.data or '{}')
+        record.update({
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'created_at': self.created_at,
+            'version': self.version
+        })
+        return record
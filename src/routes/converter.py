@@ -3,44 +3,125 @@ import sys
 import requests
 import re
 import html
-import tempfile
-import io
-import threading
+import time
 import uuid
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+import zipfile
+import threading
 from email_validator import validate_email, EmailNotValidError
-from datetime import datetime, timedelta
-from flask import Blueprint, request, jsonify, send_file
+from datetime import datetime
+from flask import Blueprint, Response, request, jsonify, send_file, stream_with_context, current_app, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from ebooklib import epub, ITEM_DOCUMENT, ITEM_IMAGE, ITEM_STYLE
-from bs4 import BeautifulSoup, Tag
-from PIL import Image, ImageFilter
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import (BaseDocTemplate, Frame, PageTemplate, Paragraph,
-                                Spacer, NextPageTemplate, PageBreak, Image as ReportLabImage,
-                                ListFlowable, ListItem)
+                                Spacer, NextPageTemplate, PageBreak, ActionFlowable)
 from reportlab.platypus.flowables import KeepInFrame
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib import colors
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_JUSTIFY
-import PyPDF2
+from reportlab.pdfgen.canvas import Canvas
+from reportlab import rl_config
+import json
+import shutil
+import hashlib
 import logging
+from functools import partial, lru_cache
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from src.services.job_queue import (ConversionQueue, ConversionCancelled, QueueFullError, RENDER_PROCESSES,
+                                    MAX_CONCURRENT_QUOTES, MAX_QUEUED_QUOTES, run_render, run_parallel, iter_parallel, set_render_initializer)
+from src.services.job_store import get_job_store
+from src.services.disk_cache import DiskCache, file_sha256, link_or_copy
+from src.services.downloader import download, download_cache
+from src.services.html_flowables import ChapterFlowableBuilder, block_text, compile_chapter, image_names
+from src.services.image_pipeline import prepare_images, image_sizes, measure_images
+from src.services.asset_cache import asset_cache, page_background, blurred_background
+from src.services.metrics import StageTimer, metrics
+from src.services.uploads import stage_uploads, uploaded_file, discard_uploads
+from src.services.pdf_concat import PdfConcatenator, NAMED_DEST_SCHEME
+from src.services.fonts import register_fonts, resolve_font_family, ascii_readable, start_subsets, BODY_FONT
+from src.services.workspaces import create_workspace, remove_workspace, clear_workspace, workspace_reaper
+from src.services.mailer import mail_queue, build_message
+from src.services.epub_archive import read_epub, item_source, read_source, ArchiveMember
 
 converter_bp = Blueprint('converter', __name__)
 logging.basicConfig(level=logging.INFO)
 
-# Global storage for conversion status
-conversion_status = {}
+# Write image streams as binary rather than ASCII85 text, which is a quarter larger
+rl_config.useA85 = 0
+
+# Bounded FIFO of conversions waiting for a worker slot
+conversion_queue = ConversionQueue()
+# Quotes wait in their own queue, so they are not stuck behind conversions
+quote_queue = ConversionQueue(MAX_CONCURRENT_QUOTES, MAX_QUEUED_QUOTES)
+
+# Bump whenever layout or rendering output changes so stale cached PDFs are not served
+RENDER_VERSION = 9
+# Bump whenever parsing or the compiled block format changes so stale parsed books are not used
+BOOK_VERSION = 2
+
+# Finished PDFs keyed by the hash of everything that determines their content
+result_cache = DiskCache(
+    'results', suffix='.pdf',
+    max_bytes=int(os.environ.get('CONVERTER_RESULT_CACHE_BYTES', 2 * 1024 ** 3)),
+    max_age=int(os.environ.get('CONVERTER_RESULT_CACHE_MAX_AGE', 7 * 24 * 3600))
+)
+
+# Status streaming: long-poll cap, SSE keep-alive and lifetime, queue position refresh (seconds)
+STATUS_LONG_POLL_TIMEOUT = float(os.environ.get('CONVERTER_STATUS_LONG_POLL_TIMEOUT', 30))
+STATUS_STREAM_HEARTBEAT = float(os.environ.get('CONVERTER_STATUS_STREAM_HEARTBEAT', 15))
+STATUS_STREAM_MAX_SECONDS = float(os.environ.get('CONVERTER_STATUS_STREAM_MAX_SECONDS', 600))
+QUEUE_POSITION_INTERVAL = 2
+
+# Progressive conversions render this many chapters per segment; a streaming download
+# (progressive PDF or batch ZIP) gives up waiting for the rest after the timeout (seconds)
+PROGRESSIVE_SEGMENT_CHAPTERS = max(1, int(os.environ.get('CONVERTER_PROGRESSIVE_SEGMENT_CHAPTERS', 4)))
+STREAMING_DOWNLOAD_TIMEOUT = float(os.environ.get('CONVERTER_STREAMING_DOWNLOAD_TIMEOUT', 3600))
+# Render every conversion as segments laid out in parallel unless a request says otherwise
+SEGMENTED_RENDERING = os.environ.get('CONVERTER_SEGMENTED_RENDERING', '0').lower() in ('1', 'true', 'yes', 'on')
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+# Books of one batch converted at the same time (also the cap on a request's
+# "concurrency"), and the most books a batch may hold
+BATCH_CONCURRENCY = max(1, int(os.environ.get('CONVERTER_BATCH_CONCURRENCY', 2)))
+BATCH_MAX_ITEMS = int(os.environ.get('CONVERTER_BATCH_MAX_ITEMS', 200))
+# Emailed PDFs larger than this are sent as a signed download link, valid for
+# EMAIL_LINK_MAX_AGE seconds, instead of an attachment. Links point at
+# CONVERTER_PUBLIC_URL when set, otherwise at the host the request came in on
+EMAIL_ATTACHMENT_MAX_BYTES = int(os.environ.get('CONVERTER_EMAIL_ATTACHMENT_MAX_BYTES', 10 * 1024 ** 2))
+EMAIL_LINK_MAX_AGE = int(os.environ.get('CONVERTER_EMAIL_LINK_MAX_AGE', 24 * 3600))
+PUBLIC_URL = os.environ.get('CONVERTER_PUBLIC_URL')
+# A book whose render is estimated to need more memory than the budget is built in
+# low-memory mode: its story is streamed, STORY_PART_BLOCKS blocks at a time, and it
+# is rendered one segment after another, each holding about a quarter of the budget
+# in drawn pages. The estimate charges every character of chapter text for its
+# flowables and for its share of the drawn pages a document keeps until it is
+# saved (measured on ReportLab 4), plus the size of every image.
+JOB_MEMORY_BUDGET_BYTES = int(os.environ.get('CONVERTER_JOB_MEMORY_BUDGET_MB', 256)) * 1024 ** 2
+STORY_BYTES_PER_CHAR = 24
+PAGE_BYTES_PER_CHAR = 5
+STORY_PART_BLOCKS = 200
+
+# Parsed books (metadata, TOC, compiled chapters, image references and sizes) keyed
+# by the EPUB bytes; every layout of a book starts from one
+book_cache = DiskCache(
+    'books',
+    max_bytes=int(os.environ.get('CONVERTER_BOOK_CACHE_BYTES', 512 * 1024 ** 2)),
+    max_age=int(os.environ.get('CONVERTER_BOOK_CACHE_MAX_AGE', 7 * 24 * 3600))
+)
+
+# Measured page counts keyed by the EPUB bytes and layout settings
+layout_cache = DiskCache(
+    'layouts',
+    max_bytes=int(os.environ.get('CONVERTER_LAYOUT_CACHE_BYTES', 64 * 1024 ** 2)),
+    max_age=int(os.environ.get('CONVERTER_LAYOUT_CACHE_MAX_AGE', 7 * 24 * 3600))
+)
 
 class PageDrawer:
     """Helper class to manage data for ReportLab's onPage functions."""
     def __init__(self, cover_path, title_bg_path, blurred_cover_path, full_page_image_path,
-                 book_title, author_name, inner_margin, outer_margin, top_bottom_margin):
+                 book_title, author_name, inner_margin, outer_margin, top_bottom_margin, font_name=BODY_FONT):
         self.cover_path = cover_path
         self.title_page_bg_path = title_bg_path
         self.blurred_cover_path = blurred_cover_path
@@ -50,6 +131,7 @@ class PageDrawer:
         self.inner_margin = inner_margin
         self.outer_margin = outer_margin
         self.top_bottom_margin = top_bottom_margin
+        self.font_name = font_name
 
     def cover_and_content_pages(self, canvas, doc):
         canvas.saveState()
@@ -60,7 +142,7 @@ class PageDrawer:
             if os.path.exists(self.cover_path):
                 canvas.drawImage(self.cover_path, 0, 0, width=page_width, height=page_height, preserveAspectRatio=False)
         elif page_num > 2:  # Content Pages (skip title page)
-            canvas.setFont('DejaVu-Sans', 9)
+            canvas.setFont(self.font_name, 9)
             header_y = page_height - self.top_bottom_margin + inch * 0.15
 
             # Headers are on the inner top margin
@@ -91,36 +173,133 @@ class PageDrawer:
             canvas.drawImage(self.blurred_cover_path, 0, 0, width=letter[0], height=letter[1], preserveAspectRatio=False)
         canvas.restoreState()
 
+class ConverterDocTemplate(BaseDocTemplate):
+    """Document template that records page statistics while it builds.
+
+    With a progress queue it also reports ('render', chapter, chapters, page)
+    as each chapter starts. Every TOC anchor gets an outline entry, titled
+    from toc, and its position is kept in `destinations` as (page index, top),
+    keyed by its name.
+    first_page is the book page number of the document's first page.
+    """
+    def __init__(self, *args, progress=None, chapter_count=0, first_page=1, toc=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page_count = 0
+        self.template_pages = {}
+        self.destinations = {}
+        self.progress = progress
+        self.chapter_count = chapter_count
+        self.first_page = first_page
+        self.toc_titles = {f'toc_entry_{index}': title for index, title in enumerate(toc)}
+
+    def afterPage(self):
+        self.page_count += 1
+        template_id = self.pageTemplate.id
+        self.template_pages[template_id] = self.template_pages.get(template_id, 0) + 1
+
+    def afterFlowable(self, flowable):
+        # Anchors take no space, so the frame's cursor is where they are
+        for name in getattr(flowable, 'anchors', ()):
+            self.destinations[name] = (self.page_count, self.frame._y)
+            self.canv.addOutlineEntry(self.toc_titles.get(name, name), name, level=0)
+        chapter_index = getattr(flowable, 'chapter_index', None)
+        if chapter_index is not None and self.progress is not None:
+            self.progress.put(('render', chapter_index + 1, self.chapter_count, self.first_page + self.page_count))
+
+class StreamingStory(list):
+    """Story that is filled from an iterable of flowable lists as doc.build drains it.
+
+    doc.build takes flowables off the front of its story and checks len() before
+    each one, so the next list is only pulled in once the last is laid out and
+    the flowables of a part are freed as soon as they have been drawn.
+    """
+    def __init__(self, parts):
+        super().__init__()
+        self._parts = iter(parts)
+
+    def __len__(self):
+        while not super().__len__():
+            part = next(self._parts, None)
+            if part is None:
+                break
+            self.extend(part)
+        return super().__len__()
+
+class ChapterStart(ActionFlowable):
+    """Marks where chapter chapter_index starts, for progress reports; takes no space"""
+    def __init__(self, chapter_index):
+        super().__init__()
+        self.chapter_index = chapter_index
+
+    def apply(self, doc):
+        pass
+
+class LayoutCanvas(Canvas):
+    """Canvas for layout-only builds: pages are counted, but no images are embedded and nothing is written"""
+    def drawImage(self, *args, **kwargs):
+        pass
+
+    def drawInlineImage(self, *args, **kwargs):
+        pass
+
+    def showPage(self):
+        if self._onPage:
+            self._onPage(self._pageNumber)
+        self._startPage()
+
+    def save(self):
+        pass
+
+def numbered_canvas(canvas_class, first_page, ascii_readable=True):
+    """Canvas factory for a document whose first page is page first_page of the book.
+
+    ascii_readable picks how the document's glyph subsets are coded (see fonts.ascii_readable).
+    """
+    def make_canvas(*args, **kwargs):
+        canvas = canvas_class(*args, **kwargs)
+        canvas._pageNumber = first_page
+        start_subsets(canvas._doc, ascii_readable)
+        return canvas
+    return make_canvas
+
+def text_sample(book_title, chapters, limit=50000):
+    """About limit characters of the book's titles and text, without markup"""
+    parts = [book_title] + [title for title, _ in chapters if title]
+    size = sum(len(part) for part in parts)
+    for _, blocks in chapters:
+        for block in blocks:
+            if size >= limit:
+                return ' '.join(parts)
+            if block[0] in ('heading', 'paragraph', 'quote', 'list_item'):
+                parts.append(block_text(block))
+                size += len(parts[-1])
+    return ' '.join(parts)
+
+def render_memory(chapters, images):
+    """Estimated memory of rendering chapters as one document: (story bytes, page bytes).
+
+    The story is every flowable, built up front; the pages are what the
+    document holds until it is saved, embedded images included.
+    """
+    chars = sum(len(block[-1]) for _, blocks in chapters for block in blocks
+                if block[0] in ('heading', 'paragraph', 'quote', 'list_item'))
+    image_bytes = sum(os.path.getsize(path) for path in {entry[0] for entry in images.values()} if path)
+    return chars * STORY_BYTES_PER_CHAR, chars * PAGE_BYTES_PER_CHAR + image_bytes
+
+def flag(value):
+    """Boolean request parameter: true in JSON, or 'true', '1', 'yes' or 'on' in a form"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes', 'on')
+    return bool(value)
+
+def calculate_price(page_count):
+    """Price in rmb: ((page number)*0.04)+22"""
+    return (page_count * 0.04) + 22
+
 class EpubToPdfConverter:
     def __init__(self):
-        # Register DejaVu Sans font
-        font_path = self.get_font_path()
-        if font_path and os.path.exists(font_path):
-            pdfmetrics.registerFont(TTFont('DejaVu-Sans', font_path))
-        else:
-            pdfmetrics.registerFont(TTFont('DejaVu-Sans', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'))
-
-    def get_font_path(self):
-        """Try to find DejaVu Sans font in common locations"""
-        possible_paths = [
-            '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
-            '/System/Library/Fonts/DejaVuSans.ttf',
-            os.path.join(os.path.dirname(__file__), '..', 'static', 'fonts', 'DejaVuSans.ttf')
-        ]
-        for path in possible_paths:
-            if os.path.exists(path):
-                return path
-        return None
-
-    def count_pdf_pages(self, pdf_path):
-        """Count the number of pages in a PDF file"""
-        try:
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                return len(pdf_reader.pages)
-        except Exception as e:
-            logging.error(f"Error counting PDF pages: {e}")
-            return 0
+        # Registered once per process; later converters reuse the parsed font
+        register_fonts()
 
     def get_default_email_body(self):
         """Get the default email body template"""
@@ -136,169 +315,84 @@ Please find the converted PDF attached to this email.
 Best regards,
 EPUB to PDF Converter"""
 
-    def process_email_body(self, email_body, book_title, page_count):
-        """Process email body by replacing placeholders with actual values"""
+    def process_email_body(self, email_body, book_title, page_count, download_link=None):
+        """Process email body by replacing placeholders with actual values.
+
+        With a download_link the PDF is not attached: the link takes the place
+        of the default body's "attached" sentence, or is added at the end.
+        """
         if not email_body or email_body.strip() == "":
             email_body = self.get_default_email_body()
         
         # Replace placeholders with actual values
         processed_body = email_body.replace("{book_title}", str(book_title))
         processed_body = processed_body.replace("{page_count}", str(page_count))
-        
-        return processed_body
-
-    def send_email_with_pdf(self, recipient_email, pdf_path, book_title, page_count, custom_email_body=None):
-        """Send PDF via email with custom email body support"""
-        try:
-            # Email configuration
-            smtp_server = "smtp.gmail.com"
-            smtp_port = 587
-            sender_email = "mr.umaroff@gmail.com"
-            sender_password = "mhwb iwfn epsc glnt"
-            
-            # Create message
-            msg = MIMEMultipart()
-            msg['From'] = sender_email
-            msg['To'] = recipient_email
-            msg['Subject'] = f"Your converted PDF: {book_title}"
-            
-            # Process email body
-            email_body = self.process_email_body(custom_email_body, book_title, page_count)
-            
-            msg.attach(MIMEText(email_body, 'plain'))
-            
-            # Attach PDF
-            with open(pdf_path, 'rb') as f:
-                pdf_attachment = MIMEApplication(f.read(), _subtype='pdf')
-                safe_title = re.sub(r'[\\/*?:"<>|]', "", book_title)
-                pdf_attachment.add_header('Content-Disposition', 'attachment', filename=f"{safe_title}.pdf")
-                msg.attach(pdf_attachment)
-            
-            # Send email
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            server.starttls()
-            server.login(sender_email, sender_password)
-            text = msg.as_string()
-            server.sendmail(sender_email, recipient_email, text)
-            server.quit()
-            
-            return True
-            
-        except Exception as e:
-            logging.error(f"Error sending email: {e}")
-            return False
 
-    def process_html_content(self, html_content, body_style, h1_style, h2_style, h3_style, image_map, frame_width, frame_height):
-        """Process HTML content and convert to ReportLab flowables"""
-        flowables = []
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Process all elements in order
-        for element in soup.find_all(True):
-            if element.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                # Handle headings
-                level = int(element.name[1])
-                text = element.get_text(strip=True)
-                if text:
-                    if level == 1:
-                        flowables.append(Paragraph(text, h1_style))
-                    elif level == 2:
-                        flowables.append(Paragraph(text, h2_style))
-                    else:
-                        flowables.append(Paragraph(text, h3_style))
-                    flowables.append(Spacer(1, 0.15 * inch))
-            
-            elif element.name == 'p':
-                # Handle paragraphs
-                text = element.get_text(strip=True)
-                if text:
-                    flowables.append(Paragraph(text, body_style))
-                    flowables.append(Spacer(1, 0.1 * inch))
-            
-            elif element.name == 'img' and element.get('src'):
-                # Handle images
-                img_src_base = os.path.basename(element['src'])
-                if img_src_base in image_map:
-                    try:
-                        img_data = io.BytesIO(image_map[img_src_base])
-                        with Image.open(img_data) as pil_img:
-                            img_width, img_height = pil_img.size
-
-                        V_BUFFER = 1 * inch
-                        max_width = frame_width
-                        max_height = frame_height - V_BUFFER
-
-                        display_width = img_width
-                        display_height = img_height
-
-                        if display_width > max_width or display_height > max_height:
-                            width_ratio = max_width / display_width
-                            height_ratio = max_height / display_height
-                            scale_ratio = min(width_ratio, height_ratio)
-
-                            display_width = display_width * scale_ratio
-                            display_height = display_height * scale_ratio
-
-                        img_data.seek(0)
-                        rl_image = ReportLabImage(img_data, width=display_width, height=display_height)
-                        flowables.append(rl_image)
-                        flowables.append(Spacer(1, 0.2 * inch))
-                    except Exception as e:
-                        logging.warning(f"Error processing image: {e}")
-            
-            elif element.name == 'div':
-                # Handle divs by recursively processing their content
-                div_flowables = self.process_html_content(str(element), body_style, h1_style, h2_style, h3_style, image_map, frame_width, frame_height)
-                flowables.extend(div_flowables)
-            
-            elif element.name in ['strong', 'b']:
-                # Handle bold text
-                text = element.get_text(strip=True)
-                if text:
-                    flowables.append(Paragraph(f"<b>{text}</b>", body_style))
-            
-            elif element.name in ['em', 'i']:
-                # Handle italic text
-                text = element.get_text(strip=True)
-                if text:
-                    flowables.append(Paragraph(f"<i>{text}</i>", body_style))
-            
-            elif element.name == 'br':
-                # Handle line breaks
-                flowables.append(Spacer(1, 0.1 * inch))
-            
-            elif element.name == 'hr':
-                # Handle horizontal rules
-                flowables.append(Spacer(1, 0.3 * inch))
-                flowables.append(Paragraph("―" * 50, body_style))
-                flowables.append(Spacer(1, 0.3 * inch))
-            
-            elif element.name == 'blockquote':
-                # Handle blockquotes
-                text = element.get_text(strip=True)
-                if text:
-                    flowables.append(Paragraph(f'<para leftIndent="20" spaceAfter="10"><i>"{text}"</i></para>', body_style))
-            
-            elif element.name in ['ul', 'ol']:
-                # Handle lists
-                list_items = []
-                for li in element.find_all('li', recursive=False):
-                    item_text = li.get_text(strip=True)
-                    if item_text:
-                        list_items.append(ListItem(Paragraph(item_text, body_style), leftIndent=20))
-                
-                if list_items:
-                    bullet_style = 'bullet' if element.name == 'ul' else '1'
-                    flowables.append(ListFlowable(list_items, bulletType=bullet_style))
-                    flowables.append(Spacer(1, 0.2 * inch))
-            
+        if download_link:
+            link_text = (f"Your PDF is too large to attach. Download it here "
+                         f"(the link is valid for {EMAIL_LINK_MAX_AGE // 3600} hours):\n{download_link}")
+            attached = "Please find the converted PDF attached to this email."
+            if attached in processed_body:
+                processed_body = processed_body.replace(attached, link_text)
             else:
-                # Fallback for other elements
-                text = element.get_text(strip=True)
-                if text:
-                    flowables.append(Paragraph(text, body_style))
+                processed_body = f"{processed_body.rstrip()}\n\n{link_text}"
         
-        return flowables
+        return processed_body
+
+    def queue_pdf_email(self, conversion_id, recipient_email, status, custom_email_body=None, download_link=None):
+        """Hand a completed job's PDF to the mail queue and record the delivery's outcome.
+
+        PDFs over EMAIL_ATTACHMENT_MAX_BYTES are sent as download_link instead,
+        when there is one, and the job is kept until the link expires.
+        """
+        store = get_job_store()
+        pdf_path = status['pdf_path']
+        book_title = status['book_title']
+        page_count = status['page_count']
+        price = status.get('price', 0)
+        if download_link and os.path.getsize(pdf_path) > EMAIL_ATTACHMENT_MAX_BYTES:
+            # From now on the PDF is only served to the link's token
+            store.update(conversion_id, expires_at=time.time() + EMAIL_LINK_MAX_AGE, email_link=True)
+            workspace_reaper.schedule(conversion_id, os.path.dirname(pdf_path), delay=EMAIL_LINK_MAX_AGE)
+        else:
+            download_link = None
+        email_body = self.process_email_body(custom_email_body, book_title, page_count, download_link)
+        safe_title = re.sub(r'[\\/*?:"<>|]', "", book_title)
+
+        def build():
+            # Read when the email is sent, not while it waits in the queue
+            return build_message(recipient_email, f"Your converted PDF: {book_title}", email_body,
+                                 attachment_path=None if download_link else pdf_path,
+                                 attachment_name=f"{safe_title}.pdf")
+
+        def sent():
+            how = 'Download link' if download_link else 'PDF'
+            store.update(conversion_id, progress=100, email_sent=True, email_pending=False,
+                         recipient_email=recipient_email,
+                         message=f'{how} sent successfully to {recipient_email}! ({page_count} pages, {price:.2f}rmb)')
+
+        def retrying(attempt, delay, error):
+            store.update(conversion_id, message=f'Sending the email failed ({error}); retrying in {delay:g}s...')
+
+        def failed(error):
+            store.update(conversion_id, status='error', email_pending=False,
+                         message='PDF generated but failed to send email')
+
+        mail_queue.submit(recipient_email, build, on_sent=sent, on_retry=retrying, on_failed=failed)
+
+    @staticmethod
+    def chapter_styles(body_style, h1_style, h2_style, h3_style):
+        """Style set used by ChapterFlowableBuilder"""
+        return {
+            'body': body_style,
+            'h1': h1_style,
+            'h2': h2_style,
+            'h3': h3_style,
+            'quote': ParagraphStyle('Quote', parent=body_style, leftIndent=20, rightIndent=20),
+            'list': [ParagraphStyle(f'ListItem{depth}', parent=body_style, alignment=TA_LEFT,
+                                    leftIndent=20 * (depth + 1), bulletIndent=20 * depth + 6)
+                     for depth in range(4)]
+        }
 
     def flatten_toc(self, toc_list):
         flat_list = []
@@ -314,12 +408,7 @@ EPUB to PDF Converter"""
             return None
         if image_input.startswith("http"):
             try:
-                response = requests.get(image_input, timeout=30)
-                response.raise_for_status()
-                image_path = os.path.join(temp_dir, temp_filename)
-                with open(image_path, 'wb') as f:
-                    f.write(response.content)
-                return image_path
+                return download(image_input, os.path.join(temp_dir, temp_filename), timeout=30)
             except requests.RequestException as e:
                 raise IOError(f"Failed to download image {image_input}: {e}")
         else:
@@ -328,26 +417,175 @@ EPUB to PDF Converter"""
             else:
                 raise FileNotFoundError(f"Image file not found: {image_input}")
 
-    def build_story(self, doc, book_title, author_name, book_description, toc_items, content_map,
-                    image_map, font_size, line_spacing, has_full_page_image,
-                    frame_width, frame_height):
-        story = []
+    def fetch_images(self, params, temp_dir, upload_dir=None):
+        """Cover, title background and full-page image paths: uploaded, fetched into temp_dir, or None"""
+        return [
+            uploaded_file(upload_dir, field) or (
+                self.get_image_path(params.get(key), filename, temp_dir) if params.get(key) else None)
+            for key, field, filename in (('cover_input', 'cover_file', 'cover.jpg'),
+                                         ('title_page_bg_input', 'title_page_bg_file', 'title_bg.jpg'),
+                                         ('full_page_image_input', 'full_page_image_file', 'full_page_image.jpg'))
+        ]
+
+    def page_images(self, image_paths, temp_dir):
+        """Blurred final-page cover and page-size copies of the images from fetch_images"""
+        cover_path = image_paths[0]
+        blurred_cover_path = None
+        if cover_path and os.path.exists(cover_path):
+            blurred_cover_path = blurred_background(cover_path, os.path.join(temp_dir, "blurred_cover.jpg"))
+
+        # Full-page artwork is drawn at page size, so embed it at page size
+        page_image_paths = [
+            page_background(path, os.path.join(temp_dir, f"page_{name}.jpg")) if path else None
+            for name, path in zip(('cover', 'title_bg', 'full_page_image'), image_paths)
+        ]
+        return blurred_cover_path, page_image_paths
+
+    def spine_documents(self, book, toc_items):
+        """Documents of the book in reading order.
+
+        That is the linear spine, plus the non-linear documents the TOC links
+        to in their spine position and those missing from the spine after it.
+        The navigation document and the cover page are left out; the PDF has
+        its own.
+        """
+        linked = [item.href.split('#')[0] for item in toc_items]
+        documents = []
+        for idref, linear in book.spine:
+            item = book.get_item_with_id(idref)
+            if item is not None and (linear != 'no' or item.get_name() in linked):
+                documents.append(item)
+        names = {item.get_name() for item in documents}
+        for name in linked:
+            item = book.get_item_with_href(name)
+            if item is not None and name not in names:
+                documents.append(item)
+                names.add(name)
+        return [item for item in documents if item.get_type() == ITEM_DOCUMENT
+                and not isinstance(item, (epub.EpubNav, epub.EpubCoverHtml))]
+
+    def prepare_chapters(self, documents, toc_items):
+        """Compile every document to blocks across the process pool, each document once.
+
+        documents are (name, source) pairs in reading order, the source an
+        ArchiveMember (or bytes), so each document is decompressed by the
+        process that compiles it. Every document opens a chapter, titled by
+        the first TOC entry that links to its start, or untitled. TOC entry k
+        becomes an ('anchor', 'toc_entry_<k>') block where its fragment starts,
+        or at the start of its document; other anchors are dropped, and so are
+        documents with neither content nor a TOC entry. Returns the
+        (title, blocks) chapters and the titles of the TOC entries.
+        """
+        compiled = run_parallel(compile_source, [source for _, source in documents])
+        index = {name: i for i, (name, _) in enumerate(documents)}
+        toc = []
+        targets = [{} for _ in documents]
+        for item in toc_items:
+            name, _, fragment = item.href.partition('#')
+            if name in index:
+                targets[index[name]].setdefault(fragment, []).append(len(toc))
+                toc.append(item.title)
+
+        chapters = []
+        for blocks, doc_targets in zip(compiled, targets):
+            ids = {block[1] for block in blocks if block[0] == 'anchor'}
+            # Entries for the whole document, or for a fragment it lacks, link to its start
+            body = [('anchor', k) for fragment, entries in doc_targets.items() if fragment not in ids for k in entries]
+            for block in blocks:
+                if block[0] != 'anchor':
+                    body.append(block)
+                else:
+                    body.extend(('anchor', k) for k in doc_targets.pop(block[1], ()))
+            if not body:
+                continue
+            leading = next((i for i, block in enumerate(body) if block[0] != 'anchor'), len(body))
+            body[:leading] = sorted(body[:leading])
+            title = toc[body[0][1]] if leading else None
+            # Most chapters open with their own heading; the TOC title replaces it
+            if (title is not None and leading < len(body) and body[leading][0] == 'heading'
+                    and block_text(body[leading]).lower() == title.strip().lower()):
+                del body[leading]
+            chapters.append((title, [('anchor', f'toc_entry_{block[1]}') if block[0] == 'anchor' else block
+                                     for block in body]))
+        return chapters, toc
+
+    def parse_book(self, book):
+        """Metadata and compiled chapters: everything the layout depends on besides the settings"""
+        book_title, author_name, book_description = "Unknown Title", "Unknown Author", "No description found."
+        if book.get_metadata('DC', 'title'):
+            book_title = book.get_metadata('DC', 'title')[0][0]
+        if book.get_metadata('DC', 'creator'):
+            author_name = book.get_metadata('DC', 'creator')[0][0]
+        if book.get_metadata('DC', 'description'):
+            raw_desc = book.get_metadata('DC', 'description')[0][0]
+            book_description = html.unescape(re.sub('<[^<]+?>', '', raw_desc))
+
+        toc_items = self.flatten_toc(book.toc)
+        documents = [(item.get_name(), item_source(book, item)) for item in self.spine_documents(book, toc_items)]
+        chapters, toc = self.prepare_chapters(documents, toc_items)
+        return {
+            'book_title': book_title,
+            'author_name': author_name,
+            'book_description': book_description,
+            'chapters': chapters,
+            'toc': toc
+        }
+
+    def layout_settings(self, params):
+        """Font and margin settings of a request, margins converted to points"""
+        return {
+            'font_size': int(params.get('font_size', 13)),
+            'font_family': resolve_font_family(params.get('font_family')),
+            'line_spacing': float(params.get('line_spacing', 1.5)),
+            'inner_margin': float(params.get('inner_margin', 0.75)) * inch,
+            'outer_margin': float(params.get('outer_margin', 1.20)) * inch,
+            'top_bottom_margin': float(params.get('top_bottom_margin', 0.75)) * inch
+        }
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def story_styles(font_size, line_spacing, font_family=BODY_FONT):
+        """Paragraph styles of the book, by role, with the chapter style set under 'chapter'.
+
+        Built once per process for each font size, line spacing and family and
+        shared by every story, so callers must not modify them. <b> and <i>
+        select the family's bold and italic faces.
+        """
         styles = getSampleStyleSheet()
         leading = font_size * line_spacing
 
-        body_style = ParagraphStyle('BodyText', parent=styles['Normal'], fontName='DejaVu-Sans',
+        body_style = ParagraphStyle('BodyText', parent=styles['Normal'], fontName=font_family,
                                       fontSize=font_size, leading=leading, alignment=TA_JUSTIFY)
-        h1_style = ParagraphStyle('H1', parent=styles['h1'], fontName='DejaVu-Sans',
-                                    fontSize=20, leading=24, spaceAfter=12, alignment=TA_CENTER)
-        toc_style = ParagraphStyle('TOC', parent=styles['Normal'], fontName='DejaVu-Sans',
-                                     fontSize=14, leading=18, leftIndent=inch*0.25)
-        title_page_title_style = ParagraphStyle('TitlePageTitle', parent=styles['h1'], fontName='DejaVu-Sans',
-                                                  fontSize=30, textColor=colors.black, alignment=TA_CENTER)
-        title_page_author_style = ParagraphStyle('TitlePageAuthor', parent=styles['Normal'], fontName='DejaVu-Sans',
-                                                   fontSize=18, textColor=colors.black, alignment=TA_CENTER, spaceBefore=12)
-        description_style = ParagraphStyle('Description', parent=body_style, textColor=colors.white,
-                                             backColor=colors.Color(0,0,0,0.6), alignment=TA_CENTER,
-                                             borderPadding=20, borderRadius=15)
+        h1_style = ParagraphStyle('H1', parent=styles['h1'], fontName=font_family,
+                                  fontSize=20, leading=24, spaceAfter=12, alignment=TA_CENTER)
+        h2_style = ParagraphStyle('H2', parent=styles['h2'], fontName=font_family,
+                                  fontSize=16, leading=20, spaceAfter=8)
+        h3_style = ParagraphStyle('H3', parent=styles['h3'], fontName=font_family,
+                                  fontSize=font_size + 1, leading=leading, spaceAfter=6)
+        return {
+            'body': body_style,
+            'h1': h1_style,
+            'h2': h2_style,
+            'h3': h3_style,
+            'chapter': EpubToPdfConverter.chapter_styles(body_style, h1_style, h2_style, h3_style),
+            'toc': ParagraphStyle('TOC', parent=styles['Normal'], fontName=font_family,
+                                  fontSize=14, leading=18, leftIndent=inch*0.25),
+            'title_page_title': ParagraphStyle('TitlePageTitle', parent=styles['h1'], fontName=font_family,
+                                               fontSize=30, textColor=colors.black, alignment=TA_CENTER),
+            'title_page_author': ParagraphStyle('TitlePageAuthor', parent=styles['Normal'], fontName=font_family,
+                                                fontSize=18, textColor=colors.black, alignment=TA_CENTER, spaceBefore=12),
+            'description': ParagraphStyle('Description', parent=body_style, textColor=colors.white,
+                                          backColor=colors.Color(0,0,0,0.6), alignment=TA_CENTER,
+                                          borderPadding=20, borderRadius=15)
+        }
+
+    def front_matter(self, styles, book_title, author_name, toc, link_prefix='#'):
+        """Title page and table of contents, starting from the (empty) cover page.
+
+        TOC entries link to '<link_prefix>toc_entry_<i>'; a document that does
+        not contain the chapters links through NAMED_DEST_SCHEME instead.
+        """
+        story = []
 
         # Title page
         story.append(NextPageTemplate('TitlePage'))
@@ -355,9 +593,9 @@ EPUB to PDF Converter"""
 
         title_page_content = [
             Spacer(1, 3*inch),
-            Paragraph(book_title, title_page_title_style),
+            Paragraph(book_title, styles['title_page_title']),
             Spacer(1, 0.25*inch),
-            Paragraph(f"<i>{author_name}</i>", title_page_author_style)
+            Paragraph(f"<i>{author_name}</i>", styles['title_page_author'])
         ]
         story.append(KeepInFrame(letter[0], letter[1], title_page_content, vAlign='TOP'))
         
@@ -366,60 +604,48 @@ EPUB to PDF Converter"""
         story.append(PageBreak())
 
         # Table of contents
-        toc_page_content = [Paragraph("Содержание", h1_style), Spacer(1, 0.25*inch)]
-        chapter_content_story = []
-        toc_links = []
-
-        for i, item in enumerate(toc_items):
-            bookmark_key = f'toc_entry_{i}'
-            toc_links.append((item.title, bookmark_key))
-            chapter_content_story.append(PageBreak())
-            title_with_anchor = f'<a name="{bookmark_key}"/>{item.title}'
-            chapter_content_story.append(Paragraph(title_with_anchor, h1_style))
-
-            chapter_html = content_map.get(item.href.split('#')[0])
-            if chapter_html:
-                soup = BeautifulSoup(chapter_html, 'html.parser')
-                for tag in soup.find_all(['p', 'img']):
-                    if tag.name == 'p' and tag.get_text(strip=True):
-                        chapter_content_story.append(Paragraph(tag.get_text(strip=True), body_style))
-                        chapter_content_story.append(Spacer(1, 0.1 * inch))
-                    elif tag.name == 'img' and tag.get('src'):
-                        img_src_base = os.path.basename(tag['src'])
-                        if img_src_base in image_map:
-                            try:
-                                img_data = io.BytesIO(image_map[img_src_base])
-                                with Image.open(img_data) as pil_img:
-                                    img_width, img_height = pil_img.size
-
-                                V_BUFFER = 1 * inch
-                                max_width = frame_width
-                                max_height = frame_height - V_BUFFER
-
-                                display_width = img_width
-                                display_height = img_height
-
-                                if display_width > max_width or display_height > max_height:
-                                    width_ratio = max_width / display_width
-                                    height_ratio = max_height / display_height
-                                    scale_ratio = min(width_ratio, height_ratio)
-
-                                    display_width = display_width * scale_ratio
-                                    display_height = display_height * scale_ratio
-
-                                img_data.seek(0)
-                                rl_image = ReportLabImage(img_data, width=display_width, height=display_height)
-                                chapter_content_story.append(rl_image)
-                                chapter_content_story.append(Spacer(1, 0.2 * inch))
-                            except Exception:
-                                pass  # Skip problematic images
-
-        for title, key in toc_links:
-            toc_page_content.append(Paragraph(f'<a href="#{key}">{title}</a>', toc_style))
-
-        story.extend(toc_page_content)
-        story.extend(chapter_content_story)
+        story.extend([Paragraph("Содержание", styles['h1']), Spacer(1, 0.25*inch)])
+        for i, title in enumerate(toc):
+            story.append(Paragraph(f'<a href="{link_prefix}toc_entry_{i}">{title}</a>', styles['toc']))
+        return story
 
+    def chapter_parts(self, styles, images, chapters, first_index=0, progress=None):
+        """Flowables of chapters[i], numbered from first_index, built and yielded about STORY_PART_BLOCKS blocks at a time.
+
+        Each chapter opens a new page; its first list starts with the page
+        break. A titled chapter opens with its title as a heading, after the
+        anchors of the TOC entries that link to its start.
+        """
+        builder = ChapterFlowableBuilder(styles['chapter'], images)
+        for i, (title, blocks) in enumerate(chapters, first_index):
+            part = [PageBreak(), ChapterStart(i)]
+            if title is not None:
+                leading = next((index for index, block in enumerate(blocks) if block[0] != 'anchor'), len(blocks))
+                part.extend(builder.build(blocks[:leading]))
+                part.append(Paragraph(title, styles['h1']))
+                blocks = blocks[leading:]
+            start = 0
+            while True:
+                end = start + STORY_PART_BLOCKS
+                # An anchor is kept with the flowable after it, so it must not end a part
+                while end < len(blocks) and blocks[end - 1][0] == 'anchor':
+                    end += 1
+                part.extend(builder.build(blocks[start:end]))
+                if progress is not None and end >= len(blocks):
+                    progress.put(('story', i + 1, first_index + len(chapters)))
+                yield part
+                if end >= len(blocks):
+                    break
+                part, start = [], end
+
+    def chapter_story(self, styles, images, chapters, first_index=0, progress=None):
+        """Flowables of chapters[i], numbered from first_index, in one list"""
+        return [flowable for part in self.chapter_parts(styles, images, chapters, first_index, progress)
+                for flowable in part]
+
+    def back_matter(self, styles, book_description, has_full_page_image):
+        """Optional full-page image page and the final page with the description"""
+        story = []
         if has_full_page_image:
             story.append(NextPageTemplate('FullImagePage'))
             story.append(PageBreak())
@@ -429,315 +655,1255 @@ EPUB to PDF Converter"""
         story.append(PageBreak())
         final_page_content = [
             Spacer(1, (letter[1] / 2) - 2*inch),
-            Paragraph(book_description, description_style)
+            Paragraph(book_description, styles['description'])
         ]
         story.append(KeepInFrame(letter[0] - 2*inch, letter[1], final_page_content, hAlign='CENTER', vAlign='MIDDLE'))
-
         return story
 
-    def cleanup_temp_files(self, file_paths, temp_dir):
-        for path in file_paths:
-            if path and path.startswith(temp_dir) and os.path.exists(path):
+    def build_story(self, doc, book_title, author_name, book_description, chapters,
+                    images, font_size, line_spacing, has_full_page_image, progress=None, font_family=BODY_FONT,
+                    streaming=False, toc=()):
+        """The whole book's story; streaming builds each chapter's flowables only when the layout reaches it"""
+        styles = self.story_styles(font_size, line_spacing, font_family)
+        front = self.front_matter(styles, book_title, author_name, toc)
+        back = self.back_matter(styles, book_description, has_full_page_image)
+        if streaming:
+            # Chapters are built during the layout, so there is no story progress to report
+            return StreamingStory(chain([front], self.chapter_parts(styles, images, chapters), [back]))
+        return front + self.chapter_story(styles, images, chapters, progress=progress) + back
+
+    def segment_story(self, segment, book_title, author_name, book_description, chapters,
+                      images, font_size, line_spacing, has_full_page_image, font_family=BODY_FONT, streaming=False,
+                      toc=()):
+        """Story of one segment of the book and the page template its first page uses.
+
+        A segment is {'part': 'front'}, {'part': 'chapters', 'start': i, 'end': j}
+        or {'part': 'back'}, plus 'first_page', the page number it starts on.
+        Built one after another and concatenated, the segments make the same
+        pages as build_story. streaming is as for build_story.
+        """
+        styles = self.story_styles(font_size, line_spacing, font_family)
+        if segment['part'] == 'front':
+            return 'CoverPage', self.front_matter(styles, book_title, author_name, toc,
+                                                  link_prefix=NAMED_DEST_SCHEME)
+        if segment['part'] == 'back':
+            story = self.back_matter(styles, book_description, has_full_page_image)
+            # The segment opens on the page the first template switch would have started
+            return ('FullImagePage' if has_full_page_image else 'FinalPage'), story[2:]
+
+        # Content pages alternate odd/even by absolute page number
+        first, second = 'OddContentPage', 'EvenContentPage'
+        if segment['first_page'] % 2 == 0:
+            first, second = second, first
+        parts = self.chapter_parts(styles, images, chapters[segment['start']:segment['end']],
+                                   first_index=segment['start'])
+        # The segment's first page is a new document's, so its chapter needs no page break
+        opening = [NextPageTemplate([second, first])] + next(parts)[1:]
+        if streaming:
+            return first, StreamingStory(chain([opening], parts))
+        return first, opening + [flowable for part in parts for flowable in part]
+
+    def check_cancelled(self, conversion_id):
+        """Abort the running conversion if it has been cancelled"""
+        if conversion_queue.is_cancelled(conversion_id):
+            raise ConversionCancelled(conversion_id)
+        record = get_job_store().get(conversion_id)
+        if record and record.get('cancel_requested'):
+            raise ConversionCancelled(conversion_id)
+
+    def build_pdf(self, pdf_filename, cover_path, title_bg_path, blurred_cover_path, full_page_image_path,
+                  book_title, author_name, book_description, chapters, images,
+                  font_size, line_spacing, inner_margin, outer_margin, top_bottom_margin,
+                  has_full_page_image=None, layout_only=False, progress=None, segment=None, font_family=BODY_FONT,
+                  streaming=False, toc=()):
+        """Lay out the story and write the PDF to pdf_filename.
+
+        Returns the page count and pages per template, captured during the build.
+        With layout_only the story is paginated on a LayoutCanvas and no file is written.
+        Per-chapter progress events are put on `progress` when one is given, and
+        the story and build stages are timed in 'stages'. With a segment (see
+        segment_story) only that part of the book is built, and 'destinations'
+        holds its TOC anchors for PdfConcatenator.add. toc lists the titles of
+        the TOC entries, for the contents page and the outline. With streaming
+        the chapters' flowables are built during the build stage, a few at a
+        time, instead of all of them up front.
+        """
+        timer = StageTimer()
+        if has_full_page_image is None:
+            has_full_page_image = bool(full_page_image_path)
+        first_page = segment['first_page'] if segment else 1
+        doc = ConverterDocTemplate(pdf_filename, pagesize=letter, progress=progress, chapter_count=len(chapters),
+                                   first_page=first_page, toc=toc)
+        page_width, page_height = letter
+
+        # Calculate frame dimensions based on new margins
+        frame_width = page_width - inner_margin - outer_margin
+        frame_height = page_height - (2 * top_bottom_margin)
+
+        page_drawer = PageDrawer(
+            cover_path=cover_path or '', title_bg_path=title_bg_path or '',
+            blurred_cover_path=blurred_cover_path or '',
+            full_page_image_path=full_page_image_path,
+            book_title=book_title, author_name=author_name,
+            inner_margin=inner_margin, outer_margin=outer_margin,
+            top_bottom_margin=top_bottom_margin, font_name=font_family
+        )
+
+        # DEFINE FRAMES AND PAGE TEMPLATES FOR MIRRORED MARGINS
+        odd_frame = Frame(inner_margin, top_bottom_margin, frame_width, frame_height, id='odd_frame')
+        even_frame = Frame(outer_margin, top_bottom_margin, frame_width, frame_height, id='even_frame')
+
+        page_templates = [
+            PageTemplate(id='CoverPage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.cover_and_content_pages),
+            PageTemplate(id='TitlePage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.title_page_background),
+            PageTemplate(id='OddContentPage', frames=[odd_frame], onPage=page_drawer.cover_and_content_pages),
+            PageTemplate(id='EvenContentPage', frames=[even_frame], onPage=page_drawer.cover_and_content_pages),
+            PageTemplate(id='FinalPage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.final_page_background)
+        ]
+
+        if has_full_page_image:
+            page_templates.append(PageTemplate(id='FullImagePage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.full_image_page_background))
+
+        # Build story
+        with timer.stage('story'):
+            if segment is None:
+                story = self.build_story(doc, book_title, author_name, book_description, chapters,
+                                         images, font_size, line_spacing, has_full_page_image, progress,
+                                         font_family=font_family, streaming=streaming, toc=toc)
+            else:
+                first_template, story = self.segment_story(segment, book_title, author_name, book_description,
+                                                           chapters, images, font_size, line_spacing,
+                                                           has_full_page_image, font_family=font_family,
+                                                           streaming=streaming, toc=toc)
+                # The document starts on its first template
+                page_templates.sort(key=lambda template: template.id != first_template)
+
+        doc.addPageTemplates(page_templates)
+
+        # Generate PDF
+        with timer.stage('build') as stage:
+            doc.build(story, canvasmaker=numbered_canvas(LayoutCanvas if layout_only else Canvas, first_page,
+                                                         ascii_readable(text_sample(book_title, chapters))))
+            if not layout_only:
+                stage['bytes'] = os.path.getsize(pdf_filename)
+        return {'page_count': doc.page_count, 'template_pages': doc.template_pages,
+                'destinations': doc.destinations, 'stages': timer.stages}
+
+    def result_cache_key(self, epub_sha256, image_paths, font_size, line_spacing,
+                         inner_margin, outer_margin, top_bottom_margin, font_family=BODY_FONT):
+        """Hash of the EPUB bytes (given as their hash), the custom images and every layout parameter"""
+        key_parts = {
+            'render_version': RENDER_VERSION,
+            'epub': epub_sha256,
+            'images': [file_sha256(path) if path else None for path in image_paths],
+            'font_size': font_size,
+            'font_family': font_family,
+            'line_spacing': line_spacing,
+            'margins': [inner_margin, outer_margin, top_bottom_margin]
+        }
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def layout_cache_key(self, epub_sha256, has_full_page_image, font_size, line_spacing,
+                         inner_margin, outer_margin, top_bottom_margin, font_family=BODY_FONT):
+        """Hash of the EPUB bytes (given as their hash) and everything else that affects pagination"""
+        key_parts = {
+            'render_version': RENDER_VERSION,
+            'epub': epub_sha256,
+            'full_page_image': has_full_page_image,
+            'font_size': font_size,
+            'font_family': font_family,
+            'line_spacing': line_spacing,
+            'margins': [inner_margin, outer_margin, top_bottom_margin]
+        }
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_layout(self, layout_key):
+        """Return the book title, page count and page stats of a layout from the layout cache, or None"""
+        return self.load_json(layout_cache, layout_key)
+
+    def store_layout(self, layout_key, book_title, page_count, page_stats, temp_dir):
+        self.store_json(layout_cache, layout_key,
+                        {'book_title': book_title, 'page_count': page_count, 'page_stats': page_stats}, temp_dir)
+
+    def load_json(self, cache, key):
+        """Decode a JSON cache entry; None when it is missing or unreadable"""
+        cached = cache.get(key)
+        if cached is None:
+            return None
+        try:
+            with open(cached[0], 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            cache.remove(key)
+            return None
+
+    def store_json(self, cache, key, value, temp_dir):
+        path = os.path.join(temp_dir, f'{key}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        cache.put(key, path)
+        os.remove(path)
+
+    def book_cache_key(self, epub_sha256):
+        """Hash of the EPUB bytes (given as their hash) and the parser version"""
+        key_parts = {'book_version': BOOK_VERSION, 'epub': epub_sha256}
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_book(self, epub_path, epub_sha256, timer, temp_dir):
+        """The book's parsed form, from the book cache or else read, parsed and stored there.
+
+        That is {'book': parse_book's result, 'image_sources': {name: ArchiveMember},
+        'image_sizes': {name: (width, height)}} for the images the chapters
+        use, with the members pointing into epub_path. Reading and parsing
+        are timed as the read_epub and parse stages.
+        """
+        book_key = self.book_cache_key(epub_sha256)
+        with timer.stage('parse'):
+            cached = self.load_json(book_cache, book_key)
+            parsed = None
+            if cached is not None:
                 try:
-                    os.remove(path)
-                except OSError:
-                    pass
+                    parsed = self.decode_book(cached, epub_path)
+                except (KeyError, TypeError, ValueError):
+                    book_cache.remove(book_key)
+        if parsed is not None:
+            return parsed
+
+        with timer.stage('read_epub') as stage:
+            book = read_epub(epub_path)
+            stage['bytes'] = os.path.getsize(epub_path)
+        with timer.stage('parse'):
+            parsed_book = self.parse_book(book)
+            referenced_images = set().union(*(image_names(blocks) for _, blocks in parsed_book['chapters']))
+            image_map = {os.path.basename(item.get_name()): item_source(book, item)
+                         for item in book.get_items_of_type(ITEM_IMAGE)}
+            parsed = {'book': parsed_book,
+                      'image_sources': {name: image_map[name] for name in referenced_images if name in image_map},
+                      'image_sizes': image_sizes(image_map, referenced_images)}
+            self.store_json(book_cache, book_key, self.encode_book(parsed), temp_dir)
+        return parsed
+
+    @staticmethod
+    def encode_book(parsed):
+        """JSON-ready form of load_book's result; members are kept as their name and key"""
+        return dict(parsed, image_sources={name: [member.name, member.key]
+                                           for name, member in parsed['image_sources'].items()})
+
+    @staticmethod
+    def decode_book(cached, epub_path):
+        """Inverse of encode_book, with the members pointing into epub_path"""
+        book = dict(cached['book'], chapters=[(title, [tuple(block) for block in blocks])
+                                              for title, blocks in cached['book']['chapters']])
+        return {'book': book,
+                'image_sources': {name: ArchiveMember(epub_path, member, key)
+                                  for name, (member, key) in cached['image_sources'].items()},
+                'image_sizes': {name: tuple(size) for name, size in cached['image_sizes'].items()}}
+
+    def quote_epub(self, params, upload_dir=None):
+        """Page count and price from a layout-only pass over the book.
+
+        Images are measured from their headers and no PDF is written. The
+        parsed book is kept in the book cache for a later conversion.
+        """
+        settings = self.layout_settings(params)
+        has_full_page_image = bool(params.get('full_page_image_input')
+                                   or uploaded_file(upload_dir, 'full_page_image_file'))
+        temp_dir = upload_dir or create_workspace()
+        try:
+            epub_path = (uploaded_file(upload_dir, 'epub_file')
+                         or download(params.get('epub_url'), os.path.join(temp_dir, "book.epub"), timeout=60))
+            epub_sha256 = file_sha256(epub_path)
+            layout_key = self.layout_cache_key(epub_sha256, has_full_page_image, **settings)
+            cached = self.load_layout(layout_key)
+            if cached is not None:
+                book_title, page_count, page_stats = cached['book_title'], cached['page_count'], cached['page_stats']
+                cache_hit = True
+            else:
+                parsed = self.load_book(epub_path, epub_sha256, StageTimer(), temp_dir)
+                parsed_book = parsed['book']
+                frame_width = letter[0] - settings['inner_margin'] - settings['outer_margin']
+                frame_height = letter[1] - (2 * settings['top_bottom_margin'])
+                images = measure_images(parsed['image_sizes'], frame_width, frame_height)
+
+                # Nothing is drawn, so only the story can outgrow the memory budget
+                story_bytes, _ = render_memory(parsed_book['chapters'], images)
+                layout_stats = run_render(measure_layout, dict(
+                    parsed_book, images=images, has_full_page_image=has_full_page_image,
+                    streaming=story_bytes > JOB_MEMORY_BUDGET_BYTES, **settings))
+                book_title, page_count, page_stats = (parsed_book['book_title'], layout_stats['page_count'],
+                                                      layout_stats['template_pages'])
+                cache_hit = False
+                self.store_layout(layout_key, book_title, page_count, page_stats, temp_dir)
+        finally:
+            remove_workspace(temp_dir)
+
+        return {
+            'book_title': book_title,
+            'page_count': page_count,
+            'price': calculate_price(page_count),
+            'page_stats': page_stats,
+            'cache_hit': cache_hit
+        }
+
+    def complete_conversion(self, conversion_id, pdf_filename, book_title, page_count, page_stats=None,
+                            cache_hit=False, email_pending=False, stages=None, pdf_sha256=None):
+        """Record a finished conversion; email_pending marks it as not final until the PDF is mailed.
+
+        pdf_sha256, the hash of the PDF's contents, is its ETag on /api/download.
+        """
+        price = calculate_price(page_count)
+
+        get_job_store().set(conversion_id, {
+            'status': 'completed',
+            'progress': 100,
+            'message': f'PDF generation complete! ({page_count} pages, {price:.2f}rmb)',
+            'pdf_path': pdf_filename,
+            'pdf_sha256': pdf_sha256 or file_sha256(pdf_filename),
+            'book_title': book_title,
+            'page_count': page_count,
+            'price': price,
+            'page_stats': page_stats or {},
+            'cache_hit': cache_hit,
+            'email_pending': email_pending,
+            'stages': stages or {},
+            'created_at': datetime.now()
+        })
+
+    def complete_from_cache(self, conversion_id, cache_key, temp_dir, email_pending=False, stages=None):
+        """Finish the job with a previously rendered PDF. Returns its path, or None on a cache miss"""
+        cached = result_cache.get(cache_key)
+        if cached is None:
+            return None
+        cached_pdf, meta = cached
+        safe_title = re.sub(r'[\\/*?:"<>|]', "", meta['book_title'])
+        pdf_filename = os.path.join(temp_dir, f"{safe_title}.pdf")
+        try:
+            link_or_copy(cached_pdf, pdf_filename)
+        except OSError:
+            # Evicted by another worker in the meantime
+            return None
+        self.complete_conversion(conversion_id, pdf_filename, meta['book_title'], meta['page_count'],
+                                 page_stats=meta.get('page_stats'), cache_hit=True, email_pending=email_pending,
+                                 stages=stages, pdf_sha256=meta.get('pdf_sha256'))
+        return pdf_filename
+
+    def plan_segments(self, chapters, group_count=None):
+        """Segments of a segmented build: front matter, groups of chapters, back matter.
+
+        With group_count the chapters are split into that many runs of about
+        the same number of blocks, to balance a parallel build; otherwise
+        every PROGRESSIVE_SEGMENT_CHAPTERS chapters make a segment.
+        """
+        if group_count is None:
+            bounds = list(range(0, len(chapters), PROGRESSIVE_SEGMENT_CHAPTERS)) + [len(chapters)]
+        else:
+            sizes = [len(blocks) + 1 for _, blocks in chapters]
+            total = sum(sizes)
+            bounds, done = [0], 0
+            for index, size in enumerate(sizes[:-1], 1):
+                done += size
+                if done * group_count >= total * len(bounds):
+                    bounds.append(index)
+            bounds.append(len(chapters))
+        chapter_groups = [{'part': 'chapters', 'start': start, 'end': end}
+                          for start, end in zip(bounds, bounds[1:]) if end > start]
+        return [{'part': 'front'}] + chapter_groups + [{'part': 'back'}]
+
+    def segment_params(self, render_params, segment):
+        """render_pdf parameters for one segment, without the blocks of chapters it does not contain"""
+        start, end = (segment['start'], segment['end']) if segment['part'] == 'chapters' else (0, 0)
+        chapters = [(title, blocks if start <= index < end else [])
+                    for index, (title, blocks) in enumerate(render_params['chapters'])]
+        return dict(render_params, chapters=chapters, segment=segment)
+
+    def render_segments(self, conversion_id, render_params, on_progress, progressive=False, parallel=False,
+                        group_count=None):
+        """Render the book as separate segment PDFs and concatenate them into the PDF.
+
+        In parallel every segment is first laid out without drawing in the
+        render pool, to learn the page it starts on, and then all of them are
+        rendered in the pool at once. Otherwise segments render one after the
+        other, each starting after the pages of the last. Either way they are
+        appended to '<pdf>.part' in order, as soon as each is done; with
+        progressive the partial file is recorded as 'partial_pdf' and every
+        appended segment bumps 'streamed_bytes', so /api/download can stream
+        it. The file is renamed to the PDF's path once complete. Returns the
+        same statistics as render_pdf, plus the paginate and concat stages.
+        group_count overrides how many chapter segments plan_segments makes.
+        """
+        pdf_filename = render_params['pdf_filename']
+        chapters = render_params['chapters']
+        partial_path = pdf_filename + '.part'
+        segment_dir = os.path.join(os.path.dirname(pdf_filename), 'segments')
+        os.makedirs(segment_dir, exist_ok=True)
+        timer = StageTimer()
+        template_pages = {}
+        if group_count is None and parallel:
+            group_count = 2 * RENDER_PROCESSES
+        segments = self.plan_segments(chapters, group_count=group_count)
+        segment_paths = [os.path.join(segment_dir, f'{index:04d}.pdf') for index in range(len(segments))]
+
+        with open(partial_path, 'wb') as f:
+            concatenator = PdfConcatenator(f)
+            if progressive:
+                get_job_store().update(conversion_id, partial_pdf=partial_path)
+
+            if parallel:
+                # Odd and even frames are the same size, so a segment paginates the
+                # same wherever it starts; lay them out to find where each one does
+                layout_params = {key: value for key, value in render_params.items()
+                                 if key != 'pdf_filename' and not key.endswith('_path')}
+                layout_params['has_full_page_image'] = bool(render_params['full_page_image_path'])
+                with timer.stage('paginate'):
+                    layouts = run_parallel(measure_layout, [
+                        self.segment_params(layout_params, dict(segment, first_page=1)) for segment in segments])
+                first_page = 1
+                for segment, layout in zip(segments, layouts):
+                    segment['first_page'] = first_page
+                    first_page += layout['page_count']
+                self.check_cancelled(conversion_id)
+                rendered = iter_parallel(render_pdf, [
+                    self.segment_params(dict(render_params, pdf_filename=path), segment)
+                    for segment, path in zip(segments, segment_paths)])
+            else:
+                def render_in_turn():
+                    for segment, path in zip(segments, segment_paths):
+                        segment['first_page'] = concatenator.page_count + 1
+                        yield run_render(render_pdf, self.segment_params(dict(render_params, pdf_filename=path), segment),
+                                         on_progress=on_progress)
+                rendered = render_in_turn()
 
-    def convert_epub_to_pdf(self, conversion_id, params):
-        """Main conversion logic"""
+            try:
+                for segment, path, segment_stats in zip(segments, segment_paths, rendered):
+                    for name, record in segment_stats['stages'].items():
+                        timer.add(name, record)
+                    for template_id, count in segment_stats['template_pages'].items():
+                        template_pages[template_id] = template_pages.get(template_id, 0) + count
+
+                    with timer.stage('concat') as stage:
+                        start = concatenator.position
+                        concatenator.add(path, segment_stats['destinations'])
+                        f.flush()
+                        os.remove(path)
+                        stage['bytes'] = concatenator.position - start
+                    if progressive:
+                        get_job_store().update(conversion_id, streamed_bytes=concatenator.position)
+                    if parallel and segment['part'] == 'chapters':
+                        # Pool tasks cannot report per chapter, so progress moves per segment
+                        on_progress(('render', segment['end'], len(chapters), concatenator.page_count))
+                    self.check_cancelled(conversion_id)
+            finally:
+                # Cancels segments not yet started when the build is abandoned
+                rendered.close()
+
+            with timer.stage('concat'):
+                concatenator.close(outline=[(title, f'toc_entry_{index}')
+                                            for index, title in enumerate(render_params.get('toc', ()))])
+        os.replace(partial_path, pdf_filename)
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        return {'page_count': concatenator.page_count, 'template_pages': template_pages, 'stages': timer.stages}
+
+    def render_progress_reporter(self, conversion_id):
+        """Turn render-stage progress events into status updates.
+
+        Story assembly covers 45-50% and layout 50-90%. Writes are throttled to
+        one per percent or half second, whichever comes first.
+        """
+        last_write = {'progress': None, 'at': 0.0}
+
+        def report(event):
+            stage, done, total = event[:3]
+            if stage == 'story':
+                progress = 45 + 5 * done // total
+                message = f'Preparing chapter {done} of {total}...'
+            else:
+                progress = 50 + 40 * done // total
+                message = f'Rendering chapter {done} of {total} (page {event[3]})...'
+            now = time.monotonic()
+            if done < total and progress == last_write['progress'] and now - last_write['at'] < 0.5:
+                return
+            last_write.update(progress=progress, at=now)
+            get_job_store().update(conversion_id, progress=progress, message=message)
+
+        return report
+
+    def convert_epub_to_pdf(self, conversion_id, params, email_pending=False, upload_dir=None, shared_images=None):
+        """Main conversion logic; every stage is timed into the record's 'stages'.
+
+        Parts uploaded with the request are staged in upload_dir, which becomes
+        the job's working directory; they are used in place of the URL inputs.
+        shared_images, prepared by a batch, replaces fetching and resizing the
+        request's own images; its files belong to the batch and are left alone.
+        Once the job is final its workspace is scheduled for removal; only the
+        PDF of a completed job is left in it until then.
+        """
+        temp_dir = upload_dir
+        timer = StageTimer()
         try:
-            conversion_status[conversion_id] = {
+            self.check_cancelled(conversion_id)
+            progressive = flag(params.get('progressive'))
+            segmented = flag(params.get('segmented', SEGMENTED_RENDERING))
+            if temp_dir is None:
+                temp_dir = create_workspace()
+            started = {
                 'status': 'processing',
                 'progress': 0,
                 'message': 'Starting conversion...',
-                'created_at': datetime.now()
+                'progressive': progressive,
+                'workspace': temp_dir
             }
+            # Merged into the queued record, so a cancel requested meanwhile is not lost
+            if not get_job_store().update(conversion_id, **started):
+                get_job_store().set(conversion_id, dict(started, created_at=datetime.now()))
+            self.check_cancelled(conversion_id)
 
             # Extract parameters
             epub_url = params.get('epub_url')
-            cover_input = params.get('cover_input', '')
-            title_page_bg_input = params.get('title_page_bg_input', '')
-            full_page_image_input = params.get('full_page_image_input', '')
-            font_size = int(params.get('font_size', 13))
-            line_spacing = float(params.get('line_spacing', 1.5))
-            
-            # Margin parameters
-            inner_margin = float(params.get('inner_margin', 0.75)) * inch
-            outer_margin = float(params.get('outer_margin', 1.20)) * inch
-            top_bottom_margin = float(params.get('top_bottom_margin', 0.75)) * inch
-
-            conversion_status[conversion_id]['progress'] = 5
-            conversion_status[conversion_id]['message'] = 'Fetching EPUB file...'
-
-            # Fetch EPUB
-            response = requests.get(epub_url, timeout=60)
-            response.raise_for_status()
-
-            temp_dir = tempfile.mkdtemp()
-            epub_path = os.path.join(temp_dir, "book.epub")
-            with open(epub_path, 'wb') as f:
-                f.write(response.content)
-            book = epub.read_epub(epub_path)
-
-            conversion_status[conversion_id]['progress'] = 15
-            conversion_status[conversion_id]['message'] = 'Processing EPUB content...'
-
-            # Extract metadata
-            book_title, author_name, book_description = "Unknown Title", "Unknown Author", "No description found."
-            if book.get_metadata('DC', 'title'):
-                book_title = book.get_metadata('DC', 'title')[0][0]
-            if book.get_metadata('DC', 'creator'):
-                author_name = book.get_metadata('DC', 'creator')[0][0]
-            if book.get_metadata('DC', 'description'):
-                raw_desc = book.get_metadata('DC', 'description')[0][0]
-                book_description = html.unescape(re.sub('<[^<]+?>', '', raw_desc))
-
-            # Map content and images
-            toc_items = self.flatten_toc(book.toc)
-            content_map = {item.get_name(): item.get_content() for item in book.get_items_of_type(ITEM_DOCUMENT)}
-            image_map = {os.path.basename(item.get_name()): item.get_content() for item in book.get_items_of_type(ITEM_IMAGE)}
-
-            conversion_status[conversion_id]['progress'] = 25
-            conversion_status[conversion_id]['message'] = 'Preparing images...'
-
-            # Process images
-            cover_path = self.get_image_path(cover_input, "cover.jpg", temp_dir) if cover_input else None
-            title_bg_path = self.get_image_path(title_page_bg_input, "title_bg.jpg", temp_dir) if title_page_bg_input else None
-            full_page_image_path = self.get_image_path(full_page_image_input, "full_page_image.jpg", temp_dir) if full_page_image_input else None
-
-            # Create blurred cover if cover exists
-            blurred_cover_path = None
-            if cover_path and os.path.exists(cover_path):
-                blurred_cover_path = os.path.join(temp_dir, "blurred_cover.jpg")
-                with Image.open(cover_path) as img:
-                    img_resized = img.resize((int(letter[0]), int(letter[1])))
-                    img_resized.filter(ImageFilter.GaussianBlur(25)).save(blurred_cover_path)
-
-            conversion_status[conversion_id]['progress'] = 35
-            conversion_status[conversion_id]['message'] = 'Building PDF structure...'
-
-            # Build PDF
-            safe_title = re.sub(r'[\\/*?:"<>|]', "", book_title)
-            pdf_filename = os.path.join(temp_dir, f"{safe_title}.pdf")
+            settings = self.layout_settings(params)
 
-            doc = BaseDocTemplate(pdf_filename, pagesize=letter)
-            page_width, page_height = letter
+            get_job_store().update(conversion_id, progress=5, message='Fetching EPUB file...')
 
-            # Calculate frame dimensions based on new margins
-            frame_width = page_width - inner_margin - outer_margin
-            frame_height = page_height - (2 * top_bottom_margin)
+            # Fetch EPUB, streamed straight to disk, unless it was uploaded
+            with timer.stage('download') as stage:
+                epub_path = uploaded_file(upload_dir, 'epub_file')
+                if epub_path is None:
+                    epub_path = download(epub_url, os.path.join(temp_dir, "book.epub"), timeout=60)
+                self.check_cancelled(conversion_id)
 
-            page_drawer = PageDrawer(
-                cover_path=cover_path or '', title_bg_path=title_bg_path or '',
-                blurred_cover_path=blurred_cover_path or '',
-                full_page_image_path=full_page_image_path,
-                book_title=book_title, author_name=author_name,
-                inner_margin=inner_margin, outer_margin=outer_margin,
-                top_bottom_margin=top_bottom_margin
-            )
-            
-            # DEFINE FRAMES AND PAGE TEMPLATES FOR MIRRORED MARGINS
-            odd_frame = Frame(inner_margin, top_bottom_margin, frame_width, frame_height, id='odd_frame')
-            even_frame = Frame(outer_margin, top_bottom_margin, frame_width, frame_height, id='even_frame')
-
-            page_templates = [
-                PageTemplate(id='CoverPage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.cover_and_content_pages),
-                PageTemplate(id='TitlePage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.title_page_background),
-                PageTemplate(id='OddContentPage', frames=[odd_frame], onPage=page_drawer.cover_and_content_pages),
-                PageTemplate(id='EvenContentPage', frames=[even_frame], onPage=page_drawer.cover_and_content_pages),
-                PageTemplate(id='FinalPage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.final_page_background)
-            ]
-
-            if full_page_image_path:
-                page_templates.append(PageTemplate(id='FullImagePage', frames=[Frame(0, 0, letter[0], letter[1])], onPage=page_drawer.full_image_page_background))
-
-            doc.addPageTemplates(page_templates)
+                # Custom images are part of the result cache key, so fetch them first
+                if shared_images is not None:
+                    cover_path, title_bg_path, full_page_image_path = shared_images['image_paths']
+                    stage['bytes'] = os.path.getsize(epub_path)
+                else:
+                    cover_path, title_bg_path, full_page_image_path = self.fetch_images(params, temp_dir, upload_dir)
+                    stage['bytes'] = sum(os.path.getsize(path) for path in
+                                         (epub_path, cover_path, title_bg_path, full_page_image_path) if path)
+
+            with timer.stage('cache_lookup'):
+                epub_sha256 = file_sha256(epub_path)
+                cache_key = self.result_cache_key(epub_sha256, [cover_path, title_bg_path, full_page_image_path], **settings)
+            cached_pdf = self.complete_from_cache(conversion_id, cache_key, temp_dir, email_pending, timer.stages)
+            if cached_pdf:
+                clear_workspace(temp_dir, keep=[cached_pdf])
+                workspace_reaper.schedule(conversion_id, temp_dir)
+                metrics.record_conversion(timer, 'cache_hit')
+                return
 
-            conversion_status[conversion_id]['progress'] = 45
-            conversion_status[conversion_id]['message'] = 'Assembling document content...'
+            get_job_store().update(conversion_id, progress=15, message='Processing EPUB content...')
 
-            # Build story
-            story = self.build_story(doc, book_title, author_name, book_description, toc_items,
-                                     content_map, image_map, font_size, line_spacing, bool(full_page_image_path),
-                                     frame_width, frame_height)
+            # A quote or an earlier conversion, with any settings, may already have parsed this book
+            parsed = self.load_book(epub_path, epub_sha256, timer, temp_dir)
+            parsed_book = parsed['book']
+            book_title = parsed_book['book_title']
+            chapters = parsed_book['chapters']
 
-            conversion_status[conversion_id]['progress'] = 85
-            conversion_status[conversion_id]['message'] = 'Generating PDF...'
+            get_job_store().update(conversion_id, progress=25, message='Preparing images...')
+            self.check_cancelled(conversion_id)
 
-            # Generate PDF
-            doc.build(story)
+            if shared_images is not None:
+                blurred_cover_path = shared_images['blurred_cover_path']
+                page_image_paths = shared_images['page_image_paths']
+            else:
+                with timer.stage('backgrounds') as stage:
+                    blurred_cover_path, page_image_paths = self.page_images(
+                        [cover_path, title_bg_path, full_page_image_path], temp_dir)
+                    stage['bytes'] = sum(os.path.getsize(path) for path in [blurred_cover_path] + page_image_paths if path)
+
+            get_job_store().update(conversion_id, progress=35, message='Preparing chapter images...')
+            self.check_cancelled(conversion_id)
+
+            # Resample, recompress and dedupe the images the chapters actually use
+            frame_width = letter[0] - settings['inner_margin'] - settings['outer_margin']
+            frame_height = letter[1] - (2 * settings['top_bottom_margin'])
+            images = {}
+            if parsed['image_sources']:
+                with timer.stage('images') as stage:
+                    images = prepare_images(parsed['image_sources'], parsed['image_sources'], frame_width, frame_height,
+                                            os.path.join(temp_dir, 'images'))
+                    stage['bytes'] = sum(os.path.getsize(path) for path in {entry[0] for entry in images.values()})
+            del parsed
+
+            get_job_store().update(conversion_id, progress=45, message='Assembling and rendering PDF...')
+            self.check_cancelled(conversion_id)
 
-            conversion_status[conversion_id]['progress'] = 95
-            conversion_status[conversion_id]['message'] = 'Counting PDF pages...'
+            # Build PDF
+            safe_title = re.sub(r'[\\/*?:"<>|]', "", book_title)
+            pdf_filename = os.path.join(temp_dir, f"{safe_title}.pdf")
 
-            # Count PDF pages
-            page_count = self.count_pdf_pages(pdf_filename)
-            
-            # Calculate price: ((page number)*0.04)+22
-            price = (page_count * 0.04) + 22
-
-            # Cleanup temp files except the final PDF
-            files_to_clean = [epub_path, cover_path, title_bg_path, blurred_cover_path, full_page_image_path]
-            self.cleanup_temp_files(files_to_clean, temp_dir)
-
-            conversion_status[conversion_id] = {
-                'status': 'completed',
-                'progress': 100,
-                'message': f'PDF generation complete! ({page_count} pages, {price:.2f}rmb)',
-                'pdf_path': pdf_filename,
-                'book_title': book_title,
-                'page_count': page_count,
-                'price': price,
+            # The render stage is CPU-bound, so it runs in the render process pool
+            story_bytes, page_bytes = render_memory(chapters, images)
+            low_memory = flag(params.get('low_memory')) or story_bytes + page_bytes > JOB_MEMORY_BUDGET_BYTES
+            if low_memory:
+                logging.info(f"Conversion {conversion_id} renders in low-memory mode "
+                             f"(estimated {(story_bytes + page_bytes) // 1024 ** 2} MB)")
+            render_params = dict(
+                pdf_filename=pdf_filename, cover_path=page_image_paths[0], title_bg_path=page_image_paths[1],
+                blurred_cover_path=blurred_cover_path, full_page_image_path=page_image_paths[2],
+                images=images, streaming=low_memory, **parsed_book, **settings
+            )
+            if progressive or segmented or low_memory:
+                # Segments only render in parallel when there is a pool to spread them over, and
+                # in low-memory mode one at a time, each small enough to stay within the budget
+                render_stats = self.render_segments(conversion_id, render_params,
+                                                    self.render_progress_reporter(conversion_id),
+                                                    progressive=progressive,
+                                                    parallel=segmented and not low_memory and RENDER_PROCESSES > 1,
+                                                    group_count=(-(-4 * page_bytes // JOB_MEMORY_BUDGET_BYTES)
+                                                                 if low_memory else None))
+            else:
+                render_stats = run_render(render_pdf, render_params,
+                                          on_progress=self.render_progress_reporter(conversion_id))
+            for name, record in render_stats['stages'].items():
+                timer.add(name, record)
+            self.check_cancelled(conversion_id)
+
+            # Page count comes from the build itself; no need to re-read the PDF
+            page_count = render_stats['page_count']
+            page_stats = render_stats['template_pages']
+
+            with timer.stage('store') as stage:
+                pdf_sha256 = file_sha256(pdf_filename)
+                result_cache.put(cache_key, pdf_filename, {'book_title': book_title, 'page_count': page_count,
+                                                           'page_stats': page_stats, 'pdf_sha256': pdf_sha256})
+                # Lets a quote with the same settings skip the layout pass
+                layout_key = self.layout_cache_key(epub_sha256, bool(full_page_image_path), **settings)
+                self.store_layout(layout_key, book_title, page_count, page_stats, temp_dir)
+
+                # Everything but the final PDF goes now
+                clear_workspace(temp_dir, keep=[pdf_filename])
+                stage['bytes'] = os.path.getsize(pdf_filename)
+
+            self.complete_conversion(conversion_id, pdf_filename, book_title, page_count, page_stats=page_stats,
+                                     email_pending=email_pending, stages=timer.stages, pdf_sha256=pdf_sha256)
+            workspace_reaper.schedule(conversion_id, temp_dir)
+            metrics.record_conversion(timer, 'completed')
+
+        except ConversionCancelled:
+            logging.info(f"Conversion {conversion_id} cancelled")
+            remove_workspace(temp_dir)
+            workspace_reaper.schedule(conversion_id)
+            get_job_store().set(conversion_id, {
+                'status': 'cancelled',
+                'progress': 0,
+                'message': 'Conversion cancelled',
+                'stages': timer.stages,
                 'created_at': datetime.now()
-            }
+            })
+            metrics.record_conversion(timer, 'cancelled')
 
         except Exception as e:
             logging.exception("Conversion error")
-            conversion_status[conversion_id] = {
+            remove_workspace(temp_dir)
+            workspace_reaper.schedule(conversion_id)
+            get_job_store().set(conversion_id, {
                 'status': 'error',
                 'progress': 0,
                 'message': f'An error occurred: {str(e)}',
+                'stages': timer.stages,
                 'created_at': datetime.now()
-            }
+            })
+            metrics.record_conversion(timer, 'error')
+
+    def convert_epub_to_pdf_and_email(self, conversion_id, params, recipient_email, upload_dir=None,
+                                      download_link=None):
+        """Convert EPUB to PDF and queue it for email delivery.
 
-    def convert_epub_to_pdf_and_email(self, conversion_id, params, recipient_email):
-        """Convert EPUB to PDF and send via email"""
+        The conversion slot is free again as soon as the PDF is rendered; the
+        email is sent by the mail queue. download_link, a signed /api/download
+        URL, is sent instead of a PDF too large to attach.
+        """
         try:
             # Validate email
             try:
                 validate_email(recipient_email)
             except EmailNotValidError:
-                conversion_status[conversion_id] = {
+                get_job_store().set(conversion_id, {
                     'status': 'error',
                     'progress': 0,
                     'message': 'Invalid email address provided',
                     'created_at': datetime.now()
-                }
+                })
+                discard_uploads(upload_dir)
+                workspace_reaper.schedule(conversion_id)
                 return
 
             # First do the regular conversion
-            self.convert_epub_to_pdf(conversion_id, params)
+            self.convert_epub_to_pdf(conversion_id, params, email_pending=True, upload_dir=upload_dir)
             
             # Check if conversion was successful
-            if conversion_status[conversion_id]['status'] == 'completed':
-                conversion_status[conversion_id]['progress'] = 95
-                conversion_status[conversion_id]['message'] = 'Sending PDF via email...'
-                
-                pdf_path = conversion_status[conversion_id]['pdf_path']
-                book_title = conversion_status[conversion_id]['book_title']
-                page_count = conversion_status[conversion_id]['page_count']
-                price = conversion_status[conversion_id].get('price', 0)
-                
-                # Get custom email body from params
-                custom_email_body = params.get('email_body', None)
-                
-                # Send email with custom body
-                if self.send_email_with_pdf(recipient_email, pdf_path, book_title, page_count, custom_email_body):
-                    conversion_status[conversion_id]['message'] = f'PDF sent successfully to {recipient_email}! ({page_count} pages, {price:.2f}rmb)'
-                    conversion_status[conversion_id]['progress'] = 100
-                    conversion_status[conversion_id]['email_sent'] = True
-                    conversion_status[conversion_id]['recipient_email'] = recipient_email
-                else:
-                    conversion_status[conversion_id]['status'] = 'error'
-                    conversion_status[conversion_id]['message'] = 'PDF generated but failed to send email'
-                    
+            status = get_job_store().get(conversion_id)
+            if status['status'] == 'completed':
+                get_job_store().update(conversion_id, progress=95, message='Sending PDF via email...')
+                self.queue_pdf_email(conversion_id, recipient_email, status, params.get('email_body', None),
+                                     download_link)
+
         except Exception as e:
             logging.exception("Email sending error")
-            conversion_status[conversion_id] = {
+            get_job_store().set(conversion_id, {
                 'status': 'error',
                 'progress': 0,
                 'message': f'An error occurred: {str(e)}',
                 'created_at': datetime.now()
-            }
+            })
+            workspace_reaper.schedule(conversion_id)
+
+    def convert_batch(self, batch_id, params, items, concurrency):
+        """Convert the books of a batch, up to `concurrency` at a time.
+
+        items are the batch record's {'conversion_id', 'epub_url'} entries.
+        The cover, title background and full-page image are fetched and
+        resized once into the batch's own directory and shared by every book.
+        Books beyond the first run in worker slots reserved from the
+        conversion queue, so a batch never pushes the number of conversions
+        past MAX_CONCURRENT_JOBS; with no slot free it converts one at a time.
+        """
+        store = get_job_store()
+        batch_dir = create_workspace()
+        progress_lock = threading.Lock()
+        reserved = 0
+        try:
+            if (store.get(batch_id) or {}).get('cancel_requested'):
+                raise ConversionCancelled(batch_id)
+            store.update(batch_id, status='processing', message='Preparing shared images...', workspace=batch_dir)
+            image_paths = self.fetch_images(params, batch_dir)
+            blurred_cover_path, page_image_paths = self.page_images(image_paths, batch_dir)
+            shared_images = {'image_paths': image_paths, 'blurred_cover_path': blurred_cover_path,
+                             'page_image_paths': page_image_paths}
+
+            def convert_item(item):
+                self.convert_epub_to_pdf(item['conversion_id'], dict(params, epub_url=item['epub_url']),
+                                         shared_images=shared_images)
+                with progress_lock:
+                    store.update(batch_id, **batch_progress(item_records(items)))
+
+            reserved = conversion_queue.reserve_workers(concurrency - 1)
+            store.update(batch_id, concurrency=reserved + 1)
+            with ThreadPoolExecutor(max_workers=reserved + 1, thread_name_prefix='batch-item') as pool:
+                list(pool.map(convert_item, items))
+
+            cancelled = (store.get(batch_id) or {}).get('cancel_requested')
+            store.update(batch_id, status='cancelled' if cancelled else 'completed',
+                         **batch_progress(item_records(items)))
+
+        except ConversionCancelled:
+            logging.info(f"Batch {batch_id} cancelled")
+            for item in items:
+                store.update(item['conversion_id'], status='cancelled', message='Conversion cancelled')
+            store.update(batch_id, status='cancelled', message='Batch cancelled')
+
+        except Exception as e:
+            logging.exception("Batch error")
+            for item, record in zip(items, item_records(items)):
+                if record is not None and not is_final_status(record):
+                    store.update(item['conversion_id'], status='error', message=f'An error occurred: {str(e)}')
+            store.update(batch_id, status='error', message=f'An error occurred: {str(e)}')
+
+        finally:
+            conversion_queue.release_workers(reserved)
+            remove_workspace(batch_dir)
+            # Books that never started are not scheduled by their own conversion
+            for item in items:
+                workspace_reaper.schedule(item['conversion_id'])
+            workspace_reaper.schedule(batch_id)
+
+def compile_source(source):
+    """Process-pool entry point: decompress one chapter's document and compile it to blocks"""
+    return compile_chapter(read_source(source))
+
+
+def render_pdf(render_params, progress=None):
+    """Render stage entry point; module-level so the render process pool can pickle it"""
+    return EpubToPdfConverter().build_pdf(progress=progress, **render_params)
+
+
+def measure_layout(layout_params):
+    """Layout-only counterpart of render_pdf: paginates the story without drawing images or writing a file"""
+    return EpubToPdfConverter().build_pdf(
+        pdf_filename=os.devnull, cover_path=None, title_bg_path=None, blurred_cover_path=None,
+        full_page_image_path=None, layout_only=True, **layout_params)
+
+
+def warm_up():
+    """Register the font, build the default styles and render a one-page book.
+
+    The render pulls in the parts of ReportLab that are only imported or
+    initialised on first use, so the first real conversion does not pay for
+    them. Runs in the gunicorn master after preloading, where forked workers
+    inherit the result, and in every render process as it starts.
+    """
+    converter = EpubToPdfConverter()
+    settings = converter.layout_settings({})
+    converter.build_pdf(
+        pdf_filename=os.devnull, cover_path=None, title_bg_path=None, blurred_cover_path=None,
+        full_page_image_path=None, book_title='Warm-up', author_name='', book_description='',
+        chapters=[('Warm-up', compile_chapter('<p>Warm-up. Разогрев.</p>'))], images={}, **settings)
+
+
+# Render processes are spawned, not forked, so they warm up on their own
+set_render_initializer(warm_up)
+
+
+def enqueue_conversion(conversion_id, target, *args, upload_dir=None, **fields):
+    """Record a queued job, with any extra record fields, and hand it to the conversion queue.
+
+    Returns the queue position, or raises QueueFullError when the queue is at capacity.
+    """
+    get_job_store().set(conversion_id, {
+        'status': 'queued',
+        'progress': 0,
+        'message': 'Waiting in queue...',
+        'upload_dir': upload_dir,
+        'created_at': datetime.now(),
+        **fields
+    })
+    try:
+        return conversion_queue.submit(conversion_id, target, *args)
+    except QueueFullError:
+        get_job_store().delete(conversion_id)
+        discard_uploads(upload_dir)
+        raise
+
+
+def conversion_request():
+    """Parameters of a convert request and the directory its uploaded files were staged in.
+
+    Accepts a JSON body, or a multipart form whose fields are the same
+    parameters and whose file parts are named as in UPLOAD_FIELDS.
+    """
+    if request.mimetype == 'multipart/form-data':
+        return request.form.to_dict(), stage_uploads(request.files)
+    return request.get_json(), None
+
+
+def has_epub_input(data, upload_dir):
+    return data is not None and bool(data.get('epub_url') or uploaded_file(upload_dir, 'epub_file'))
+
+
+def queue_full_response(error, message='Conversion queue is full, please try again later'):
+    response = jsonify({
+        'error': message,
+        'queue_length': error.queue_length
+    })
+    response.headers['Retry-After'] = '30'
+    return response, 503
+
+
+def upload_too_large_response():
+    return jsonify({'error': f'Upload exceeds the {current_app.config["MAX_CONTENT_LENGTH"]} byte limit'}), 413
+
+
+def download_signer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='pdf-download')
+
+
+def signed_download_link(conversion_id):
+    """Absolute /api/download URL of a job, with a token that expires after EMAIL_LINK_MAX_AGE"""
+    token = download_signer().dumps(conversion_id)
+    if PUBLIC_URL:
+        return PUBLIC_URL.rstrip('/') + url_for('converter.download_pdf', conversion_id=conversion_id, token=token)
+    return url_for('converter.download_pdf', conversion_id=conversion_id, token=token, _external=True)
+
 
 @converter_bp.route('/convert-and-email', methods=['POST'])
 def start_conversion_and_email():
     """Start EPUB to PDF conversion and send via email"""
+    upload_dir = None
     try:
-        data = request.get_json()
+        data, upload_dir = conversion_request()
 
         # Validate required fields
-        if not data or not data.get('epub_url'):
-            return jsonify({'error': 'EPUB URL is required'}), 400
+        if not has_epub_input(data, upload_dir):
+            discard_uploads(upload_dir)
+            return jsonify({'error': 'EPUB URL or file is required'}), 400
             
         if not data.get('email'):
+            discard_uploads(upload_dir)
             return jsonify({'error': 'Email address is required'}), 400
 
+        if not mail_queue.enabled:
+            discard_uploads(upload_dir)
+            return jsonify({'error': 'Email delivery is not configured on this server'}), 503
+
         # Generate unique conversion ID
         conversion_id = str(uuid.uuid4())
         recipient_email = data.get('email')
 
-        # Start conversion and email in background thread
+        # Queue conversion and email for a worker slot
         converter = EpubToPdfConverter()
-        thread = threading.Thread(
-            target=converter.convert_epub_to_pdf_and_email,
-            args=(conversion_id, data, recipient_email)
-        )
-        thread.daemon = True
-        thread.start()
+        try:
+            # Signed now, while the request tells which host the link should point at
+            queue_position = enqueue_conversion(
+                conversion_id, partial(converter.convert_epub_to_pdf_and_email, upload_dir=upload_dir,
+                                       download_link=signed_download_link(conversion_id)),
+                conversion_id, data, recipient_email, upload_dir=upload_dir, progressive=flag(data.get('progressive')))
+        except QueueFullError as e:
+            return queue_full_response(e)
 
         return jsonify({
             'conversion_id': conversion_id,
+            'queue_position': queue_position,
             'message': f'Conversion started, PDF will be sent to {recipient_email}'
         }), 202
 
+    except RequestEntityTooLarge:
+        return upload_too_large_response()
     except Exception as e:
+        discard_uploads(upload_dir)
         return jsonify({'error': str(e)}), 500
 
 
 @converter_bp.route('/convert', methods=['POST'])
 def start_conversion():
-    """Start EPUB to PDF conversion"""
+    """Start EPUB to PDF conversion from an EPUB URL or an uploaded file"""
+    upload_dir = None
     try:
-        data = request.get_json()
+        data, upload_dir = conversion_request()
 
         # Validate required fields
-        if not data or not data.get('epub_url'):
-            return jsonify({'error': 'EPUB URL is required'}), 400
+        if not has_epub_input(data, upload_dir):
+            discard_uploads(upload_dir)
+            return jsonify({'error': 'EPUB URL or file is required'}), 400
 
         # Generate unique conversion ID
         conversion_id = str(uuid.uuid4())
 
-        # Start conversion in background thread
+        # Queue conversion for a worker slot
         converter = EpubToPdfConverter()
-        thread = threading.Thread(
-            target=converter.convert_epub_to_pdf,
-            args=(conversion_id, data)
-        )
-        thread.daemon = True
-        thread.start()
+        try:
+            queue_position = enqueue_conversion(
+                conversion_id, partial(converter.convert_epub_to_pdf, upload_dir=upload_dir),
+                conversion_id, data, upload_dir=upload_dir, progressive=flag(data.get('progressive')))
+        except QueueFullError as e:
+            return queue_full_response(e)
 
         return jsonify({
             'conversion_id': conversion_id,
+            'queue_position': queue_position,
             'message': 'Conversion started successfully'
         }), 202
 
+    except RequestEntityTooLarge:
+        return upload_too_large_response()
+    except Exception as e:
+        discard_uploads(upload_dir)
+        return jsonify({'error': str(e)}), 500
+
+
+@converter_bp.route('/quote', methods=['POST'])
+def quote_conversion():
+    """Page count and price of a conversion, from a layout-only pass.
+
+    Quotes run one at a time per worker by default, behind a bounded queue.
+    """
+    upload_dir = None
+    try:
+        data, upload_dir = conversion_request()
+
+        if not has_epub_input(data, upload_dir):
+            discard_uploads(upload_dir)
+            return jsonify({'error': 'EPUB URL or file is required'}), 400
+
+        return jsonify(quote_queue.call(str(uuid.uuid4()), EpubToPdfConverter().quote_epub, data, upload_dir))
+
+    except QueueFullError as e:
+        discard_uploads(upload_dir)
+        return queue_full_response(e, 'Too many quotes are being prepared, please try again later')
+    except RequestEntityTooLarge:
+        return upload_too_large_response()
+    except Exception as e:
+        logging.exception("Quote error")
+        discard_uploads(upload_dir)
+        return jsonify({'error': str(e)}), 500
+
+
+@converter_bp.route('/batch', methods=['POST'])
+def start_batch():
+    """Convert a list of EPUB URLs that share one set of layout parameters and images.
+
+    The batch is a single queued job; its books are converted up to
+    "concurrency" at a time, as far as the queue has idle workers, and each
+    gets a conversion id of its own.
+    """
+    try:
+        data = request.get_json()
+        epub_urls = data.get('epub_urls') if data else None
+        if (not isinstance(epub_urls, list) or not epub_urls
+                or not all(isinstance(url, str) and url for url in epub_urls)):
+            return jsonify({'error': 'epub_urls must be a non-empty list of EPUB URLs'}), 400
+        if len(epub_urls) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'A batch may hold at most {BATCH_MAX_ITEMS} books'}), 400
+        try:
+            concurrency = min(max(1, int(data.get('concurrency', BATCH_CONCURRENCY))), BATCH_CONCURRENCY)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'concurrency must be a number'}), 400
+
+        # Everything but the book list is shared by every book
+        params = {key: value for key, value in data.items() if key not in ('epub_urls', 'epub_url', 'concurrency')}
+        batch_id = str(uuid.uuid4())
+        items = [{'conversion_id': str(uuid.uuid4()), 'epub_url': url} for url in epub_urls]
+        for item in items:
+            get_job_store().set(item['conversion_id'], {
+                'status': 'queued',
+                'progress': 0,
+                'message': 'Waiting for the batch to start...',
+                'progressive': flag(params.get('progressive')),
+                'created_at': datetime.now()
+            })
+
+        converter = EpubToPdfConverter()
+        try:
+            queue_position = enqueue_conversion(batch_id, converter.convert_batch, batch_id, params, items,
+                                                concurrency, kind='batch', items=items, concurrency=concurrency)
+        except QueueFullError as e:
+            for item in items:
+                get_job_store().delete(item['conversion_id'])
+            return queue_full_response(e)
+
+        return jsonify({
+            'batch_id': batch_id,
+            'queue_position': queue_position,
+            'items': items,
+            'message': f'Batch of {len(items)} books started'
+        }), 202
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def public_status(conversion_id, status):
+    """Status record as clients see it: no file paths, live queue position"""
+    # Remove file paths from response for security
+    status.pop('pdf_path', None)
+    status.pop('partial_pdf', None)
+    status.pop('upload_dir', None)
+    status.pop('workspace', None)
+    status.pop('expires_at', None)
+
+    if status['status'] == 'queued':
+        queue_position = conversion_queue.position(conversion_id)
+        if queue_position:
+            status['queue_position'] = queue_position
+            status['message'] = f'Waiting in queue (position {queue_position})...'
+    return status
+
+
+def is_final_status(status):
+    """True once a job's record will not change any more, short of its PDF being evicted"""
+    if status['status'] == 'completed':
+        return not status.get('email_pending')
+    return status['status'] in ('error', 'cancelled', 'expired')
+
+
+def item_records(items):
+    """Current records of a batch's items; None for any that has been removed"""
+    store = get_job_store()
+    return [store.get(item['conversion_id']) for item in items]
+
+
+def batch_progress(records):
+    """Aggregate progress, per-status counts and summary message of a batch's item records"""
+    counts = {}
+    progress = 0
+    for record in records:
+        status = record['status'] if record else 'error'
+        counts[status] = counts.get(status, 0) + 1
+        progress += 100 if record is None or is_final_status(record) else record.get('progress', 0)
+    return {
+        'progress': progress // max(1, len(records)),
+        'counts': counts,
+        'message': f"{counts.get('completed', 0)} of {len(records)} books converted"
+    }
+
+
+def next_status(conversion_id, since, timeout):
+    """Wait up to timeout seconds for a record newer than version `since`.
+
+    Queued jobs return within QUEUE_POSITION_INTERVAL so their queue position,
+    which is not part of the record, stays current.
+    """
+    store = get_job_store()
+    status = store.get(conversion_id)
+    if status is None or status['version'] > since or is_final_status(status):
+        return status
+    if status['status'] == 'queued':
+        timeout = min(timeout, QUEUE_POSITION_INTERVAL)
+    return store.wait(conversion_id, since, timeout)
+
+
 @converter_bp.route('/status/<conversion_id>', methods=['GET'])
 def get_conversion_status(conversion_id):
-    """Get conversion status"""
-    if conversion_id not in conversion_status:
+    """Get conversion status.
+
+    With ?since=<version> the request long-polls: it returns as soon as the
+    record is newer than that version, or with the unchanged record after
+    ?timeout= seconds (capped at STATUS_LONG_POLL_TIMEOUT).
+    """
+    since = request.args.get('since', type=int)
+    if since is None:
+        status = get_job_store().get(conversion_id)
+    else:
+        timeout = min(request.args.get('timeout', STATUS_LONG_POLL_TIMEOUT, type=float), STATUS_LONG_POLL_TIMEOUT)
+        status = next_status(conversion_id, since, max(0, timeout))
+    if status is None:
         return jsonify({'error': 'Conversion not found'}), 404
 
-    status = conversion_status[conversion_id].copy()
-    # Remove file path from response for security
-    if 'pdf_path' in status:
-        del status['pdf_path']
+    return jsonify(public_status(conversion_id, status))
 
-    return jsonify(status)
+
+@converter_bp.route('/status/<conversion_id>/stream', methods=['GET'])
+def stream_conversion_status(conversion_id):
+    """Server-Sent Events stream of status changes.
+
+    Each event carries the whole public record with its version as the event
+    id, so a reconnecting EventSource resumes from Last-Event-ID. Updates that
+    land between two reads are coalesced into the latest record. The stream
+    ends once the job is final, or after STATUS_STREAM_MAX_SECONDS.
+    """
+    if get_job_store().get(conversion_id) is None:
+        return jsonify({'error': 'Conversion not found'}), 404
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+
+    def events():
+        version = since
+        last_sent = None
+        deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            status = next_status(conversion_id, version, min(STATUS_STREAM_HEARTBEAT, remaining))
+            if status is None:
+                yield 'event: gone\ndata: {}\n\n'
+                return
+            status = public_status(conversion_id, status)
+            if status['version'] > version or status != last_sent:
+                version = status['version']
+                last_sent = status
+                yield f'id: {version}\nevent: status\ndata: {current_app.json.dumps(status)}\n\n'
+                if is_final_status(status):
+                    return
+            else:
+                yield ': keep-alive\n\n'
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@converter_bp.route('/cancel/<conversion_id>', methods=['POST'])
+def cancel_conversion(conversion_id):
+    """Cancel a queued or running conversion"""
+    status = get_job_store().get(conversion_id)
+    if status is None:
+        return jsonify({'error': 'Conversion not found'}), 404
+
+    if status.get('kind') == 'batch':
+        return cancel_batch(conversion_id, status)
+
+    cancelled = conversion_queue.cancel(conversion_id)
+    if cancelled == 'queued':
+        discard_uploads(status.get('upload_dir'))
+        get_job_store().update(conversion_id, status='cancelled', message='Conversion cancelled')
+        workspace_reaper.schedule(conversion_id)
+        return jsonify({'message': 'Conversion cancelled'})
+
+    if cancelled is None:
+        if status['status'] not in ('queued', 'processing'):
+            return jsonify({'error': 'Conversion is not queued or running'}), 409
+        # The job belongs to another worker process; it picks the flag up at its next check
+        get_job_store().update(conversion_id, cancel_requested=True)
+
+    return jsonify({'message': 'Cancellation requested'}), 202
+
+
+def cancel_batch(batch_id, status):
+    """Cancel every book of a batch that has not finished yet"""
+    if is_final_status(status):
+        return jsonify({'error': 'Batch is not queued or running'}), 409
+    store = get_job_store()
+    for item, record in zip(status['items'], item_records(status['items'])):
+        if record is not None and not is_final_status(record):
+            store.update(item['conversion_id'], cancel_requested=True)
+
+    if conversion_queue.cancel(batch_id) == 'queued':
+        for item in status['items']:
+            store.update(item['conversion_id'], status='cancelled', message='Conversion cancelled')
+            workspace_reaper.schedule(item['conversion_id'])
+        store.update(batch_id, status='cancelled', message='Batch cancelled')
+        workspace_reaper.schedule(batch_id)
+        return jsonify({'message': 'Batch cancelled'})
+
+    # Running books stop at their next check, the others as soon as they start
+    store.update(batch_id, cancel_requested=True)
+    return jsonify({'message': 'Cancellation requested'}), 202
+
+
+def progressive_pdf(conversion_id, status):
+    """Yield a progressive job's PDF as its segments are appended, until the job completes.
+
+    The partial file is renamed when the job completes; an open handle keeps
+    reading the same file, so no bytes are lost or repeated.
+    """
+    store = get_job_store()
+    deadline = time.monotonic() + STREAMING_DOWNLOAD_TIMEOUT
+    pdf_file = None
+    try:
+        while True:
+            if pdf_file is None:
+                path = status.get('pdf_path') if status['status'] == 'completed' else status.get('partial_pdf')
+                if path:
+                    try:
+                        pdf_file = open(path, 'rb')
+                    except OSError:
+                        # Renamed or removed since the record was read
+                        pass
+            if pdf_file is not None:
+                yield from iter(partial(pdf_file.read, DOWNLOAD_CHUNK_BYTES), b'')
+                if status['status'] == 'completed':
+                    return
+            remaining = deadline - time.monotonic()
+            if status['status'] not in ('queued', 'processing') or remaining <= 0:
+                # Dropping the connection before the last chunk tells the client the PDF is incomplete
+                raise IOError(f"Progressive download of {conversion_id} aborted: conversion is {status['status']}")
+            status = store.wait(conversion_id, status['version'], min(remaining, STATUS_STREAM_HEARTBEAT))
+            if status is None:
+                raise IOError(f"Progressive download of {conversion_id} aborted: conversion was removed")
+    finally:
+        if pdf_file is not None:
+            pdf_file.close()
 
 
 @converter_bp.route('/download/<conversion_id>', methods=['GET'])
 def download_pdf(conversion_id):
-    """Download generated PDF"""
-    if conversion_id not in conversion_status:
+    """Download generated PDF.
+
+    The PDF's content hash is its ETag, and Range, If-Range and If-None-Match
+    are honoured, so resumed and repeated downloads only send what is missing.
+    A progressive job can be downloaded before it completes: the response
+    streams the PDF as its segments are rendered, without a Content-Length.
+    Jobs whose PDF was sent as a link by email are only served with the
+    link's signed token, which is refused once expired.
+    """
+    status = get_job_store().get(conversion_id)
+    if status is None:
         return jsonify({'error': 'Conversion not found'}), 404
 
-    status = conversion_status[conversion_id]
+    token = request.args.get('token')
+    if token is not None or status.get('email_link'):
+        try:
+            if download_signer().loads(token or '', max_age=EMAIL_LINK_MAX_AGE) != conversion_id:
+                raise BadSignature('token is for another conversion')
+        except BadSignature:
+            return jsonify({'error': 'Download link is invalid or has expired'}), 403
+
     if status['status'] != 'completed':
+        if status.get('progressive') and status['status'] in ('queued', 'processing'):
+            # Named after the job: the title is not known until the book has been parsed
+            return Response(stream_with_context(progressive_pdf(conversion_id, status)),
+                            mimetype='application/pdf',
+                            headers={'Content-Disposition': f'attachment; filename="{conversion_id}.pdf"',
+                                     'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
         return jsonify({'error': 'Conversion not completed'}), 400
 
     pdf_path = status.get('pdf_path')
@@ -751,36 +1917,138 @@ def download_pdf(conversion_id):
         pdf_path,
         as_attachment=True,
         download_name=f"{safe_title}.pdf",
-        mimetype='application/pdf'
+        mimetype='application/pdf',
+        etag=status.get('pdf_sha256', True),
+        conditional=True
     )
 
 
-# Cleanup old conversions periodically (simple implementation)
-def cleanup_old_conversions():
-    """Remove conversion records older than 1 hour"""
-    cutoff_time = datetime.now() - timedelta(hours=1)
-    to_remove = []
+@converter_bp.route('/batch/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """Aggregate progress of a batch, with the status and download link of each book"""
+    batch = get_job_store().get(batch_id)
+    if batch is None or batch.get('kind') != 'batch':
+        return jsonify({'error': 'Batch not found'}), 404
+
+    records = item_records(batch['items'])
+    items = []
+    for item, record in zip(batch['items'], records):
+        if record is None:
+            items.append(dict(item, status='error', progress=0, message='Conversion not found'))
+            continue
+        entry = dict(item, **public_status(item['conversion_id'], record))
+        entry.pop('stages', None)
+        entry.pop('page_stats', None)
+        if record['status'] == 'completed':
+            entry['download_url'] = url_for('converter.download_pdf', conversion_id=item['conversion_id'])
+        items.append(entry)
+
+    # Item progress is finer-grained than the batch record, which changes as books finish
+    progress = batch_progress(records)
+    status = public_status(batch_id, batch)
+    status.update(progress=progress['progress'], counts=progress['counts'], items=items,
+                  zip_url=url_for('converter.download_batch_zip', batch_id=batch_id))
+    return jsonify(status)
 
-    for conv_id, status in conversion_status.items():
-        if status.get('created_at', datetime.now()) < cutoff_time:
-            # Also cleanup the PDF file if it exists
-            if 'pdf_path' in status and os.path.exists(status['pdf_path']):
-                try:
-                    os.remove(status['pdf_path'])
-                    # Try to remove the temp directory if empty
-                    temp_dir = os.path.dirname(status['pdf_path'])
-                    if os.path.exists(temp_dir):
-                        os.rmdir(temp_dir)
-                except OSError:
-                    pass
-            to_remove.append(conv_id)
 
-    for conv_id in to_remove:
-        del conversion_status[conv_id]
+class ZipChunks:
+    """Write-only file object that holds what zipfile writes until it is drained.
+
+    It cannot seek, so zipfile writes each entry's sizes after its data.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """The bytes written since the last drain, as a list of at most one chunk"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return [data] if data else []
+
+
+def batch_zip(batch_id, batch):
+    """Yield a ZIP of a batch's PDFs, adding each one as soon as its book is done.
+
+    Books that failed are listed in errors.txt at the end of the archive.
+    """
+    store = get_job_store()
+    deadline = time.monotonic() + STREAMING_DOWNLOAD_TIMEOUT
+    pending = dict(enumerate(batch['items']))
+    failures = []
+    buffer = ZipChunks()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        while pending:
+            for index, item in list(pending.items()):
+                record = store.get(item['conversion_id'])
+                if record is not None and not is_final_status(record):
+                    continue
+                del pending[index]
+                pdf_path = record.get('pdf_path') if record and record['status'] == 'completed' else None
+                if not pdf_path or not os.path.exists(pdf_path):
+                    failures.append(f"{item['epub_url']}: {record['message'] if record else 'conversion not found'}")
+                    continue
+                # Numbered so that books with the same title do not collide
+                entry = zipfile.ZipInfo(f'{index + 1:03d} {os.path.basename(pdf_path)}', time.localtime()[:6])
+                entry.file_size = os.path.getsize(pdf_path)
+                with open(pdf_path, 'rb') as pdf_file, archive.open(entry, 'w') as entry_file:
+                    for chunk in iter(partial(pdf_file.read, DOWNLOAD_CHUNK_BYTES), b''):
+                        entry_file.write(chunk)
+                        yield from buffer.drain()
+                yield from buffer.drain()
+            if not pending:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise IOError(f"ZIP download of batch {batch_id} aborted: timed out waiting for its books")
+            # The batch record changes whenever one of its books finishes
+            batch = store.wait(batch_id, batch['version'], min(remaining, STATUS_STREAM_HEARTBEAT))
+            if batch is None:
+                raise IOError(f"ZIP download of batch {batch_id} aborted: batch was removed")
+        if failures:
+            archive.writestr('errors.txt', '\n'.join(failures) + '\n')
+    yield from buffer.drain()
+
+
+@converter_bp.route('/batch/<batch_id>/zip', methods=['GET'])
+def download_batch_zip(batch_id):
+    """Download a batch's PDFs as one ZIP, streamed while the batch is still converting"""
+    batch = get_job_store().get(batch_id)
+    if batch is None or batch.get('kind') != 'batch':
+        return jsonify({'error': 'Batch not found'}), 404
+    return Response(stream_with_context(batch_zip(batch_id, batch)), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="batch-{batch_id}.zip"',
+                             'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@converter_bp.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Cache hit/miss counters (per worker) and disk usage"""
+    return jsonify({
+        'results': result_cache.stats(),
+        'downloads': download_cache.stats(),
+        'assets': asset_cache.stats(),
+        'layouts': layout_cache.stats(),
+        'books': book_cache.stats(),
+        'workspaces': workspace_reaper.stats()
+    })
+
+
+@converter_bp.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage timing histograms of every worker, in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @converter_bp.route('/cleanup', methods=['POST'])
 def manual_cleanup():
-    """Manual cleanup endpoint for old conversions"""
-    cleanup_old_conversions()
-    return jsonify({'message': 'Cleanup completed'})
+    """Sweep expired jobs and orphaned workspaces now, then enforce the workspace quota"""
+    removed = workspace_reaper.sweep()
+    freed = workspace_reaper.enforce_quota()
+    return jsonify({'message': 'Cleanup completed', 'evicted_bytes': freed, **removed})
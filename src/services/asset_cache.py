@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+from PIL import Image, ImageFilter
+from reportlab.lib.pagesizes import letter
+from src.services.disk_cache import DiskCache, file_sha256, link_or_copy
+from src.services.image_pipeline import TARGET_DPI, JPEG_QUALITY
+
+# Bump when a transform's output changes so stale assets are not reused
+ASSET_VERSION = 1
+
+# Cover-derived images (page backgrounds, blurred covers) shared across jobs
+asset_cache = DiskCache(
+    'assets', suffix='.jpg',
+    max_bytes=int(os.environ.get('CONVERTER_ASSET_CACHE_BYTES', 512 * 1024 ** 2)),
+    max_age=int(os.environ.get('CONVERTER_ASSET_CACHE_MAX_AGE', 30 * 24 * 3600))
+)
+
+
+def render_page_background(source_path, dest_path, page_size, dpi):
+    """Resize full-page artwork to the page at the target resolution"""
+    with Image.open(source_path) as img:
+        target = (round(page_size[0] / 72 * dpi), round(page_size[1] / 72 * dpi))
+        if img.format == 'JPEG':
+            img.draft('RGB', target)
+        img = img.convert('RGB')
+        if img.width > target[0] or img.height > target[1]:
+            img = img.resize(target, Image.LANCZOS)
+        img.save(dest_path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+
+
+def render_blurred_background(source_path, dest_path, page_size, radius, reduction):
+    """Blur artwork for a page background.
+
+    The blur runs on a copy reduced by `reduction` with a proportionally
+    smaller radius and is then scaled back up; at radius 25 the result is
+    indistinguishable from a full-size blur at a fraction of the cost.
+    """
+    page_pixels = (int(page_size[0]), int(page_size[1]))
+    small = (max(1, page_pixels[0] // reduction), max(1, page_pixels[1] // reduction))
+    with Image.open(source_path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', small)
+        img = img.convert('RGB').resize(small, Image.BILINEAR)
+        img = img.filter(ImageFilter.GaussianBlur(radius / reduction))
+        img.resize(page_pixels, Image.BICUBIC).save(dest_path, 'JPEG', quality=JPEG_QUALITY)
+
+
+def derived_asset(source_path, dest_path, transform, render, **params):
+    """Place the transformed source at dest_path, reusing a cached result when one exists.
+
+    Assets are keyed on the source bytes, the transform name and its parameters.
+    """
+    key_parts = {'version': ASSET_VERSION, 'source': file_sha256(source_path), 'transform': transform, 'params': params}
+    key = hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode('utf-8')).hexdigest()
+    cached = asset_cache.get(key)
+    if cached is not None:
+        try:
+            link_or_copy(cached[0], dest_path)
+            return dest_path
+        except OSError:
+            pass
+    render(source_path, dest_path, **params)
+    asset_cache.put(key, dest_path, {'transform': transform})
+    return dest_path
+
+
+def page_background(source_path, dest_path, page_size=letter, dpi=TARGET_DPI):
+    return derived_asset(source_path, dest_path, 'page_background', render_page_background,
+                         page_size=list(page_size), dpi=dpi)
+
+
+def blurred_background(source_path, dest_path, page_size=letter, radius=25, reduction=4):
+    return derived_asset(source_path, dest_path, 'blurred_background', render_blurred_background,
+                         page_size=list(page_size), radius=radius, reduction=reduction)
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+# Root directory shared by every on-disk cache of the converter
+CACHE_ROOT = os.environ.get('CONVERTER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'epub-converter-cache'))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hex SHA-256 of a file's contents, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dest):
+    """Hard-link src to dest when both live on one filesystem, copy otherwise"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class DiskCache:
+    """Content-addressed file cache with age- and size-based LRU eviction.
+
+    Each entry is a data file '<key><suffix>' plus a '<key>.json' metadata
+    sidecar. Reads refresh the entry's mtime, which is the LRU clock, so
+    several worker processes can share one directory without coordination.
+    """
+    def __init__(self, name, suffix='', max_bytes=1024 ** 3, max_age=7 * 24 * 3600):
+        self.root = os.path.join(CACHE_ROOT, name)
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _data_path(self, key):
+        return os.path.join(self.root, key + self.suffix)
+
+    def _meta_path(self, key):
+        return os.path.join(self.root, key + '.json')
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Return (data_path, metadata) for a cached entry, or None"""
+        data_path = self._data_path(key)
+        try:
+            with open(self._meta_path(key), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(data_path)
+        except (OSError, ValueError):
+            self._count(False)
+            return None
+        self._count(True)
+        return data_path, meta
+
+    def put(self, key, src_path, meta=None):
+        """Store a copy of src_path under key, then enforce the cache limits"""
+        tmp_path = os.path.join(self.root, f'.{key}.{uuid.uuid4().hex}.tmp')
+        try:
+            link_or_copy(src_path, tmp_path)
+            os.replace(tmp_path, self._data_path(key))
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta or {}, f)
+            os.replace(tmp_path, self._meta_path(key))
+        except OSError as e:
+            logging.warning(f"Could not store cache entry {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.startswith('.') or name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            key = name[:-len(self.suffix)] if self.suffix else name
+            entries.append((stat.st_mtime, stat.st_size, key))
+        return entries
+
+    def remove(self, key):
+        for path in (self._meta_path(key), self._data_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """Drop entries past max_age, then least recently used ones until under max_bytes"""
+        entries = sorted(self._entries())
+        cutoff = time.time() - self.max_age
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, key in entries:
+            if mtime >= cutoff and total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes
+            }
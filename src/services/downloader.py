@@ -0,0 +1,82 @@
+import os
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from src.services.disk_cache import DiskCache, link_or_copy
+
+# Largest file we will fetch; src/main.py uses the same value for MAX_CONTENT_LENGTH
+MAX_DOWNLOAD_BYTES = int(os.environ.get('CONVERTER_MAX_DOWNLOAD_BYTES', 100 * 1024 * 1024))
+CHUNK_SIZE = 256 * 1024
+
+# Bodies of responses that carried an ETag or Last-Modified, kept for revalidation
+download_cache = DiskCache(
+    'downloads',
+    max_bytes=int(os.environ.get('CONVERTER_DOWNLOAD_CACHE_BYTES', 1024 ** 3)),
+    max_age=int(os.environ.get('CONVERTER_DOWNLOAD_CACHE_MAX_AGE', 7 * 24 * 3600))
+)
+
+_local = threading.local()
+
+
+class DownloadTooLargeError(requests.RequestException):
+    """Raised when a response exceeds MAX_DOWNLOAD_BYTES"""
+
+
+def get_session():
+    """Pooled session for the calling worker thread (Session is not thread-safe)"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8,
+                              max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504)))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+def download(url, dest_path, timeout=60, max_bytes=MAX_DOWNLOAD_BYTES):
+    """Stream url to dest_path in chunks, revalidating a cached copy when possible"""
+    cache_key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    cached = download_cache.get(cache_key)
+    headers = {}
+    if cached:
+        if cached[1].get('etag'):
+            headers['If-None-Match'] = cached[1]['etag']
+        if cached[1].get('last_modified'):
+            headers['If-Modified-Since'] = cached[1]['last_modified']
+
+    with get_session().get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304 and cached:
+            if os.path.getsize(cached[0]) > max_bytes:
+                raise DownloadTooLargeError(f"{url} exceeds the {max_bytes} byte limit")
+            link_or_copy(cached[0], dest_path)
+            return dest_path
+        response.raise_for_status()
+
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise DownloadTooLargeError(f"{url} is {content_length} bytes, the limit is {max_bytes}")
+
+        part_path = dest_path + '.part'
+        received = 0
+        try:
+            with open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    received += len(chunk)
+                    if received > max_bytes:
+                        raise DownloadTooLargeError(f"{url} exceeds the {max_bytes} byte limit")
+                    f.write(chunk)
+            os.replace(part_path, dest_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    if etag or last_modified:
+        download_cache.put(cache_key, dest_path, {'url': url, 'etag': etag, 'last_modified': last_modified})
+    return dest_path
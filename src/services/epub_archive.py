@@ -0,0 +1,154 @@
+import io
+import mmap
+import zipfile
+import posixpath
+from collections import namedtuple
+from contextlib import contextmanager
+from ebooklib import epub
+
+
+class _MappedFile(mmap.mmap):
+    """Read-only memory map that zipfile accepts as a file (mmap has no seekable() before Python 3.13)"""
+    def seekable(self):
+        return True
+
+
+class EpubArchive:
+    """Read-only view of an EPUB's zip members, each decompressed only when it is read.
+
+    The file is memory-mapped where possible, so compressed bytes are served
+    from the page cache instead of being copied into the process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = _MappedFile(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and special files cannot be mapped
+            self._map = None
+        try:
+            self.zip = zipfile.ZipFile(self._map if self._map is not None else self._file)
+        except Exception:
+            self.close()
+            raise
+
+    def read(self, name):
+        return self.zip.read(posixpath.normpath(name))
+
+    def open(self, name):
+        """Stream a member without decompressing all of it"""
+        return self.zip.open(posixpath.normpath(name))
+
+    def member(self, name):
+        """ArchiveMember for the zip member name"""
+        info = self.zip.getinfo(posixpath.normpath(name))
+        return ArchiveMember(self.path, info.filename, f'{info.CRC:08x}{info.file_size:024x}')
+
+    def close(self):
+        if getattr(self, 'zip', None) is not None:
+            self.zip.close()
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArchiveMember(namedtuple('ArchiveMember', 'path name key')):
+    """Picklable reference to one member of an EPUB on disk.
+
+    key identifies the member's contents (CRC-32 and size from the zip
+    directory) without decompressing it.
+    """
+    def read(self):
+        with EpubArchive(self.path) as archive:
+            return archive.read(self.name)
+
+    @contextmanager
+    def open(self):
+        with EpubArchive(self.path) as archive, archive.open(self.name) as f:
+            yield f
+
+
+def read_source(source):
+    """Bytes of a document or image: an ArchiveMember is decompressed now, bytes are returned as they are"""
+    return source.read() if isinstance(source, ArchiveMember) else source
+
+
+@contextmanager
+def open_source(source):
+    """File object over a document or image given as an ArchiveMember or bytes"""
+    if isinstance(source, ArchiveMember):
+        with source.open() as f:
+            yield f
+    else:
+        yield io.BytesIO(source)
+
+
+class _Deferred(namedtuple('_Deferred', 'name')):
+    """Stands in for a member's contents while ebooklib loads the manifest"""
+
+
+class LazyEpubReader(epub.EpubReader):
+    """ebooklib reader that leaves documents and images in the archive.
+
+    Metadata, manifest, spine, navigation document and NCX are loaded as
+    usual. Every other item gets empty content; its ArchiveMember is in the
+    book's lazy_members, keyed by item name.
+    """
+    # Items whose contents ebooklib itself needs, or which are small
+    EAGER_ITEMS = (epub.EpubNav, epub.EpubNcx, epub.EpubSMIL, epub.EpubCoverHtml)
+
+    def __init__(self, archive, options=None):
+        super().__init__(archive.path, options)
+        self.archive = archive
+        self._deferring = False
+
+    def _load(self):
+        self.zf = self.archive.zip
+        self._load_container()
+        self._load_opf_file()
+
+    def _load_manifest(self):
+        self._deferring = True
+        try:
+            super()._load_manifest()
+        finally:
+            self._deferring = False
+        self.book.lazy_members = {}
+        for item in self.book.items:
+            if not isinstance(item.content, _Deferred):
+                continue
+            name = item.content.name
+            if isinstance(item, self.EAGER_ITEMS):
+                item.content = self.archive.read(name)
+            else:
+                item.content = b''
+                self.book.lazy_members[item.get_name()] = self.archive.member(name)
+
+    def read_file(self, name):
+        if self._deferring:
+            # Raises KeyError for a missing member, as ebooklib expects
+            self.archive.zip.getinfo(posixpath.normpath(name))
+            return _Deferred(name)
+        return super().read_file(name)
+
+
+def read_epub(path):
+    """EpubBook of an EPUB without the contents of its documents and images.
+
+    Use item_source() to get at those; nothing stays open in the meantime.
+    """
+    with EpubArchive(path) as archive:
+        return LazyEpubReader(archive).load()
+
+
+def item_source(book, item):
+    """ArchiveMember of an item of a book from read_epub, or the content of an eagerly loaded one"""
+    member = getattr(book, 'lazy_members', {}).get(item.get_name())
+    return member if member is not None else item.get_content()
@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.fonts import addMapping
+
+# Directories searched for font files, in order; CONVERTER_FONT_DIR, when set, comes first
+FONT_DIRS = [path for path in (
+    os.environ.get('CONVERTER_FONT_DIR'),
+    '/usr/share/fonts/truetype/dejavu',
+    '/usr/share/fonts/dejavu',
+    '/System/Library/Fonts',
+    os.path.join(os.path.dirname(__file__), '..', 'static', 'fonts')
+) if path]
+
+# Font families by the name their regular face is registered under: the file of
+# each face. Faces whose file is not installed fall back to another face of the family
+FONT_FAMILIES = {
+    'DejaVu-Sans': {'normal': 'DejaVuSans.ttf', 'bold': 'DejaVuSans-Bold.ttf',
+                    'italic': 'DejaVuSans-Oblique.ttf', 'boldItalic': 'DejaVuSans-BoldOblique.ttf'},
+    'DejaVu-Serif': {'normal': 'DejaVuSerif.ttf', 'bold': 'DejaVuSerif-Bold.ttf',
+                     'italic': 'DejaVuSerif-Italic.ttf', 'boldItalic': 'DejaVuSerif-BoldItalic.ttf'}
+}
+# The family used when a request does not pick one, and for page headers
+BODY_FONT = 'DejaVu-Sans'
+# Request values of the "font_family" parameter
+FONT_FAMILY_ALIASES = {'sans': 'DejaVu-Sans', 'serif': 'DejaVu-Serif'}
+
+# Registered name of each face relative to the family name
+_FACE_SUFFIXES = {'normal': '', 'bold': '-Bold', 'italic': '-Italic', 'boldItalic': '-BoldItalic'}
+# Faces tried, in order, in place of a face that is not installed
+_FALLBACKS = {'bold': ('normal',), 'italic': ('normal',), 'boldItalic': ('bold', 'italic', 'normal')}
+
+_lock = threading.Lock()
+# family -> {face: registered font name}, for the families registered in this process
+_families = {}
+_all_registered = False
+
+
+def find_font_file(file_name):
+    """Path of file_name in the first of FONT_DIRS that has it, or None"""
+    for directory in FONT_DIRS:
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _register_family(family):
+    files = {face: find_font_file(file_name) for face, file_name in FONT_FAMILIES[family].items()}
+    if files['normal'] is None:
+        raise FileNotFoundError(f"Font {FONT_FAMILIES[family]['normal']} not found in {FONT_DIRS}")
+    faces = {}
+    for face in ('normal', 'bold', 'italic', 'boldItalic'):
+        if files[face] is not None:
+            faces[face] = family + _FACE_SUFFIXES[face]
+            if faces[face] not in pdfmetrics.getRegisteredFontNames():
+                # Glyphs are embedded as per-document subsets, never the whole file
+                pdfmetrics.registerFont(TTFont(faces[face], files[face]))
+        else:
+            faces[face] = next(faces[other] for other in _FALLBACKS[face] if files[other] is not None)
+            logging.info(f"Font {FONT_FAMILIES[family][face]} not found; {face} text uses {faces[face]}")
+    # Map <b>, <i> and both in paragraph markup to the family's faces
+    for (bold, italic), face in (((0, 0), 'normal'), ((1, 0), 'bold'), ((0, 1), 'italic'), ((1, 1), 'boldItalic')):
+        addMapping(family, bold, italic, faces[face])
+    return faces
+
+
+def register_family(family):
+    """Parse and register every installed face of a family once per process.
+
+    ReportLab's font registry is process-wide, so the parsed TTFs and their
+    glyph metrics are shared by every conversion in the process, and by the
+    workers gunicorn forks after preloading. Returns {face: font name}.
+    """
+    with _lock:
+        if family not in _families:
+            _families[family] = _register_family(family)
+        return _families[family]
+
+
+def register_fonts():
+    """Register the body font family, which must be installed, and every other installed family"""
+    global _all_registered
+    if _all_registered:
+        return
+    register_family(BODY_FONT)
+    for family, files in FONT_FAMILIES.items():
+        if find_font_file(files['normal']):
+            register_family(family)
+        else:
+            logging.warning(f"Font family {family} is not installed; requests for it fall back to {BODY_FONT}")
+    _all_registered = True
+
+
+def resolve_font_family(value):
+    """Family named by a request's "font_family" ("sans", "serif" or a family name).
+
+    Families that are not installed resolve to BODY_FONT, so the name can be
+    part of a cache key.
+    """
+    family = FONT_FAMILY_ALIASES.get(str(value).lower(), value) if value else BODY_FONT
+    if family not in FONT_FAMILIES:
+        raise ValueError(f"Unknown font family: {value}")
+    if family != BODY_FONT and not find_font_file(FONT_FAMILIES[family]['normal']):
+        return BODY_FONT
+    return family
+
+
+def ascii_readable(text):
+    """Whether a document whose text is like `text` should keep ASCII-readable glyph codes.
+
+    ReportLab's default subsets reserve codes 32-126 for ASCII, so Latin text
+    is written as plain characters and every other glyph as an escape. When
+    most letters are Cyrillic (or any other non-ASCII script), handing out
+    codes in order of first use writes them as plain bytes instead. In
+    benchmarks/bench_fonts.py that makes the embedded fonts of a Cyrillic book
+    about 30% smaller (75.5 KB to 53.2 KB for DejaVu Sans) and the whole PDF
+    about 14% smaller; Latin text is best left ASCII-readable.
+    """
+    letters = [char for char in text if char.isalpha()]
+    return sum(char.isascii() for char in letters) * 2 >= len(letters)
+
+
+def start_subsets(doc, ascii_readable=True):
+    """Start the glyph subsets of every registered face for a new PDF document.
+
+    Subsets are kept per document, so each PDF embeds only the glyphs it uses.
+    """
+    with _lock:
+        names = {name for faces in _families.values() for name in faces.values()}
+    for name in names:
+        state = pdfmetrics.getFont(name)._assignState(doc, asciiReadable=ascii_readable)
+        if not ascii_readable:
+            # The faces themselves stay ASCII-readable, which moves a subset that
+            # reaches code 31 on to 127; start past the control codes instead
+            state.nextCode = 33
@@ -0,0 +1,285 @@
+import os
+import re
+import html
+import lxml.html
+from lxml import etree
+from bs4 import UnicodeDammit
+from reportlab.platypus import Paragraph, Spacer, Image as ReportLabImage
+from reportlab.platypus.flowables import Flowable, AnchorFlowable
+from reportlab.lib.units import inch
+
+# Inline tags and the ReportLab paragraph markup they map to
+INLINE_MARKUP = {
+    'b': 'b', 'strong': 'b',
+    'i': 'i', 'em': 'i', 'cite': 'i', 'var': 'i',
+    'u': 'u', 'ins': 'u',
+    's': 'strike', 'strike': 'strike', 'del': 'strike',
+    'sup': 'super', 'sub': 'sub'
+}
+
+# Tags that end the current paragraph and start a new one
+BLOCK_TAGS = {
+    'html', 'body', 'p', 'div', 'section', 'article', 'main', 'header', 'footer', 'aside', 'nav',
+    'figure', 'figcaption', 'address', 'center', 'pre', 'table', 'thead', 'tbody', 'tfoot', 'tr',
+    'td', 'th', 'caption', 'dl', 'dt', 'dd'
+}
+
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+SKIPPED_TAGS = {'head', 'title', 'script', 'style', 'noscript', 'svg', 'math'}
+LINK_SCHEMES = ('http://', 'https://', 'mailto:')
+
+_whitespace = re.compile(r'\s+')
+_xml_declaration = re.compile(r'^\s*<\?xml[^>]*\?>')
+_html_parser = lxml.html.HTMLParser(remove_comments=True, remove_pis=True)
+
+
+def parse_html(html_content):
+    """Parse chapter markup with lxml; returns the root element or None for an empty document"""
+    if isinstance(html_content, bytes):
+        try:
+            html_content = html_content.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            html_content = UnicodeDammit(html_content).unicode_markup
+    # lxml refuses str input that still carries an encoding declaration
+    html_content = _xml_declaration.sub('', html_content, count=1)
+    if not html_content.strip():
+        return None
+    try:
+        return lxml.html.document_fromstring(html_content, parser=_html_parser)
+    except etree.ParserError:
+        return None
+
+
+class HtmlBlockCompiler:
+    """Single-pass walk of a chapter DOM into a flat list of blocks.
+
+    Every node is visited exactly once. Inline formatting is kept as
+    ReportLab paragraph markup, and open inline tags are closed and reopened
+    around any block that interrupts them, so every emitted block is
+    well-formed. Blocks are plain tuples, so they are cheap to pickle:
+
+        ('heading', level, markup)
+        ('paragraph', markup)
+        ('quote', markup)
+        ('list_item', bullet, depth, markup)
+        ('image', image_name)
+        ('rule',)
+        ('anchor', name)
+
+    An anchor stands for an element's id (or an <a name>): that element's
+    content starts in the block after it.
+    """
+    def compile(self, html_content):
+        root = parse_html(html_content) if isinstance(html_content, (str, bytes)) else html_content
+        self._blocks = []
+        self._buffer = []
+        self._has_text = False
+        self._open_inline = []
+        self._context = [('paragraph',)]
+        self._anchors = []
+        if root is not None:
+            self._walk(root)
+        self._flush()
+        self._blocks.extend(('anchor', name) for name in self._anchors)
+        return self._blocks
+
+    def _emit(self, block):
+        # Anchors met since the last block belong to this one, which holds their element's text
+        if self._anchors:
+            self._blocks.extend(('anchor', name) for name in self._anchors)
+            self._anchors = []
+        self._blocks.append(block)
+
+    def _flush(self):
+        """Emit the buffered inline markup as a block of the current context"""
+        if self._has_text:
+            closing = ''.join(close for _, close in reversed(self._open_inline))
+            markup = ''.join(self._buffer) + closing
+            context = self._context[-1]
+            if context[0] == 'heading':
+                self._emit(('heading', context[1], markup))
+            elif context[0] == 'list_item':
+                self._emit(('list_item', context[1], context[2], markup))
+                # Only the first paragraph of a list item carries the bullet
+                self._context[-1] = ('list_item', '', context[2])
+            else:
+                self._emit((context[0], markup))
+        self._buffer = [opening for opening, _ in self._open_inline]
+        self._has_text = False
+
+    def _text(self, text):
+        text = _whitespace.sub(' ', text)
+        if text.strip():
+            self._has_text = True
+        elif not self._has_text:
+            # Leading whitespace of a block is never significant
+            return
+        self._buffer.append(html.escape(text, quote=False))
+
+    def _walk(self, element):
+        if element.text:
+            self._text(element.text)
+        for child in element:
+            # Comments and processing instructions have a non-string tag
+            if isinstance(child.tag, str):
+                self._visit(child)
+            if child.tail:
+                self._text(child.tail)
+
+    def _visit(self, element):
+        name = element.tag.rsplit('}', 1)[-1].lower()
+        if name in SKIPPED_TAGS:
+            return
+        anchor = element.get('id') or (element.get('name') if name == 'a' else None)
+        if anchor:
+            self._anchors.append(anchor)
+        if name in INLINE_MARKUP:
+            self._walk_inline(element, f'<{INLINE_MARKUP[name]}>', f'</{INLINE_MARKUP[name]}>')
+        elif name == 'a':
+            href = element.get('href', '')
+            if href.startswith(LINK_SCHEMES):
+                self._walk_inline(element, f'<a href="{html.escape(href)}">', '</a>')
+            else:
+                self._walk(element)
+        elif name == 'br':
+            if self._has_text:
+                self._buffer.append('<br/>')
+        elif name == 'img':
+            if element.get('src'):
+                self._flush()
+                self._emit(('image', os.path.basename(element.get('src'))))
+        elif name == 'hr':
+            self._flush()
+            self._emit(('rule',))
+        elif name in HEADING_TAGS:
+            self._walk_block(element, ('heading', int(name[1])))
+        elif name == 'blockquote':
+            self._walk_block(element, ('quote',))
+        elif name in ('ul', 'ol'):
+            self._walk_list(element, name == 'ol')
+        elif name == 'li':
+            # Stray list item outside a list
+            self._walk_block(element, ('list_item', '•', 0))
+        elif name in BLOCK_TAGS:
+            self._flush()
+            self._walk(element)
+            self._flush()
+        else:
+            # span, small, code, font, ...: transparent inline containers
+            self._walk(element)
+
+    def _walk_inline(self, element, opening, closing):
+        self._open_inline.append((opening, closing))
+        self._buffer.append(opening)
+        self._walk(element)
+        self._open_inline.pop()
+        if self._buffer and self._buffer[-1] == opening:
+            self._buffer.pop()
+        else:
+            self._buffer.append(closing)
+
+    def _walk_block(self, element, context):
+        self._flush()
+        self._context.append(context)
+        self._walk(element)
+        self._flush()
+        self._context.pop()
+
+    def _walk_list(self, element, ordered):
+        depth = sum(1 for context in self._context if context[0] == 'list_item')
+        number = 0
+        self._flush()
+        for child in element:
+            if not isinstance(child.tag, str):
+                continue
+            if child.tag.rsplit('}', 1)[-1].lower() == 'li':
+                number += 1
+                self._walk_block(child, ('list_item', f'{number}.' if ordered else '•', depth))
+            else:
+                self._visit(child)
+        self._flush()
+
+
+def compile_chapter(html_content):
+    """Process-pool entry point: compile one chapter's markup to blocks"""
+    if not html_content:
+        return []
+    return HtmlBlockCompiler().compile(html_content)
+
+
+class Anchor(AnchorFlowable):
+    """Named destination at the top of the next flowable, and kept on its page.
+
+    anchors lists the destination names a flowable defines where it is laid out.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self.anchors = [name]
+        self.keepWithNext = 1
+
+
+class ImagePlaceholder(Flowable):
+    """Takes up an image's space without drawing it; used by layout-only builds"""
+    def __init__(self, width, height):
+        super().__init__()
+        self.width = width
+        self.height = height
+
+    def draw(self):
+        pass
+
+
+class ChapterFlowableBuilder:
+    """Turns compiled blocks into ReportLab flowables.
+
+    images maps image names to the (path, width, height) entries produced by
+    image_pipeline.prepare_images; a None path (from measure_images) yields a
+    placeholder of the same size.
+    """
+    def __init__(self, styles, images):
+        self.styles = styles
+        self.images = images
+
+    def build(self, blocks):
+        flowables = []
+        for block in blocks:
+            kind = block[0]
+            if kind == 'heading':
+                style = self.styles['h1'] if block[1] == 1 else self.styles['h2'] if block[1] == 2 else self.styles['h3']
+                flowables.append(Paragraph(block[2], style))
+                flowables.append(Spacer(1, 0.15 * inch))
+            elif kind == 'paragraph':
+                flowables.append(Paragraph(block[1], self.styles['body']))
+                flowables.append(Spacer(1, 0.1 * inch))
+            elif kind == 'quote':
+                flowables.append(Paragraph(f'<i>{block[1]}</i>', self.styles['quote']))
+                flowables.append(Spacer(1, 0.1 * inch))
+            elif kind == 'list_item':
+                bullet, depth = block[1], block[2]
+                flowables.append(Paragraph(block[3], self.styles['list'][min(depth, len(self.styles['list']) - 1)],
+                                           bulletText=bullet or None))
+            elif kind == 'image':
+                if block[1] in self.images:
+                    path, width, height = self.images[block[1]]
+                    if path is None:
+                        flowables.append(ImagePlaceholder(width, height))
+                    else:
+                        flowables.append(ReportLabImage(path, width=width, height=height))
+                    flowables.append(Spacer(1, 0.2 * inch))
+            elif kind == 'rule':
+                flowables.append(Spacer(1, 0.3 * inch))
+                flowables.append(Paragraph("―" * 50, self.styles['body']))
+                flowables.append(Spacer(1, 0.3 * inch))
+            elif kind == 'anchor':
+                flowables.append(Anchor(block[1]))
+        return flowables
+
+
+def image_names(blocks):
+    """Names of the images referenced by compiled blocks"""
+    return {block[1] for block in blocks if block[0] == 'image'}
+
+
+def block_text(block):
+    """Plain text of a text block's markup, for comparisons"""
+    return _whitespace.sub(' ', html.unescape(re.sub(r'<[^>]+>', '', block[-1]))).strip()
@@ -0,0 +1,156 @@
+import io
+import os
+import math
+import hashlib
+import logging
+from PIL import Image
+from reportlab.lib.units import inch
+from src.services.job_queue import run_parallel
+from src.services.epub_archive import ArchiveMember, read_source, open_source
+
+# Resolution embedded images are resampled to for their display box
+TARGET_DPI = int(os.environ.get('CONVERTER_IMAGE_DPI', 200))
+JPEG_QUALITY = int(os.environ.get('CONVERTER_IMAGE_JPEG_QUALITY', 85))
+
+# Vertical room left under an image so it never fills a frame on its own
+V_BUFFER = 1 * inch
+
+
+def display_size(img_width, img_height, frame_width, frame_height):
+    """Size in points an image is shown at: one point per pixel, scaled down to fit the frame"""
+    max_width = frame_width
+    max_height = frame_height - V_BUFFER
+
+    display_width = img_width
+    display_height = img_height
+
+    if display_width > max_width or display_height > max_height:
+        width_ratio = max_width / display_width
+        height_ratio = max_height / display_height
+        scale_ratio = min(width_ratio, height_ratio)
+
+        display_width = display_width * scale_ratio
+        display_height = display_height * scale_ratio
+
+    return display_width, display_height
+
+
+def prepare_image(task):
+    """Process-pool entry point: resample and re-encode one image.
+
+    task is (image source, frame width, frame height, dpi, output directory),
+    the source being bytes or an ArchiveMember that is only decompressed here.
+    The file is named after the SHA-256 of the source bytes, so identical
+    images come out as the same file. Returns (path, display width, display
+    height) or None when the image cannot be read.
+    """
+    source, frame_width, frame_height, dpi, output_dir = task
+    try:
+        data = read_source(source)
+        output_base = os.path.join(output_dir, hashlib.sha256(data).hexdigest()[:32])
+        with Image.open(io.BytesIO(data)) as img:
+            display_width, display_height = display_size(img.width, img.height, frame_width, frame_height)
+            target = (max(1, math.ceil(display_width / 72 * dpi)), max(1, math.ceil(display_height / 72 * dpi)))
+            needs_resize = img.width > target[0] or img.height > target[1]
+
+            # Already a JPEG at or below the target resolution: embed it untouched
+            if img.format == 'JPEG' and not needs_resize and img.mode in ('RGB', 'L', 'CMYK'):
+                path = output_base + '.jpg'
+                # Identical images may be written by two render processes at once
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                return path, display_width, display_height
+
+            if img.format == 'JPEG' and needs_resize:
+                # Let the decoder skip straight to a reduced scale
+                img.draft(img.mode, target)
+
+            has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+            # Few-colour PNG/GIF sources are line art or diagrams, not photographs
+            lossless = has_alpha or img.mode in ('1', 'P') or (
+                img.format in ('PNG', 'GIF') and img.getcolors(256) is not None)
+            if lossless:
+                img = img.convert('RGBA' if has_alpha else 'L' if img.mode == '1' else 'RGB')
+            elif img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+
+            if needs_resize:
+                img = img.resize(target, Image.LANCZOS)
+
+            if lossless:
+                # Line art, palettes and transparency: flate keeps them sharp
+                path = output_base + '.png'
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                img.save(tmp_path, 'PNG', optimize=True)
+            else:
+                path = output_base + '.jpg'
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                img.save(tmp_path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            return path, display_width, display_height
+    except Exception as e:
+        logging.warning(f"Error processing image: {e}")
+        return None
+
+
+def source_key(source):
+    """Identity of an image source: the archive entry itself, or the hash of given bytes.
+
+    Different entries with the same bytes still end up in one file, named by
+    prepare_image after their hash; a CRC and size are not trusted for that.
+    """
+    return source if isinstance(source, ArchiveMember) else hashlib.sha256(source).hexdigest()
+
+
+def prepare_images(image_map, image_names, frame_width, frame_height, output_dir, dpi=TARGET_DPI):
+    """Prepare every referenced image once per distinct source.
+
+    image_map maps image names to their bytes or ArchiveMembers. Returns
+    {image name: (path, display width, display height)}. Names whose
+    contents are identical share one file, so ReportLab embeds them as a
+    single image XObject.
+    """
+    names_by_source = {}
+    for name in image_names:
+        source = image_map.get(name)
+        if source is not None:
+            names_by_source.setdefault(source_key(source), []).append(name)
+
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(image_map[names[0]], frame_width, frame_height, dpi, output_dir) for names in names_by_source.values()]
+    prepared = {}
+    for names, result in zip(names_by_source.values(), run_parallel(prepare_image, tasks)):
+        if result is not None:
+            for name in names:
+                prepared[name] = result
+    return prepared
+
+
+def image_sizes(image_map, image_names):
+    """Pixel sizes of the referenced images, read from their headers only.
+
+    Returns {image name: (width, height)}; images that cannot be read are left out.
+    """
+    sizes = {}
+    for name in image_names:
+        source = image_map.get(name)
+        if source is None:
+            continue
+        try:
+            with open_source(source) as f, Image.open(f) as img:
+                sizes[name] = img.size
+        except Exception as e:
+            logging.warning(f"Error reading image {name}: {e}")
+    return sizes
+
+
+def measure_images(sizes, frame_width, frame_height):
+    """Display sizes of images from their pixel sizes (see image_sizes).
+
+    Returns {image name: (None, display width, display height)}, the shape
+    prepare_images produces, for layout-only passes that draw nothing.
+    """
+    return {name: (None, *display_size(width, height, frame_width, frame_height))
+            for name, (width, height) in sizes.items()}
@@ -0,0 +1,236 @@
+import os
+import queue
+import threading
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# Number of conversions that may run at the same time in this process
+MAX_CONCURRENT_JOBS = int(os.environ.get('CONVERTER_MAX_CONCURRENT_JOBS', 2))
+# Number of jobs that may wait for a free slot before new ones are rejected
+MAX_QUEUED_JOBS = int(os.environ.get('CONVERTER_MAX_QUEUED_JOBS', 20))
+# Quotes running at the same time, and waiting, in this process; more are answered 503
+MAX_CONCURRENT_QUOTES = int(os.environ.get('CONVERTER_MAX_CONCURRENT_QUOTES', 1))
+MAX_QUEUED_QUOTES = int(os.environ.get('CONVERTER_MAX_QUEUED_QUOTES', 8))
+# Size of the process pool for CPU-heavy stages: chapter parsing and rendering (0 runs them in-thread)
+RENDER_PROCESSES = int(os.environ.get('CONVERTER_RENDER_PROCESSES', MAX_CONCURRENT_JOBS))
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+    def __init__(self, queue_length):
+        super().__init__(f'Conversion queue is full ({queue_length} jobs waiting)')
+        self.queue_length = queue_length
+
+
+class ConversionCancelled(Exception):
+    """Raised inside a running job once it has been cancelled."""
+
+
+class ConversionQueue:
+    """Bounded FIFO of conversion jobs served by a fixed set of worker threads.
+
+    Worker threads are started lazily on the first submit so that nothing is
+    spawned before gunicorn forks its workers.
+    """
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS, max_queued=MAX_QUEUED_JOBS):
+        self.max_workers = max(1, max_workers)
+        self.max_queued = max(0, max_queued)
+        self._pending = deque()
+        self._running = set()
+        self._cancelled = set()
+        # Worker slots lent to running jobs for threads of their own (see reserve_workers)
+        self._reserved = 0
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def submit(self, job_id, target, *args):
+        """Queue a job and return its 1-based position in the queue"""
+        with self._cond:
+            if len(self._pending) >= self.max_queued and len(self._running) + self._reserved >= self.max_workers:
+                raise QueueFullError(len(self._pending))
+            self._pending.append((job_id, target, args))
+            self._start_workers()
+            self._cond.notify()
+            return len(self._pending)
+
+    def call(self, job_id, target, *args):
+        """Queue a job, wait for it and return its result or raise its exception"""
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(target(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.submit(job_id, run)
+        return future.result()
+
+    def position(self, job_id):
+        """Return the 1-based queue position of a waiting job, or None"""
+        with self._cond:
+            for index, (pending_id, _, _) in enumerate(self._pending):
+                if pending_id == job_id:
+                    return index + 1
+        return None
+
+    def reserve_workers(self, count):
+        """Take up to count idle worker slots for a running job's own threads; returns how many it got.
+
+        No queued job starts in a reserved slot until release_workers gives it back.
+        """
+        with self._cond:
+            reserved = max(0, min(count, self.max_workers - len(self._running) - self._reserved))
+            self._reserved += reserved
+            return reserved
+
+    def release_workers(self, count):
+        with self._cond:
+            self._reserved -= count
+            self._cond.notify_all()
+
+    def cancel(self, job_id):
+        """Cancel a job. Returns 'queued', 'running' or None if the job is unknown here"""
+        with self._cond:
+            for entry in self._pending:
+                if entry[0] == job_id:
+                    self._pending.remove(entry)
+                    return 'queued'
+            if job_id in self._running:
+                self._cancelled.add(job_id)
+                return 'running'
+        return None
+
+    def is_cancelled(self, job_id):
+        with self._cond:
+            return job_id in self._cancelled
+
+    def _start_workers(self):
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name=f'conversion-worker-{len(self._workers)}')
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending or len(self._running) + self._reserved >= self.max_workers:
+                    self._cond.wait()
+                job_id, target, args = self._pending.popleft()
+                self._running.add(job_id)
+            try:
+                target(*args)
+            except Exception:
+                logging.exception(f"Unhandled error in conversion job {job_id}")
+            finally:
+                with self._cond:
+                    self._running.discard(job_id)
+                    self._cancelled.discard(job_id)
+                    self._cond.notify_all()
+
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+_progress_manager = None
+# Run once in every render process as it starts (see set_render_initializer)
+_render_initializer = None
+
+
+def set_render_initializer(initializer):
+    """Have every render process run initializer, a picklable module-level callable, before its first task"""
+    global _render_initializer
+    _render_initializer = initializer
+
+
+def get_render_executor():
+    """Return the shared render process pool, or None when rendering in-thread"""
+    global _render_executor
+    if RENDER_PROCESSES <= 0:
+        return None
+    with _render_executor_lock:
+        if _render_executor is None:
+            # spawn rather than fork: the parent is multi-threaded by the time we get here
+            _render_executor = ProcessPoolExecutor(max_workers=RENDER_PROCESSES,
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=_render_initializer)
+        return _render_executor
+
+
+def start_render_pool():
+    """Start every render process now instead of on demand during the first conversions"""
+    executor = get_render_executor()
+    if executor is not None:
+        # Processes are spawned one per task submitted while none is idle
+        for _ in range(RENDER_PROCESSES):
+            executor.submit(os.getpid)
+
+
+def get_progress_manager():
+    """Return the manager whose queues carry progress out of the render processes"""
+    global _progress_manager
+    with _render_executor_lock:
+        if _progress_manager is None:
+            _progress_manager = multiprocessing.get_context('spawn').Manager()
+        return _progress_manager
+
+
+class _DirectReporter:
+    """Stands in for a progress queue when the target runs in this thread"""
+    def __init__(self, on_progress):
+        self.put = on_progress
+
+
+def run_render(target, *args, on_progress=None):
+    """Run a picklable render callable in the process pool and wait for its result.
+
+    With on_progress, target gets a queue-like reporter as its last argument;
+    every item it puts there is handed to on_progress in the calling thread.
+    """
+    executor = get_render_executor()
+    if on_progress is None:
+        if executor is None:
+            return target(*args)
+        return executor.submit(target, *args).result()
+
+    if executor is None:
+        return target(*args, _DirectReporter(on_progress))
+    progress = get_progress_manager().Queue()
+    future = executor.submit(target, *args, progress)
+    while True:
+        try:
+            item = progress.get(timeout=0.2)
+        except queue.Empty:
+            if future.done():
+                break
+            continue
+        try:
+            on_progress(item)
+        except Exception:
+            logging.exception("Progress callback failed")
+    return future.result()
+
+
+def run_parallel(target, items):
+    """Map a picklable callable over items in the process pool, preserving order"""
+    items = list(items)
+    executor = get_render_executor()
+    if executor is None or len(items) < 2:
+        return [target(item) for item in items]
+    chunksize = max(1, len(items) // (RENDER_PROCESSES * 4))
+    return list(executor.map(target, items, chunksize=chunksize))
+
+
+def iter_parallel(target, items):
+    """Map a picklable callable over items in the process pool, one task per item.
+
+    Results are yielded in order, each as soon as it and those before it are
+    done. Closing the iterator early cancels the tasks that have not started.
+    """
+    executor = get_render_executor()
+    if executor is None:
+        return (target(item) for item in items)
+    return executor.map(target, items)
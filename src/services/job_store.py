@@ -0,0 +1,234 @@
+import os
+import copy
+import json
+import time
+import threading
+from datetime import datetime
+from sqlalchemy import update, func
+from sqlalchemy.exc import IntegrityError
+from src.models.job import db, ConversionJob
+
+# Which backend src.main installs: 'sqlite' (shared across workers) or 'memory'
+JOB_STORE_BACKEND = os.environ.get('CONVERTER_JOB_STORE', 'sqlite')
+# How often wait() re-reads a record that may be written by another process
+WAIT_POLL_INTERVAL = float(os.environ.get('CONVERTER_STATUS_POLL_INTERVAL', 0.5))
+
+
+class JobStore:
+    """Interface for conversion status records.
+
+    A record is a plain dict with at least 'status', 'progress', 'message' and
+    'created_at', plus a 'version' that every set() and update() increments.
+    Every method returns copies, never live references.
+    """
+    def __init__(self):
+        self._changed = threading.Condition()
+
+    def _notify(self):
+        """Wake the waiters of this process after a write"""
+        with self._changed:
+            self._changed.notify_all()
+
+    def get(self, job_id):
+        """Return the record for job_id, or None"""
+        raise NotImplementedError
+
+    def set(self, job_id, record):
+        """Create or replace the whole record for job_id"""
+        raise NotImplementedError
+
+    def update(self, job_id, **fields):
+        """Atomically merge fields into an existing record. Returns False if the job is unknown"""
+        raise NotImplementedError
+
+    def delete(self, job_id):
+        raise NotImplementedError
+
+    def created_before(self, cutoff):
+        """Return (job_id, record) pairs for jobs created before cutoff"""
+        raise NotImplementedError
+
+    def version(self, job_id):
+        """Return the current version of a record, or None if the job is unknown"""
+        record = self.get(job_id)
+        return record['version'] if record is not None else None
+
+    def wait(self, job_id, since, timeout):
+        """Block until the record's version passes `since` or timeout seconds elapse.
+
+        Returns the current record either way, or None if the job is unknown.
+        Writes from this process wake waiters at once; writes from other
+        processes are picked up every WAIT_POLL_INTERVAL seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            version = self.version(job_id)
+            if version is None or version > since:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with self._changed:
+                self._changed.wait(min(remaining, WAIT_POLL_INTERVAL))
+        return self.get(job_id)
+
+    def after_fork(self):
+        """Drop resources inherited from the parent process; called in each forked worker"""
+        self._changed = threading.Condition()
+
+    def __contains__(self, job_id):
+        return self.get(job_id) is not None
+
+
+class MemoryJobStore(JobStore):
+    """Process-local store; only suitable for a single worker process"""
+    def __init__(self):
+        super().__init__()
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            record = self._records.get(job_id)
+            return copy.deepcopy(record) if record is not None else None
+
+    def set(self, job_id, record):
+        with self._lock:
+            previous = self._records.get(job_id)
+            record = copy.deepcopy(record)
+            record['version'] = (previous['version'] if previous else 0) + 1
+            self._records[job_id] = record
+        self._notify()
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None:
+                return False
+            fields.pop('version', None)
+            record.update(copy.deepcopy(fields))
+            record['version'] += 1
+        self._notify()
+        return True
+
+    def delete(self, job_id):
+        with self._lock:
+            self._records.pop(job_id, None)
+        self._notify()
+
+    def created_before(self, cutoff):
+        with self._lock:
+            return [(job_id, copy.deepcopy(record)) for job_id, record in self._records.items()
+                    if record.get('created_at', datetime.now()) < cutoff]
+
+
+class SqlJobStore(JobStore):
+    """Store backed by the ConversionJob table (SQLite in WAL mode by default).
+
+    Every worker process sees the same records, and they survive restarts.
+    """
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def get(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(ConversionJob, job_id)
+            return job.to_dict() if job else None
+
+    def set(self, job_id, record):
+        values = ConversionJob.columns(record)
+        with self.app.app_context():
+            while True:
+                # The version is bumped by the UPDATE itself, so concurrent writers never reuse one
+                result = db.session.execute(update(ConversionJob).where(ConversionJob.id == job_id).values(
+                    **values, updated_at=datetime.now(), version=ConversionJob.version + 1))
+                if result.rowcount:
+                    db.session.commit()
+                    break
+                db.session.add(ConversionJob(id=job_id, version=1, **values))
+                try:
+                    db.session.commit()
+                    break
+                except IntegrityError:
+                    # Another worker inserted the job first; update that row instead
+                    db.session.rollback()
+        self._notify()
+
+    def update(self, job_id, **fields):
+        fields.pop('version', None)
+        core = {key: value for key, value in fields.items() if key in ConversionJob.CORE_FIELDS}
+        extra = {key: value for key, value in fields.items() if key not in ConversionJob.CORE_FIELDS}
+        with self.app.app_context():
+            if extra and db.engine.dialect.name != 'sqlite':
+                # No json_set outside SQLite: merge under a row lock instead
+                job = db.session.query(ConversionJob).filter_by(id=job_id).with_for_update().first()
+                if job is None:
+                    db.session.rollback()
+                    return False
+                data = json.loads(job.data or '{}')
+                data.update(extra)
+                job.data = json.dumps(data)
+                for key, value in core.items():
+                    setattr(job, key, value)
+                job.version += 1
+                db.session.commit()
+                self._notify()
+                return True
+
+            # A single UPDATE statement, so concurrent progress writes never interleave
+            values = dict(core, updated_at=datetime.now(), version=ConversionJob.version + 1)
+            if extra:
+                # Replace each top-level key, as MemoryJobStore does; json_patch would merge nested dicts
+                paths = []
+                for key, value in extra.items():
+                    paths += ['$.' + json.dumps(key), func.json(json.dumps(value))]
+                values['data'] = func.json_set(ConversionJob.data, *paths)
+            result = db.session.execute(update(ConversionJob).where(ConversionJob.id == job_id).values(**values))
+            db.session.commit()
+        self._notify()
+        return result.rowcount > 0
+
+    def version(self, job_id):
+        with self.app.app_context():
+            return db.session.query(ConversionJob.version).filter_by(id=job_id).scalar()
+
+    def delete(self, job_id):
+        with self.app.app_context():
+            db.session.query(ConversionJob).filter_by(id=job_id).delete()
+            db.session.commit()
+        self._notify()
+
+    def after_fork(self):
+        super().after_fork()
+        # Pooled connections opened while preloading belong to the parent; never reuse them
+        with self.app.app_context():
+            db.engine.dispose(close=False)
+
+    def created_before(self, cutoff):
+        with self.app.app_context():
+            jobs = db.session.query(ConversionJob).filter(ConversionJob.created_at < cutoff).all()
+            return [(job.id, job.to_dict()) for job in jobs]
+
+
+_job_store = MemoryJobStore()
+
+
+def get_job_store():
+    return _job_store
+
+
+def set_job_store(store):
+    global _job_store
+    _job_store = store
+
+
+def init_job_store(app):
+    """Install the configured backend for this app"""
+    if JOB_STORE_BACKEND == 'memory':
+        set_job_store(MemoryJobStore())
+        return
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    set_job_store(SqlJobStore(app))
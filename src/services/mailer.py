@@ -0,0 +1,201 @@
+import os
+import time
+import heapq
+import smtplib
+import logging
+import threading
+from itertools import count
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+
+# SMTP server; a local stand-in needs only host, port and sender, with STARTTLS off and no user.
+# Sending is disabled until a sender (or a user to send as) is configured.
+SMTP_HOST = os.environ.get('CONVERTER_SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('CONVERTER_SMTP_PORT', 587))
+SMTP_STARTTLS = os.environ.get('CONVERTER_SMTP_STARTTLS', '1').lower() in ('1', 'true', 'yes', 'on')
+SMTP_USER = os.environ.get('CONVERTER_SMTP_USER', '')
+SMTP_PASSWORD = os.environ.get('CONVERTER_SMTP_PASSWORD', '')
+SENDER_EMAIL = os.environ.get('CONVERTER_EMAIL_SENDER', SMTP_USER)
+SMTP_TIMEOUT = float(os.environ.get('CONVERTER_SMTP_TIMEOUT', 60))
+# Delivery threads, each with one SMTP connection kept open while it is used
+# within the idle timeout (seconds)
+SMTP_CONNECTIONS = max(1, int(os.environ.get('CONVERTER_SMTP_CONNECTIONS', 2)))
+SMTP_IDLE_TIMEOUT = float(os.environ.get('CONVERTER_SMTP_IDLE_TIMEOUT', 60))
+# Attempts per email; the delay before a retry starts at EMAIL_RETRY_DELAY seconds and doubles
+EMAIL_MAX_ATTEMPTS = max(1, int(os.environ.get('CONVERTER_EMAIL_MAX_ATTEMPTS', 5)))
+EMAIL_RETRY_DELAY = float(os.environ.get('CONVERTER_EMAIL_RETRY_DELAY', 5))
+
+
+def build_message(recipient, subject, body, attachment_path=None, attachment_name=None):
+    """A plain-text email, with the file at attachment_path attached as a PDF"""
+    msg = MIMEMultipart()
+    msg['From'] = SENDER_EMAIL
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
+    if attachment_path:
+        with open(attachment_path, 'rb') as f:
+            attachment = MIMEApplication(f.read(), _subtype='pdf')
+        attachment.add_header('Content-Disposition', 'attachment',
+                              filename=attachment_name or os.path.basename(attachment_path))
+        msg.attach(attachment)
+    return msg
+
+
+def is_permanent(error):
+    """Whether an SMTP failure will not go away by retrying: a refused recipient or a 5xx reply"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+
+def configuration_error():
+    """Why emails cannot be sent with the SMTP settings, or None if they can"""
+    if not SENDER_EMAIL:
+        return 'no sender address is configured (CONVERTER_EMAIL_SENDER or CONVERTER_SMTP_USER)'
+    if SMTP_USER and not SMTP_PASSWORD:
+        return 'CONVERTER_SMTP_USER is set but CONVERTER_SMTP_PASSWORD is not'
+    return None
+
+
+class MailQueue:
+    """Delivers emails in the background over persistent SMTP connections.
+
+    Each delivery thread connects, runs STARTTLS and logs in once, then sends
+    message after message over the same connection until it has been idle for
+    SMTP_IDLE_TIMEOUT. Failed sends are retried with exponential backoff
+    unless the server refused them for good. Messages are built only when a
+    send is attempted, so a queued email holds no attachment in memory.
+    Threads are started lazily on the first submit, after gunicorn forks.
+    Without usable SMTP settings the queue is disabled and fails every email
+    it is given at once.
+    """
+    def __init__(self, connections=SMTP_CONNECTIONS, max_attempts=EMAIL_MAX_ATTEMPTS, retry_delay=EMAIL_RETRY_DELAY):
+        self.connections = connections
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # (due time, sequence, delivery) heap of emails waiting to be sent or retried
+        self._pending = []
+        self._sequence = count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self.disabled_reason = configuration_error()
+        if self.disabled_reason:
+            logging.warning(f"Email delivery is disabled: {self.disabled_reason}")
+
+    @property
+    def enabled(self):
+        return self.disabled_reason is None
+
+    def submit(self, recipient, build, on_sent=None, on_retry=None, on_failed=None):
+        """Queue an email to recipient; build() returns the message.
+
+        on_sent() is called once it is delivered, on_retry(attempt, delay,
+        error) before each retry, and on_failed(error) once it is given up,
+        right away if the queue is disabled.
+        """
+        if not self.enabled:
+            logging.warning(f"Not sending the email to {recipient}: {self.disabled_reason}")
+            self._notify(on_failed, RuntimeError(f'Email delivery is disabled: {self.disabled_reason}'))
+            return
+        delivery = {'recipient': recipient, 'build': build, 'attempt': 0,
+                    'on_sent': on_sent, 'on_retry': on_retry, 'on_failed': on_failed}
+        self._push(delivery, time.monotonic())
+
+    def _push(self, delivery, due):
+        with self._cond:
+            heapq.heappush(self._pending, (due, next(self._sequence), delivery))
+            self._start_workers()
+            self._cond.notify()
+
+    def _start_workers(self):
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.connections:
+            worker = threading.Thread(target=self._work, name=f'mail-delivery-{len(self._workers)}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _next(self, idle_deadline):
+        """Wait for the next email that is due; None if idle_deadline passes first"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._pending and self._pending[0][0] <= now:
+                    return heapq.heappop(self._pending)[2]
+                if idle_deadline is not None and now >= idle_deadline:
+                    return None
+                wake = [at for at in (self._pending[0][0] if self._pending else None, idle_deadline) if at is not None]
+                self._cond.wait(min(wake) - now if wake else None)
+
+    def connect(self):
+        connection = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        try:
+            if SMTP_STARTTLS:
+                connection.starttls()
+            if SMTP_USER and SMTP_PASSWORD:
+                connection.login(SMTP_USER, SMTP_PASSWORD)
+        except Exception:
+            self.disconnect(connection)
+            raise
+        return connection
+
+    def disconnect(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    @staticmethod
+    def _notify(callback, *args):
+        if callback is not None:
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception("Mail delivery callback failed")
+
+    def _work(self):
+        connection = None
+        idle_since = 0.0
+        while True:
+            delivery = self._next(idle_since + SMTP_IDLE_TIMEOUT if connection is not None else None)
+            if delivery is None:
+                self.disconnect(connection)
+                connection = None
+                continue
+
+            delivery['attempt'] += 1
+            try:
+                message = delivery['build']()
+            except Exception as e:
+                logging.exception(f"Could not build the email to {delivery['recipient']}")
+                self._notify(delivery['on_failed'], e)
+                continue
+            try:
+                if connection is None:
+                    connection = self.connect()
+                connection.sendmail(SENDER_EMAIL, delivery['recipient'], message.as_string())
+            except (smtplib.SMTPException, OSError) as e:
+                # The connection may be half-way through a command; start over with a new one
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                if is_permanent(e) or delivery['attempt'] >= self.max_attempts:
+                    logging.error(f"Giving up on the email to {delivery['recipient']} "
+                                  f"after {delivery['attempt']} attempts: {e}")
+                    self._notify(delivery['on_failed'], e)
+                else:
+                    delay = self.retry_delay * 2 ** (delivery['attempt'] - 1)
+                    logging.warning(f"Email to {delivery['recipient']} failed ({e}); retrying in {delay:g}s")
+                    self._notify(delivery['on_retry'], delivery['attempt'], delay, e)
+                    self._push(delivery, time.monotonic() + delay)
+                continue
+            finally:
+                # Do not hold on to the attachment while waiting for the next email
+                message = None
+            idle_since = time.monotonic()
+            self._notify(delivery['on_sent'])
+
+
+# The delivery queue of this process
+mail_queue = MailQueue()
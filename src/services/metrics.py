@@ -0,0 +1,370 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from src.services.disk_cache import CACHE_ROOT
+
+# How often the resident set size is sampled while a stage runs (seconds)
+RSS_SAMPLE_INTERVAL = float(os.environ.get('CONVERTER_RSS_SAMPLE_INTERVAL', 0.05))
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# Where each worker process writes its metric values for /api/metrics to merge
+METRICS_DIR = os.environ.get('CONVERTER_METRICS_DIR', os.path.join(CACHE_ROOT, 'metrics'))
+
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(1, 12))  # 4 KB .. 4 GB
+
+HISTOGRAMS = {
+    'converter_stage_seconds': ('Wall-clock time of a conversion stage', SECONDS_BUCKETS),
+    'converter_stage_cpu_seconds': ('CPU time of the thread or render process running a conversion stage', SECONDS_BUCKETS),
+    'converter_stage_bytes': ('Bytes fetched, read or written by a conversion stage', BYTES_BUCKETS),
+    'converter_stage_rss_bytes': ('Highest resident set size sampled while a conversion stage ran', BYTES_BUCKETS),
+    'converter_stage_rss_delta_bytes': ('Growth of the resident set size over a conversion stage, '
+                                        'from its start to the highest sample', BYTES_BUCKETS),
+    'converter_conversion_seconds': ('Wall-clock time of a whole conversion', SECONDS_BUCKETS)
+}
+COUNTERS = {
+    'converter_conversions_total': 'Conversions finished, by outcome'
+}
+
+
+def current_rss():
+    """Resident set size of this process now, in bytes.
+
+    Without /proc (macOS) this falls back to the process's high-water mark.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class RssSampler:
+    """Samples this process's RSS while stages run and keeps each stage's highest sample.
+
+    One thread per process samples every RSS_SAMPLE_INTERVAL, and only while
+    some stage is running. It is started by the first stage, and again in a
+    process forked after that. Stages running at the same time in one
+    process see the same samples.
+    """
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._cond = threading.Condition()
+            self._active = set()
+            self._peaks = {}
+            threading.Thread(target=self._run, name='rss-sampler', daemon=True).start()
+            self._pid = os.getpid()
+
+    def begin(self):
+        """Start tracking a stage; returns its token and the RSS at its start"""
+        if self._pid != os.getpid():
+            self._start()
+        rss = current_rss()
+        token = object()
+        with self._cond:
+            self._active.add(token)
+            self._peaks[token] = rss
+            self._cond.notify()
+        return token, rss
+
+    def end(self, token):
+        """Stop tracking a stage; returns the highest RSS sampled during it"""
+        rss = current_rss()
+        with self._cond:
+            self._active.discard(token)
+            return max(self._peaks.pop(token, rss), rss)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+            rss = current_rss()
+            with self._cond:
+                for token in self._active:
+                    self._peaks[token] = max(self._peaks[token], rss)
+                self._cond.wait(self.interval)
+
+
+_rss_sampler = RssSampler()
+
+
+class StageTimer:
+    """Wall time, CPU time, RSS and byte counts for the stages of one conversion.
+
+    stages maps stage names to {'wall', 'cpu', 'rss', 'rss_delta', 'bytes'}:
+    rss is the highest RSS of the process sampled during the stage, and
+    rss_delta how far that is above the RSS at the stage's start. CPU time
+    is that of the thread running the stage; work it fans out to the process
+    pool is not included. A stage entered twice accumulates, keeping the
+    higher rss and rss_delta.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block; set 'bytes' on the yielded dict to record a byte count"""
+        record = {'bytes': 0}
+        token, rss_start = _rss_sampler.begin()
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+            rss = _rss_sampler.end(token)
+            self.add(name, {
+                'wall': wall,
+                'cpu': cpu,
+                'rss': rss,
+                'rss_delta': rss - rss_start,
+                'bytes': record['bytes']
+            })
+
+    def add(self, name, record):
+        """Record a stage measured elsewhere, e.g. in the render process"""
+        record = {
+            'wall': round(record['wall'], 4),
+            'cpu': round(record['cpu'], 4),
+            'rss': record['rss'],
+            'rss_delta': record['rss_delta'],
+            'bytes': record['bytes']
+        }
+        previous = self.stages.get(name)
+        if previous is not None:
+            record = {
+                'wall': round(previous['wall'] + record['wall'], 4),
+                'cpu': round(previous['cpu'] + record['cpu'], 4),
+                'rss': max(previous['rss'], record['rss']),
+                'rss_delta': max(previous['rss_delta'], record['rss_delta']),
+                'bytes': previous['bytes'] + record['bytes']
+            }
+        self.stages[name] = record
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def _label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """Prometheus histograms and counters shared by every worker process.
+
+    Each process keeps its own values and writes them to a file of its own in
+    METRICS_DIR after every change; render() merges all the files, so a
+    scrape sees totals across workers whichever worker answers it. The files
+    of processes that have exited are folded into one aggregate file, and
+    clear() empties the directory when the gunicorn master starts. The
+    directory belongs to one host: liveness is judged by process id.
+    """
+    # Values of processes that have exited, added up
+    AGGREGATE = 'aggregate.json'
+
+    def __init__(self, directory=METRICS_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._path = None
+        self._histograms = {}
+        self._counters = {}
+
+    def _own_process(self):
+        """Called under the lock: a forked process starts with no values and a file of its own"""
+        if self._pid != os.getpid():
+            # Whatever the parent recorded is in the parent's file already
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f'{self._pid}-{uuid.uuid4().hex[:8]}.json')
+            self._histograms = {}
+            self._counters = {}
+
+    def observe(self, name, value, **labels):
+        buckets = HISTOGRAMS[name][1]
+        with self._lock:
+            self._own_process()
+            series = self._histograms.setdefault(name, {}).setdefault(
+                _label_key(labels), {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._own_process()
+            series = self._counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def record_conversion(self, timer, outcome):
+        """Observe every stage of a finished conversion and write this process's values"""
+        for stage, record in timer.stages.items():
+            self.observe('converter_stage_seconds', record['wall'], stage=stage)
+            self.observe('converter_stage_cpu_seconds', record['cpu'], stage=stage)
+            self.observe('converter_stage_rss_bytes', record['rss'], stage=stage)
+            self.observe('converter_stage_rss_delta_bytes', record['rss_delta'], stage=stage)
+            if record['bytes']:
+                self.observe('converter_stage_bytes', record['bytes'], stage=stage)
+        self.observe('converter_conversion_seconds', timer.elapsed(), outcome=outcome)
+        self.inc('converter_conversions_total', outcome=outcome)
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._own_process()
+            snapshot = json.dumps({'histograms': self._histograms, 'counters': self._counters})
+            path = self._path
+        tmp_path = f'{path}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(snapshot)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {path}: {e}")
+
+    def clear(self):
+        """Remove every process's values; run by the gunicorn master before it starts workers"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _add(histograms, counters, values):
+        """Add one file's values into histograms and counters"""
+        for metric, series in values.get('histograms', {}).items():
+            merged = histograms.setdefault(metric, {})
+            for key, data in series.items():
+                total = merged.setdefault(key, {'buckets': [0] * len(data['buckets']), 'sum': 0.0, 'count': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], data['buckets'])]
+                total['sum'] += data['sum']
+                total['count'] += data['count']
+        for metric, series in values.get('counters', {}).items():
+            merged = counters.setdefault(metric, {})
+            for key, value in series.items():
+                merged[key] = merged.get(key, 0) + value
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _exited(name):
+        """Whether the file name is that of a process which is no longer running"""
+        try:
+            pid = int(name.split('-', 1)[0])
+        except ValueError:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def _fold_exited(self, names):
+        """Fold the files of exited processes into the aggregate file, so each scrape reads few files"""
+        exited = [name for name in names if self._exited(name)]
+        if not exited:
+            return
+        try:
+            with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another worker may have folded them meanwhile
+                exited = [name for name in exited if os.path.exists(os.path.join(self.directory, name))]
+                histograms, counters = {}, {}
+                for name in [self.AGGREGATE] + exited:
+                    values = self._read(name)
+                    if values is not None:
+                        self._add(histograms, counters, values)
+                tmp_path = os.path.join(self.directory, f'.{self.AGGREGATE}.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'histograms': histograms, 'counters': counters}, f)
+                os.replace(tmp_path, os.path.join(self.directory, self.AGGREGATE))
+                for name in exited:
+                    os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            logging.warning(f"Could not fold the metrics of exited processes: {e}")
+
+    def _merged(self):
+        histograms, counters = {}, {}
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        except OSError:
+            names = []
+        self._fold_exited(names)
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        except OSError:
+            names = []
+        for name in names:
+            values = self._read(name)
+            if values is not None:
+                self._add(histograms, counters, values)
+        return histograms, counters
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format"""
+        histograms, counters = self._merged()
+        lines = []
+        for metric, (help_text, buckets) in HISTOGRAMS.items():
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} histogram')
+            for key, data in sorted(histograms.get(metric, {}).items()):
+                labels = [tuple(pair) for pair in json.loads(key)]
+                cumulative = 0
+                for bound, count in zip(buckets, data['buckets']):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{_format_labels(labels + [("le", bound)])} {cumulative}')
+                lines.append(f'{metric}_bucket{_format_labels(labels + [("le", "+Inf")])} {data["count"]}')
+                lines.append(f'{metric}_sum{_format_labels(labels)} {data["sum"]}')
+                lines.append(f'{metric}_count{_format_labels(labels)} {data["count"]}')
+        for metric, help_text in COUNTERS.items():
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for key, value in sorted(counters.get(metric, {}).items()):
+                labels = [tuple(pair) for pair in json.loads(key)]
+                lines.append(f'{metric}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,230 @@
+import hashlib
+import io
+from collections import deque
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (ArrayObject, DictionaryObject, FloatObject, IndirectObject, NameObject,
+                            NullObject, NumberObject, StreamObject, TextStringObject)
+
+# Link URIs with this scheme become jumps to the named destination that follows it,
+# so a part can link to a destination defined by a part added later
+NAMED_DEST_SCHEME = 'named-dest:'
+
+# Object numbers reserved for the objects written last
+_CATALOG = 1
+_PAGES = 2
+# Page attributes a page may inherit from its page tree ancestors
+_INHERITABLE = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+class PdfConcatenator:
+    """Concatenates PDFs into one, writing each part's objects as soon as it is added.
+
+    Only the page tree, the catalog and the cross-reference table are held
+    back until close(), so the output file can be read, or sent to a client,
+    while later parts are still being rendered. Objects are copied as they
+    are; content streams are never decoded. An image XObject identical to
+    one an earlier part brought along is not written again: the later
+    part's pages refer to the earlier copy. Fonts are per-part subsets and
+    are always copied.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.page_count = 0
+        self._offsets = {}
+        self._next_number = _PAGES + 1
+        self._pages = []
+        self._destinations = {}
+        self._info = None
+        # Content hash of every image XObject written -> its object number
+        self._images = {}
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def _write_object(self, number, obj):
+        buffer = io.BytesIO()
+        obj.write_to_stream(buffer, None)
+        self._offsets[number] = self.position
+        self._write(f'{number} 0 obj\n'.encode('ascii') + buffer.getvalue() + b'\nendobj\n')
+
+    def _allocate(self):
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def _leaf_pages(self, node_ref, inherited):
+        """(page reference, inherited attributes) for every page under a page tree node, in order"""
+        node = node_ref.get_object()
+        if node.get('/Type') != '/Pages':
+            yield node_ref, inherited
+            return
+        inherited = dict(inherited, **{key: node.raw_get(key) for key in _INHERITABLE if key in node})
+        for kid in node['/Kids']:
+            yield from self._leaf_pages(kid, inherited)
+
+    def _named_link(self, annotation):
+        """Turn a NAMED_DEST_SCHEME URI link into a GoTo to that named destination"""
+        action = annotation.get('/A')
+        if action is None:
+            return
+        action = action.get_object()
+        uri = action.get('/URI')
+        if action.get('/S') == '/URI' and isinstance(uri, str) and uri.startswith(NAMED_DEST_SCHEME):
+            annotation[NameObject('/A')] = DictionaryObject({
+                NameObject('/S'): NameObject('/GoTo'),
+                NameObject('/D'): NameObject('/' + uri[len(NAMED_DEST_SCHEME):])
+            })
+
+    @classmethod
+    def _image_key(cls, obj):
+        """Hash of an image XObject's encoded data and dictionary, following its soft mask; None for other objects"""
+        if not isinstance(obj, StreamObject) or obj.get('/Subtype') != '/Image':
+            return None
+        digest = hashlib.sha256(obj._data)
+        for key in sorted(obj):
+            value = obj.raw_get(key)
+            if isinstance(value, IndirectObject):
+                value = cls._image_key(value.get_object())
+                if value is None:
+                    return None
+                digest.update(f'{key} {value}\n'.encode('ascii'))
+                continue
+            buffer = io.BytesIO()
+            value.write_to_stream(buffer, None)
+            digest.update(key.encode('utf-8') + b' ' + buffer.getvalue() + b'\n')
+        return digest.hexdigest()
+
+    def add(self, path, destinations=None):
+        """Append every page of the PDF at path and write its objects.
+
+        destinations maps names to (page index, top) in this PDF; they become
+        named destinations of the output. Returns the number of pages added.
+        """
+        reader = PdfReader(path)
+        numbers = {}
+        pending = deque()
+
+        def reference(indirect):
+            number = numbers.get(indirect.idnum)
+            if number is None:
+                image_key = self._image_key(indirect.get_object())
+                number = self._images.get(image_key) if image_key else None
+                if number is None:
+                    number = self._allocate()
+                    pending.append(indirect)
+                    if image_key:
+                        self._images[image_key] = number
+                numbers[indirect.idnum] = number
+            return IndirectObject(number, 0, None)
+
+        def remap(obj):
+            """Renumber every reference in obj, in place"""
+            if isinstance(obj, IndirectObject):
+                return reference(obj)
+            if isinstance(obj, DictionaryObject):
+                if obj.get('/Subtype') == '/Link':
+                    self._named_link(obj)
+                for key, value in list(obj.items()):
+                    obj[key] = remap(value)
+            elif isinstance(obj, ArrayObject):
+                for index, value in enumerate(obj):
+                    obj[index] = remap(value)
+            return obj
+
+        root = reader.trailer['/Root']
+        first_page = len(self._pages)
+        page_numbers = set()
+        for page_ref, inherited in self._leaf_pages(root.raw_get('/Pages'), {}):
+            page = page_ref.get_object()
+            for key, value in inherited.items():
+                if key not in page:
+                    page[NameObject(key)] = value
+            # Re-parented to the output's page tree below
+            page.pop('/Parent', None)
+            number = reference(page_ref).idnum
+            page_numbers.add(number)
+            self._pages.append(number)
+        if self._info is None and '/Info' in reader.trailer:
+            self._info = reference(reader.trailer.raw_get('/Info')).idnum
+
+        while pending:
+            indirect = pending.popleft()
+            number = numbers[indirect.idnum]
+            obj = indirect.get_object()
+            obj = NullObject() if obj is None else remap(obj)
+            if number in page_numbers:
+                obj[NameObject('/Parent')] = IndirectObject(_PAGES, 0, None)
+            self._write_object(number, obj)
+
+        for name, (page_index, top) in (destinations or {}).items():
+            self._destinations[name] = ArrayObject([
+                IndirectObject(self._pages[first_page + page_index], 0, None),
+                NameObject('/XYZ'), NumberObject(0), FloatObject(top), NumberObject(0)
+            ])
+        added = len(self._pages) - first_page
+        self.page_count += added
+        return added
+
+    def _write_outline(self, outline):
+        """Write a flat outline of (title, destination name) entries; returns its root's number"""
+        root = self._allocate()
+        numbers = [self._allocate() for _ in outline]
+        for index, (title, name) in enumerate(outline):
+            entry = DictionaryObject({
+                NameObject('/Title'): TextStringObject(title),
+                NameObject('/Parent'): IndirectObject(root, 0, None),
+                NameObject('/Dest'): NameObject('/' + name)
+            })
+            if index > 0:
+                entry[NameObject('/Prev')] = IndirectObject(numbers[index - 1], 0, None)
+            if index < len(numbers) - 1:
+                entry[NameObject('/Next')] = IndirectObject(numbers[index + 1], 0, None)
+            self._write_object(numbers[index], entry)
+        self._write_object(root, DictionaryObject({
+            NameObject('/Type'): NameObject('/Outlines'),
+            NameObject('/First'): IndirectObject(numbers[0], 0, None),
+            NameObject('/Last'): IndirectObject(numbers[-1], 0, None),
+            NameObject('/Count'): NumberObject(len(numbers))
+        }))
+        return root
+
+    def close(self, outline=None):
+        """Write the page tree, the catalog and the cross-reference table.
+
+        outline lists (title, destination name) pairs for the document outline;
+        the outlines of the parts themselves are not copied.
+        """
+        self._write_object(_PAGES, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(IndirectObject(number, 0, None) for number in self._pages),
+            NameObject('/Count'): NumberObject(len(self._pages))
+        }))
+        catalog = DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): IndirectObject(_PAGES, 0, None),
+            NameObject('/PageMode'): NameObject('/UseNone')
+        })
+        if self._destinations:
+            catalog[NameObject('/Dests')] = DictionaryObject(
+                {NameObject('/' + name): dest for name, dest in self._destinations.items()})
+        if outline:
+            catalog[NameObject('/Outlines')] = IndirectObject(self._write_outline(outline), 0, None)
+        self._write_object(_CATALOG, catalog)
+
+        xref_offset = self.position
+        xref = [f'xref\n0 {self._next_number}\n', '0000000000 65535 f \n']
+        xref.extend(f'{self._offsets[number]:010d} 00000 n \n' for number in range(1, self._next_number))
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(self._next_number),
+            NameObject('/Root'): IndirectObject(_CATALOG, 0, None)
+        })
+        if self._info is not None:
+            trailer[NameObject('/Info')] = IndirectObject(self._info, 0, None)
+        buffer = io.BytesIO()
+        trailer.write_to_stream(buffer, None)
+        self._write(''.join(xref).encode('ascii') + b'trailer\n' + buffer.getvalue()
+                    + f'\nstartxref\n{xref_offset}\n%%EOF\n'.encode('ascii'))
+        self.stream.flush()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from flask import Request
+from src.services.workspaces import create_workspace
+
+# Multipart file parts accepted by the convert routes, and the name each gets in the job directory
+UPLOAD_FIELDS = {
+    'epub_file': 'book.epub',
+    'cover_file': 'cover.jpg',
+    'title_page_bg_file': 'title_bg.jpg',
+    'full_page_image_file': 'full_page_image.jpg'
+}
+
+# File parts are written here while the request body is parsed; it must be on the
+# same filesystem as the job workspaces (CONVERTER_WORKSPACE_DIR) for the handoff to be a rename
+UPLOAD_SPOOL_DIR = os.environ.get('CONVERTER_UPLOAD_SPOOL_DIR',
+                                  os.path.join(tempfile.gettempdir(), 'epub-converter-uploads'))
+
+
+class UploadRequest(Request):
+    """Request whose multipart file parts always go straight to named files on disk.
+
+    Werkzeug keeps parts under 500 KB in memory and the rest in anonymous
+    temporary files; named files can instead be renamed into a job directory.
+    Parts that were not claimed by stage_uploads are deleted when the request
+    is closed.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        stream = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_SPOOL_DIR, prefix='upload-', delete=False)
+        self.__dict__.setdefault('_spooled_paths', []).append(stream.name)
+        return stream
+
+    def close(self):
+        super().close()
+        for path in self.__dict__.get('_spooled_paths', ()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def stage_uploads(files):
+    """Move the uploaded parts into a new job directory without copying them.
+
+    Returns the directory, or None when the request carried no known parts.
+    """
+    parts = [(field, storage) for field, storage in files.items() if field in UPLOAD_FIELDS and storage.filename]
+    if not parts:
+        return None
+    job_dir = create_workspace()
+    for field, storage in parts:
+        dest_path = os.path.join(job_dir, UPLOAD_FIELDS[field])
+        spooled_path = getattr(storage.stream, 'name', None)
+        storage.stream.flush()
+        try:
+            os.replace(spooled_path, dest_path)
+        except (OSError, TypeError):
+            # Spooled elsewhere (another filesystem, or not by UploadRequest): copy instead
+            storage.stream.seek(0)
+            storage.save(dest_path)
+    return job_dir
+
+
+def uploaded_file(upload_dir, field):
+    """Path of the part uploaded as field and staged in upload_dir, or None"""
+    if upload_dir:
+        path = os.path.join(upload_dir, UPLOAD_FIELDS[field])
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def discard_uploads(upload_dir):
+    if upload_dir:
+        shutil.rmtree(upload_dir, ignore_errors=True)
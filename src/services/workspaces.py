@@ -0,0 +1,252 @@
+import os
+import time
+import heapq
+import shutil
+import logging
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from src.services.job_store import get_job_store
+
+# Every job's working directory (uploads, downloads, intermediate files and the finished PDF) lives here
+WORKSPACE_ROOT = os.path.abspath(os.environ.get('CONVERTER_WORKSPACE_DIR',
+                                                os.path.join(tempfile.gettempdir(), 'epub-converter-jobs')))
+# Finished jobs are removed, record and PDF, this long after they finish (seconds)
+RESULT_TTL = float(os.environ.get('CONVERTER_RESULT_TTL', 3600))
+# Jobs that never finished, because their worker died, are removed after this long (seconds)
+STALE_JOB_AGE = float(os.environ.get('CONVERTER_STALE_JOB_AGE', 24 * 3600))
+# Total size of all workspaces; beyond it finished PDFs are evicted, oldest first
+WORKSPACE_QUOTA_BYTES = int(os.environ.get('CONVERTER_WORKSPACE_QUOTA_BYTES', 10 * 1024 ** 3))
+
+
+def create_workspace():
+    """Create a new, empty job workspace under WORKSPACE_ROOT and return its path"""
+    os.makedirs(WORKSPACE_ROOT, exist_ok=True)
+    return tempfile.mkdtemp(dir=WORKSPACE_ROOT, prefix='job-')
+
+
+def is_workspace(path):
+    """Whether path is a directory directly under WORKSPACE_ROOT; nothing else is ever removed"""
+    return bool(path) and os.path.dirname(os.path.abspath(path)) == WORKSPACE_ROOT
+
+
+def remove_workspace(path):
+    """Remove a workspace and everything in it"""
+    if is_workspace(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def clear_workspace(path, keep=()):
+    """Remove everything in a workspace except the paths in keep"""
+    keep = {os.path.abspath(kept) for kept in keep if kept}
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.path in keep:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def directory_size(path):
+    """Total size in bytes of the files under path"""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+
+def workspaces_of(record):
+    """Workspaces a status record refers to"""
+    if not record:
+        return set()
+    paths = [record.get('workspace'), record.get('upload_dir')]
+    paths += [os.path.dirname(record[key]) for key in ('pdf_path', 'partial_pdf') if record.get(key)]
+    return {os.path.abspath(path) for path in paths if is_workspace(path)}
+
+
+class WorkspaceReaper:
+    """Removes finished jobs, their records and workspaces, once they expire.
+
+    Expirations are kept in a heap ordered by deadline and served by one
+    background thread per process, which sleeps until the earliest of them.
+    The heap only holds jobs that finished in this process; sweep() catches
+    the others, such as the jobs of a worker that was restarted, from the job
+    store and the workspace directory, and runs whenever the thread starts.
+    The thread is started after gunicorn forks, or by the first schedule(),
+    never in the master before it forks.
+    The disk quota is checked by the same thread after every finished job.
+    """
+    def __init__(self, ttl=RESULT_TTL, quota_bytes=WORKSPACE_QUOTA_BYTES):
+        self.ttl = ttl
+        self.quota_bytes = quota_bytes
+        self._heap = []
+        # job id -> its latest deadline; heap entries with an earlier one are stale
+        self._deadlines = {}
+        self._quota_due = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Start this process's reaper thread, unless it is running already"""
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='workspace-reaper', daemon=True)
+            self._thread.start()
+
+    def after_fork(self):
+        """Forget the parent's thread and expirations; called in each forked worker"""
+        self._cond = threading.Condition()
+        self._heap = []
+        self._deadlines = {}
+        self._quota_due = False
+        self._thread = None
+
+    def schedule(self, job_id, workspace=None, delay=None):
+        """Expire a finished job `delay` seconds from now (by default the TTL).
+
+        Its record is deleted then, along with workspace and any workspace
+        the record refers to. A job scheduled again expires at the later of
+        its deadlines. To outlive a sweep in another process, a job kept past
+        the TTL also needs an 'expires_at' timestamp in its record.
+        """
+        deadline = time.time() + (self.ttl if delay is None else delay)
+        with self._cond:
+            deadline = max(deadline, self._deadlines.get(job_id, 0))
+            self._deadlines[job_id] = deadline
+            heapq.heappush(self._heap, (deadline, job_id, workspace))
+            self._quota_due = True
+            self._cond.notify()
+        self.start()
+
+    def expire(self, job_id, workspace=None):
+        """Delete a job's record and remove its workspaces now"""
+        store = get_job_store()
+        record = store.get(job_id)
+        store.delete(job_id)
+        for path in workspaces_of(record) | ({workspace} if workspace else set()):
+            remove_workspace(path)
+
+    def enforce_quota(self):
+        """Evict the oldest finished PDFs until the workspaces fit in the quota; returns the bytes freed.
+
+        An evicted job keeps its record, as 'expired', until its TTL.
+        """
+        usage = directory_size(WORKSPACE_ROOT)
+        if usage <= self.quota_bytes:
+            return 0
+        store = get_job_store()
+        # A completed record's created_at is when it completed
+        finished = sorted((record['created_at'], job_id, record) for job_id, record in store.created_before(datetime.max)
+                          if record['status'] == 'completed' and record.get('pdf_path')
+                          and not record.get('email_pending'))
+        freed = 0
+        for _, job_id, record in finished:
+            if usage - freed <= self.quota_bytes:
+                break
+            for path in workspaces_of(record):
+                size = directory_size(path)
+                remove_workspace(path)
+                freed += size
+            store.update(job_id, status='expired', pdf_path=None, message='The PDF was removed to free disk space')
+            logging.info(f"Evicted the PDF of {job_id} to stay under the workspace quota")
+        if usage - freed > self.quota_bytes:
+            logging.warning(f"Workspaces use {usage - freed} bytes, over the {self.quota_bytes} byte quota, "
+                            f"and no finished PDF is left to evict")
+        return freed
+
+    def sweep(self):
+        """Expire old jobs and remove the workspaces no job refers to.
+
+        Finished jobs older than the TTL and unfinished ones older than
+        STALE_JOB_AGE are expired, unless their record's 'expires_at' is
+        still ahead. Directories under WORKSPACE_ROOT that no remaining record
+        refers to are removed once they are older than the TTL, which leaves
+        the quotes and uploads in flight alone. Returns the number of jobs and
+        orphaned workspaces removed.
+        """
+        store = get_job_store()
+        now = datetime.now()
+        expired = 0
+        for job_id, record in store.created_before(now - timedelta(seconds=self.ttl)):
+            if record.get('expires_at', 0) > time.time():
+                continue
+            if (record['status'] not in ('queued', 'processing')
+                    or record['created_at'] < now - timedelta(seconds=STALE_JOB_AGE)):
+                self.expire(job_id)
+                expired += 1
+
+        live = set()
+        for _, record in store.created_before(datetime.max):
+            live |= workspaces_of(record)
+        orphans = 0
+        cutoff = time.time() - self.ttl
+        try:
+            entries = list(os.scandir(WORKSPACE_ROOT))
+        except OSError:
+            entries = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False) and entry.path not in live and entry.stat().st_mtime < cutoff:
+                    remove_workspace(entry.path)
+                    orphans += 1
+            except OSError:
+                pass
+        if expired or orphans:
+            logging.info(f"Workspace sweep removed {expired} expired jobs and {orphans} orphaned workspaces")
+        return {'expired_jobs': expired, 'orphaned_workspaces': orphans}
+
+    def stats(self):
+        with self._cond:
+            scheduled = len(self._heap)
+        return {'bytes': directory_size(WORKSPACE_ROOT), 'quota_bytes': self.quota_bytes, 'scheduled': scheduled}
+
+    def _run(self):
+        for task in (self.sweep, self.enforce_quota):
+            try:
+                task()
+            except Exception:
+                logging.exception("Workspace sweep failed")
+        while True:
+            with self._cond:
+                while not self._quota_due and (not self._heap or self._heap[0][0] > time.time()):
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                check_quota, self._quota_due = self._quota_due, False
+                due = []
+                while self._heap and self._heap[0][0] <= time.time():
+                    deadline, job_id, workspace = heapq.heappop(self._heap)
+                    if self._deadlines.get(job_id) == deadline:
+                        del self._deadlines[job_id]
+                        due.append((deadline, job_id, workspace))
+            for _, job_id, workspace in due:
+                try:
+                    self.expire(job_id, workspace)
+                except Exception:
+                    logging.exception(f"Could not expire job {job_id}")
+            if check_quota:
+                try:
+                    self.enforce_quota()
+                except Exception:
+                    logging.exception("Workspace quota check failed")
+
+
+# The reaper of this process; gunicorn.conf.py starts it in each worker, the development servers in theirs
+workspace_reaper = WorkspaceReaper()
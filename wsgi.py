@@ -5,10 +5,12 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from src.main import app
+from src.services.workspaces import workspace_reaper
 
 # Configure for production
 app.config["DEBUG"] = False
 
 if __name__ == "__main__":
     # This is only used for development
+    workspace_reaper.start()
     app.run(host="0.0.0.0", port=5000, debug=False)